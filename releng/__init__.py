@@ -94,6 +94,30 @@ def process_multi_configuration_build_results(inputfile):
     with factory.status_reporter as status:
         status.return_value = process_matrix_results(factory, inputfile)
 
+def merge_coverage_results(inputfiles, outputfile, source_dir=None):
+    """Merges coverage results from multiple build configurations.
+
+    Combines line coverage from, e.g., the configurations of a matrix build
+    into a single Cobertura XML file.  The input files are processed in a
+    single pass, so the number of configurations does not influence the
+    memory usage, and no sources need to be checked out.
+
+    Args:
+        inputfiles (List[str]): Files written by process_coverage_results()
+            in each configuration (:file:`logs/coverage-lines.log`),
+            relative to working dir.
+        outputfile (str): Cobertura XML file to write, relative to working dir.
+        source_dir (Optional[str]): Source root to write into the XML.
+            Defaults to the source root of the configuration that produced
+            the first input file.
+    """
+    from factory import ContextFactory
+    from coverage import merge_coverage_artifacts
+    factory = ContextFactory()
+    with factory.status_reporter as status:
+        status.return_value = merge_coverage_artifacts(factory.executor,
+                inputfiles, outputfile, source_dir)
+
 def get_actions_from_triggering_comment():
     """Processes Gerrit comment that triggered the build.
 
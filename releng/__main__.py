@@ -14,6 +14,7 @@ import os
 from common import Project
 from context import BuildContext
 from factory import ContextFactory
+import coverage
 import matrixbuild
 
 def run_build(args, factory):
@@ -33,6 +34,11 @@ def process_matrix(args, factory):
         build_url = 'http://jenkins.gromacs.org/job/{0}/{1}'.format(args.job_name, args.build_number)
         status.return_value = matrixbuild.process_matrix_failures(factory, configs, build_url)
 
+def merge_coverage(args, factory):
+    status = factory.status_reporter
+    status.return_value = coverage.merge_coverage_artifacts(factory.executor,
+            args.input_files, args.output_file, args.source_dir)
+
 parser = argparse.ArgumentParser(description="""\
         Test driver fof build scripts for GROMACS Jenkins CI builds
         """)
@@ -63,6 +69,12 @@ parser_process.add_argument('-J', '--job-name', help='Matrix job name')
 parser_process.add_argument('-n', '--build-number', help='Build number to process')
 parser_process.set_defaults(func=process_matrix)
 
+parser_coverage = subparsers.add_parser('merge-coverage', help='Merge coverage results')
+parser_coverage.add_argument('input_files', nargs='+', help='Coverage artifacts from each configuration')
+parser_coverage.add_argument('-o', '--output-file', required=True, help='Cobertura XML file to write')
+parser_coverage.add_argument('-s', '--source-dir', help='Source root for the XML (default: from the first artifact)')
+parser_coverage.set_defaults(func=merge_coverage)
+
 args = parser.parse_args()
 
 workspace_root = args.workspace
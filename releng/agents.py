@@ -1,6 +1,8 @@
 """
 Information about Jenkins build agents
 """
+import re
+
 from common import ConfigurationError
 
 BS_MAC = 'bs_mac'
@@ -227,8 +229,10 @@ _SPECIAL_HOST_GROUPS = [
             {BS_NIX_AMD_GPU}
         ]
 
-# For hosts not specifically listed here, a default hard-coded in
-# get_default_build_parallelism() is used.
+# Expected build parallelism on each agent, used for balancing matrix builds
+# between the agents, and for builds where the resources of the agent cannot
+# be determined (see resources.py).  For hosts not specifically listed here,
+# a default hard-coded in get_default_build_parallelism() is used.
 _DEFAULT_BUILD_PARALLELISM = {
             BS_WIN2008: 4,
             # The following agents are limited to a single executor, so we
@@ -247,30 +251,220 @@ _DEFAULT_BUILD_PARALLELISM = {
             BS_WIN2012R2: 8
         }
 
+# Number of executors (concurrent builds) on each agent.  For hosts not
+# listed here, a default hard-coded in get_executor_count() is used.
+_EXECUTOR_COUNT = {
+            BS_JETSON_TK1: 1,
+            BS_JETSON_TX1: 1,
+            BS_OVERDRIVE_1000: 1,
+            BS_NIX_AMD_GPU: 1,
+            BS_MAC: 2,
+            BS_GPU01: 2
+        }
+
+_LABEL_EXPRESSION_TOKEN_RE = re.compile(r'\s*(&&|\|\||[!()]|[^\s&|!()]+)')
+
+class _LabelIndex(object):
+    """Inverted index from labels to the hosts that have them.
+
+    Each host is assigned a bit, and each label maps to the bitmask of the
+    hosts that have the label, so the hosts matching a set of labels are
+    found by AND-ing a few integers.  As in Jenkins, each host also has its
+    own name as a label.
+
+    Args:
+        host_labels (Dict[str, Set[str]]): Labels for each host.
+    """
+
+    def __init__(self, host_labels):
+        self._hosts = sorted(host_labels)
+        self._masks = dict()
+        self._expressions = dict()
+        for bit, host in enumerate(self._hosts):
+            for label in set(host_labels[host]) | {host}:
+                self._masks[label] = self._masks.get(label, 0) | (1 << bit)
+        self.all_hosts = (1 << len(self._hosts)) - 1
+
+    def get_mask(self, labels):
+        """Returns the bitmask of hosts that have all the given labels."""
+        mask = self.all_hosts
+        for label in labels:
+            mask &= self._masks.get(label, 0)
+            if not mask:
+                break
+        return mask
+
+    def get_expression_mask(self, expression):
+        """Returns the bitmask of hosts that match a label expression.
+
+        The expression syntax is the subset of Jenkins label expressions
+        with ``&&``, ``||``, ``!``, and parentheses; ``!`` binds tightest
+        and ``||`` loosest.
+
+        Raises:
+            ConfigurationError: If the expression is not valid.
+        """
+        mask = self._expressions.get(expression, None)
+        if mask is None:
+            tokens = _tokenize_label_expression(expression)
+            mask = self._parse_or(tokens, expression)
+            if tokens:
+                raise ConfigurationError('invalid label expression: ' + expression)
+            self._expressions[expression] = mask
+        return mask
+
+    def get_group_mask(self, hosts):
+        """Returns the bitmask of a set of hosts."""
+        mask = 0
+        for host in hosts:
+            mask |= self._masks.get(host, 0)
+        return mask
+
+    def get_hosts(self, mask):
+        """Returns the (sorted) hosts in a bitmask."""
+        return [host for bit, host in enumerate(self._hosts) if mask >> bit & 1]
+
+    def _parse_or(self, tokens, expression):
+        mask = self._parse_and(tokens, expression)
+        while tokens and tokens[0] == '||':
+            tokens.pop(0)
+            mask |= self._parse_and(tokens, expression)
+        return mask
+
+    def _parse_and(self, tokens, expression):
+        mask = self._parse_term(tokens, expression)
+        while tokens and tokens[0] == '&&':
+            tokens.pop(0)
+            mask &= self._parse_term(tokens, expression)
+        return mask
+
+    def _parse_term(self, tokens, expression):
+        token = tokens.pop(0) if tokens else None
+        if token == '!':
+            return self.all_hosts & ~self._parse_term(tokens, expression)
+        if token == '(':
+            mask = self._parse_or(tokens, expression)
+            if not tokens or tokens.pop(0) != ')':
+                raise ConfigurationError('unbalanced parentheses in label expression: ' + expression)
+            return mask
+        if token is None or token in ('&&', '||', ')'):
+            raise ConfigurationError('invalid label expression: ' + expression)
+        return self._masks.get(token, 0)
+
+def _tokenize_label_expression(expression):
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        match = _LABEL_EXPRESSION_TOKEN_RE.match(expression, pos)
+        if not match:
+            raise ConfigurationError('invalid label expression: ' + expression)
+        tokens.append(match.group(1))
+        pos = match.end()
+    return tokens
+
+_index = None
+
+def _get_index():
+    global _index
+    if _index is None:
+        _index = _LabelIndex(_HOST_LABELS)
+    return _index
+
 def is_label(host):
     return host in ALL_LABELS
 
-def is_matrix_host(host):
-    return host in _MATRIX_HOSTS
+def find_non_matrix_hosts(hosts):
+    """Returns the hosts from a list that cannot execute matrix configurations.
+
+    ``None`` values in the list are ignored.
+    """
+    return sorted(set(hosts) - _MATRIX_HOSTS - {None})
 
 def get_default_build_parallelism(host):
     return _DEFAULT_BUILD_PARALLELISM.get(host, 2)
 
-def pick_host(labels, opts):
-    """Selects a host that can build with a given set of labels."""
-    if labels.issubset(_HOST_LABELS[DOCKER_DEFAULT]):
-        return DOCKER_DEFAULT
-    possible_hosts = []
-    for host, host_labels in _HOST_LABELS.iteritems():
-        if labels.issubset(host_labels):
-            possible_hosts.append(host)
-    if not possible_hosts:
-        return None
-    # TODO: If there are multiple possible hosts, it would be better to
-    # optimize the selection globally over all the configurations to
-    # avoid assigning all the builds to the same host.
-    for group in _SPECIAL_HOST_GROUPS:
-        if set(possible_hosts).issubset(group):
-            return possible_hosts[0]
-        possible_hosts = [x for x in possible_hosts if x not in group]
-    return possible_hosts[0]
+def get_executor_count(host):
+    return _EXECUTOR_COUNT.get(host, 2)
+
+def find_hosts(queries):
+    """Finds the hosts that builds with given requirements may use.
+
+    Hosts in _SPECIAL_HOST_GROUPS are only included for a query if no host
+    outside the group matches it.  A query without any requirements matches
+    only DOCKER_DEFAULT.
+
+    Args:
+        queries (List[Tuple[Set[str], str]]): Labels that the host must all
+            have, and a Jenkins label expression that the host must
+            additionally match (see _LabelIndex.get_expression_mask()), or
+            ``None``.
+
+    Returns:
+        List[List[str]]: Sorted names of the matching hosts for each query.
+
+    Raises:
+        ConfigurationError: If an expression is not valid.
+    """
+    index = _get_index()
+    group_masks = [index.get_group_mask(group) for group in _SPECIAL_HOST_GROUPS]
+    result = []
+    for labels, expression in queries:
+        if not labels and expression is None:
+            result.append([DOCKER_DEFAULT])
+            continue
+        mask = index.get_mask(labels)
+        if expression is not None:
+            mask &= index.get_expression_mask(expression)
+        for group_mask in group_masks:
+            if not mask & ~group_mask:
+                break
+            mask &= ~group_mask
+        result.append(index.get_hosts(mask))
+    return result
+
+def assign_hosts(builds):
+    """Selects hosts for a set of builds, balancing the load between hosts.
+
+    The builds are assigned in order of decreasing cost, each to the
+    candidate host where it would finish first (longest processing time
+    first scheduling), which keeps the completion time of the slowest host
+    close to the minimum.  A build is assumed to occupy one executor of the
+    host for its cost divided by the build parallelism of the host, and each
+    host is assumed to run its builds on all its executors in parallel.
+
+    The special host groups are kept as constraints: a build only runs on a
+    special host if no other host can build it.  Ties are broken by host
+    name in reverse order (which prefers the newest of the bs_nix agents),
+    so the result only depends on the input.
+
+    Args:
+        builds (List[Tuple[Set[str], str, float]]): Labels that each build
+            requires, a label expression that the host must additionally
+            match (or ``None``), and an estimate of the relative cost of the
+            build.
+
+    Returns:
+        List[str]: Selected host for each build, in the input order, or
+            ``None`` for builds that no host supports.
+    """
+    keys = list(set([(frozenset(labels), expression) for labels, expression, cost in builds]))
+    candidates = dict(zip(keys, find_hosts(keys)))
+    result = [None] * len(builds)
+    load = dict()
+    order = sorted(range(len(builds)), key=lambda x: (-builds[x][2], x))
+    for index in order:
+        labels, expression, cost = builds[index]
+        hosts = candidates[(frozenset(labels), expression)]
+        if not hosts:
+            continue
+        best = None
+        for host in reversed(hosts):
+            duration = float(cost) / get_default_build_parallelism(host)
+            finish = (load.get(host, 0.0) + duration) / get_executor_count(host)
+            if best is None or finish < best[0]:
+                best = (finish, host, duration)
+        finish, host, duration = best
+        load[host] = load.get(host, 0.0) + duration
+        result[index] = host
+    return result
@@ -0,0 +1,233 @@
+"""
+Streaming creation of compressed tar archives
+
+The archives are written in a single pass: the tar stream is produced
+directly from the source tree (or from the output of a command such as ``git
+archive``), compressed in parallel, and hashed while the compressed data is
+written out.  This avoids both staging the files under a different name and
+re-reading the finished archive for computing checksums.
+
+gzip compression splits the input into blocks that are compressed
+concurrently into separate gzip members.  A concatenation of gzip members is a
+valid gzip file that all standard tools decompress as a single stream, so the
+result is compatible with archives produced by :command:`tar czf`.
+"""
+
+import collections
+import hashlib
+import multiprocessing
+import multiprocessing.pool
+import os
+import shutil
+import tarfile
+import zlib
+
+from common import ConfigurationError
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Size of uncompressed input compressed as one gzip member.
+_GZIP_BLOCK_SIZE = 1024 * 1024
+
+def get_extension(compression):
+    """Returns the file name extension for an archive with given compression."""
+    return '.tar.' + compression
+
+class _GzipCompressor(object):
+    """Compresses blocks into independent gzip members using a thread pool.
+
+    zlib releases the GIL while compressing, so the threads give a real
+    speedup.
+    """
+
+    def __init__(self, level, jobs, block_size):
+        self._level = level
+        self._block_size = block_size
+        self._pool = multiprocessing.pool.ThreadPool(jobs)
+        self._max_pending = 2 * jobs
+        self._pending = collections.deque()
+        self._buffer = []
+        self._buffered = 0
+
+    def compress(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        output = []
+        if self._buffered >= self._block_size:
+            data = b''.join(self._buffer)
+            self._buffer = []
+            self._buffered = 0
+            for start in range(0, len(data) - self._block_size + 1, self._block_size):
+                output.extend(self._submit(data[start:start + self._block_size]))
+            remainder = len(data) % self._block_size
+            if remainder:
+                self._buffer.append(data[-remainder:])
+                self._buffered = remainder
+        return b''.join(output)
+
+    def flush(self):
+        output = []
+        if self._buffered or not self._pending:
+            output.extend(self._submit(b''.join(self._buffer)))
+            self._buffer = []
+            self._buffered = 0
+        while self._pending:
+            output.append(self._pending.popleft().get())
+        self.close()
+        return b''.join(output)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _submit(self, block):
+        self._pending.append(self._pool.apply_async(_compress_gzip_member, (block, self._level)))
+        output = []
+        while len(self._pending) > self._max_pending:
+            output.append(self._pending.popleft().get())
+        return output
+
+def _compress_gzip_member(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+class _ZstdCompressor(object):
+    def __init__(self, level, jobs):
+        compressor = zstandard.ZstdCompressor(level=level, threads=jobs)
+        self._compressor = compressor.compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def close(self):
+        pass
+
+class _XzCompressor(object):
+    def __init__(self, level):
+        self._compressor = lzma.LZMACompressor(preset=level)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def close(self):
+        pass
+
+def _create_compressor(compression, level, jobs, block_size):
+    if compression == 'gz':
+        return _GzipCompressor(level, jobs, block_size)
+    elif compression == 'xz':
+        if lzma is None:
+            raise ConfigurationError('xz compression requires the lzma module')
+        return _XzCompressor(min(level, 6))
+    elif compression == 'zst':
+        if zstandard is None:
+            raise ConfigurationError('zstd compression requires the zstandard module')
+        return _ZstdCompressor(level, jobs)
+    raise ConfigurationError('unknown archive compression: ' + compression)
+
+class ArchiveWriter(object):
+
+    """File-like object that compresses and hashes data written to it.
+
+    The compressed data is first written to a temporary file next to the
+    given path, which is renamed to the final name when the writer is
+    closed, so that an incomplete archive never appears under that name.
+    The MD5 and SHA-256 checksums of the compressed file are available from
+    ``digests`` after the writer has been closed.  Can be used as a context
+    manager; if the with block raises, the writer is aborted.
+
+    Args:
+        path (str): Path of the compressed file to write.
+        compression (Optional[str]): ``gz``, ``xz``, or ``zst``.
+        level (Optional[int]): Compression level.
+        jobs (Optional[int]): Number of threads to use for compression.
+            Defaults to the number of CPUs; builds pass their number of
+            jobs instead, so that they stay within their share of the agent.
+    """
+
+    def __init__(self, path, compression='gz', level=9, jobs=None,
+            block_size=_GZIP_BLOCK_SIZE):
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+        self.digests = None
+        self._compressor = _create_compressor(compression, level, jobs, block_size)
+        self._md5 = hashlib.md5()
+        self._sha256 = hashlib.sha256()
+        self._path = path
+        self._tmp_path = path + '.partial'
+        self._fp = open(self._tmp_path, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def write(self, data):
+        self._write_compressed(self._compressor.compress(data))
+
+    def close(self):
+        if self._fp.closed:
+            return
+        self._write_compressed(self._compressor.flush())
+        self._fp.close()
+        if os.name == 'nt' and os.path.exists(self._path):
+            # os.rename() does not replace existing files on Windows.
+            os.remove(self._path)
+        os.rename(self._tmp_path, self._path)
+        self.digests = {
+                'md5': self._md5.hexdigest(),
+                'sha256': self._sha256.hexdigest()
+            }
+
+    def abort(self):
+        """Discards the archive written so far."""
+        if self._fp.closed:
+            return
+        self._compressor.close()
+        self._fp.close()
+        os.remove(self._tmp_path)
+
+    def _write_compressed(self, data):
+        if data:
+            self._md5.update(data)
+            self._sha256.update(data)
+            self._fp.write(data)
+
+def write_tree(fileobj, root_dir, arcname):
+    """Writes a directory tree as an uncompressed tar stream.
+
+    Args:
+        fileobj (file): Object to write the tar stream to.
+        root_dir (str): Directory to archive.
+        arcname (str): Name of the directory within the archive.
+    """
+    with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+        tar.add(root_dir, arcname)
+
+def copy_stream(source, fileobj):
+    """Copies an already existing tar stream (e.g., from a pipe)."""
+    shutil.copyfileobj(source, fileobj, 1024 * 1024)
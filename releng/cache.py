@@ -0,0 +1,114 @@
+"""
+Agent-local caches shared between builds
+
+Results that are expensive to recompute and that do not depend on the
+workspace contents are stored in a per-agent cache directory outside the
+workspace, so that subsequent builds on the same agent (also from different
+jobs) can reuse them.  The location defaults to :file:`~/.cache/releng/`, and
+can be overridden with the ``RELENG_CACHE_DIR`` environment variable.
+
+All cached data must be safe to delete at any time; the caches only exist to
+speed up the builds.
+"""
+
+import hashlib
+import json
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where the caches that need locking are not
+    # used.
+    fcntl = None
+
+def get_cache_dir(env, name):
+    """Returns the directory for a named cache.
+
+    The directory is not created.
+
+    Args:
+        env (Dict[str,str]): Environment variables for the build.
+        name (str): Name of the cache (a subdirectory of the cache root).
+
+    Returns:
+        str: Absolute path to the cache directory.
+    """
+    root = env.get('RELENG_CACHE_DIR', None)
+    if not root:
+        root = os.path.join(os.path.expanduser('~'), '.cache', 'releng')
+    return os.path.join(root, name)
+
+def compute_key(*parts):
+    """Computes a cache key from JSON-serializable values.
+
+    Returns:
+        str: Hexadecimal digest that identifies the values.
+    """
+    data = json.dumps(parts, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+def get_file_stamp(path):
+    """Returns a value that changes whenever the given file is modified.
+
+    Returns:
+        List or None: Modification time and size of the file, or ``None``
+            if the file does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime, stat.st_size]
+
+def touch(path):
+    """Marks a cache entry as recently used (for prune_lru())."""
+    os.utime(path, None)
+
+def prune_lru(cache_dir, max_entries, remove_path):
+    """Removes least recently used entries from a cache directory.
+
+    Each subdirectory of cache_dir is considered an entry, and the
+    modification time of the directory (see touch()) the time it was last
+    used.  The caller should hold a lock that prevents concurrent use of the
+    entries.
+
+    Args:
+        cache_dir (str): Directory that contains the entries.
+        max_entries (int): Number of most recently used entries to keep.
+        remove_path (function): Function to use for removing an entry.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path):
+            entries.append((os.path.getmtime(path), path))
+    entries.sort(reverse=True)
+    for mtime, path in entries[max_entries:]:
+        remove_path(path)
+
+class FileLock(object):
+
+    """Exclusive lock between processes, based on a lock file.
+
+    Used as a context manager to serialize updates to a shared cache between
+    concurrent builds on the same agent.  The lock is released also if the
+    process dies.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._fp = None
+
+    def __enter__(self):
+        self._fp = open(self._path, 'a')
+        if fcntl is not None:
+            fcntl.flock(self._fp.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl is not None:
+            fcntl.flock(self._fp.fileno(), fcntl.LOCK_UN)
+        self._fp.close()
+        self._fp = None
+        return False
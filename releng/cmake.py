@@ -1,11 +1,14 @@
 """
 Helper routines for parsing CMake-related stuff.
 """
+import collections
 import os.path
 import re
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
 
 from common import BuildError, ConfigurationError
+import utils
 
 def read_cmake_variable_file(executor, path):
     """Reads a file with CMake variable declarations (set commands).
@@ -43,19 +46,58 @@ def get_cmake_version(cmd_runner, cmake_executable):
         return match.group(1)
     raise ConfigurationError('Could not parse CMake version:\n' + output)
 
-def process_ctest_xml(executor, memcheck):
+CTestResult = collections.namedtuple('CTestResult', ['name', 'duration', 'passed'])
+
+# Default limit for the amount of test output included in the JUnit XML for a
+# single test.  The output from CTest can be very large for failing tests (in
+# particular with memory checkers); the end of it is usually the most useful.
+DEFAULT_MAX_TEST_OUTPUT = 1024 * 1024
+
+def process_ctest_xml(executor, memcheck, max_output_size=DEFAULT_MAX_TEST_OUTPUT):
+    """Converts XML output from CTest into JUnit XML for Jenkins.
+
+    The CTest XML is parsed incrementally, and the JUnit XML is written out
+    one test at a time, so that the whole XML trees are never in memory.
+
+    Args:
+        executor (Executor): Executor to use for file access.
+        memcheck (bool): Whether CTest was run with a memory checker.
+        max_output_size (Optional[int]): Maximum number of characters of
+            output to include for each test.  If the output is longer, only
+            its end is included.  ``None`` disables the limit.
+
+    Returns:
+        List[CTestResult]: Name, execution time, and status of each test.
+            Empty for memcheck runs, which do not report the times.
+    """
     tag = _read_ctest_tag_name(executor)
-    xml_name, test_xpath, suite_name = _get_properties(memcheck)
-    ctest_root = _read_ctest_xml(executor, tag, xml_name)
-    junit_root = ET.Element('testsuites')
-    junit_suite = ET.SubElement(junit_root, 'testsuite', {'name': suite_name})
-    for test in ctest_root.findall(test_xpath):
+    xml_name, test_path, suite_name = _get_properties(memcheck)
+    xml_path = os.path.join('Testing', tag, xml_name)
+    tests = utils.iterparse_elements(executor.read_file(xml_path, binary=True), test_path)
+    results = []
+    contents = _generate_junit_xml(tests, suite_name, memcheck, max_output_size, results)
+    executor.write_file('Testing/Temporary/CTest.xml', contents)
+    return results
+
+def _generate_junit_xml(tests, suite_name, memcheck, max_output_size, results):
+    yield '<testsuites><testsuite name={0}>'.format(quoteattr(suite_name))
+    for test in tests:
         if memcheck:
-            _create_junit_testcase_memcheck(test, junit_suite, suite_name)
+            junit_case = _create_junit_testcase_memcheck(test, suite_name)
         else:
-            _create_junit_testcase(test, junit_suite, suite_name)
-    contents = ET.tostring(junit_root)
-    executor.write_file('Testing/Temporary/CTest.xml', contents)
+            junit_case = _create_junit_testcase(test, suite_name)
+            results.append(CTestResult(junit_case.get('name'),
+                float(junit_case.get('time')), junit_case.find('failure') is None))
+        output = junit_case.find('system-out')
+        output.text = _truncate_output(output.text, max_output_size)
+        yield ET.tostring(junit_case)
+    yield '</testsuite></testsuites>'
+
+def _truncate_output(text, max_size):
+    if text is None or max_size is None or len(text) <= max_size:
+        return text
+    return '[... {0} characters of output omitted ...]\n'.format(len(text) - max_size) \
+            + text[-max_size:]
 
 def _read_ctest_tag_name(executor):
     lines = list(executor.read_file('Testing/TAG'))
@@ -68,35 +110,31 @@ def _get_properties(memcheck):
         # TODO: If the tests pass, they do not create Test entries at all (at
         # least, not for ASAN)...
         # It would be nice to still get the same list of tests always.
-        return 'DynamicAnalysis.xml', './DynamicAnalysis/Test', 'CTest_MemCheck'
+        return 'DynamicAnalysis.xml', ['DynamicAnalysis', 'Test'], 'CTest_MemCheck'
     else:
-        return 'Test.xml', './Testing/Test', 'CTest'
-
-def _read_ctest_xml(executor, tag, xml_name):
-    xml_path = os.path.join('Testing', tag, xml_name)
-    xml_lines = executor.read_file(xml_path)
-    return ET.fromstring(''.join(xml_lines))
+        return 'Test.xml', ['Testing', 'Test'], 'CTest'
 
-def _create_junit_testcase(test, parent, suite_name):
+def _create_junit_testcase(test, suite_name):
     name = test.find('Name').text
     time = _get_named_measurement(test, 'Execution Time')
     passed = (test.get('Status') == 'passed')
     attrs = {'name': name, 'classname': suite_name, 'time': time}
-    junit_case = ET.SubElement(parent, 'testcase', attrs)
+    junit_case = ET.Element('testcase', attrs)
     if not passed:
         reason = _get_named_measurement(test, 'Exit Code')
         failure = ET.SubElement(junit_case, 'failure', {'message': reason})
     output = ET.SubElement(junit_case, 'system-out')
     output.text = test.find('./Results/Measurement/Value').text
+    return junit_case
 
 def _get_named_measurement(test, name):
     return test.find("./Results/NamedMeasurement[@name='{0}']/Value".format(name)).text
 
-def _create_junit_testcase_memcheck(test, parent, suite_name):
+def _create_junit_testcase_memcheck(test, suite_name):
     name = test.find('Name').text
     passed = (test.get('Status') == 'passed')
     attrs = {'name': name, 'classname': suite_name}
-    junit_case = ET.SubElement(parent, 'testcase', attrs)
+    junit_case = ET.Element('testcase', attrs)
     if not passed:
         # TODO: This will produce an empty message if the test fails normally,
         # not because of an ASAN error...
@@ -105,3 +143,4 @@ def _create_junit_testcase_memcheck(test, parent, suite_name):
         failure = ET.SubElement(junit_case, 'failure', {'message': reason})
     output = ET.SubElement(junit_case, 'system-out')
     output.text = test.find('Log').text
+    return junit_case
@@ -78,6 +78,9 @@ class Enum(object):
         attrs.update(kwargs)
         values.extend(kwargs.itervalues())
         attrs['_values'] = tuple(values)
+        # Case-folded lookup table for parse(); the first value wins if
+        # several only differ in case.
+        attrs['_lookup'] = dict([(x.lower(), x) for x in reversed(values)])
         return type(name, (Enum,), attrs)
 
     @classmethod
@@ -93,9 +96,9 @@ class Enum(object):
         Args:
             value[str]: String to convert.
         """
-        for allowed in cls._values:
-            if value.lower() == allowed.lower():
-                return allowed
+        allowed = cls._lookup.get(value.lower(), None)
+        if allowed is not None:
+            return allowed
         raise ConfigurationError('unknown {0}: {1}'.format(cls.__name__, value))
 
 # Currently, the string values should match the result of
@@ -111,6 +114,16 @@ Project = Enum.create('Project',
     'gromacs', 'regressiontests', 'releng',
     doc="""Enum to identify a git repository/directory used in the build""")
 
+# Currently, the string values are used as-is in environment variables that
+# select the mode (see ProjectsManager).
+CheckoutMode = Enum.create('CheckoutMode',
+    'full', 'shallow', 'partial',
+    doc="""Enum to identify how much of the git history to fetch in checkouts
+
+           ``shallow`` fetches only the commit to build (``--depth=1``), and
+           ``partial`` fetches all commits, but file contents only for the
+           checked-out commit (``--filter=blob:none``).""")
+
 # There is no special significance with these strings.
 JobType = Enum.create('JobType',
     'gerrit', 'nightly', 'release',
@@ -1,18 +1,28 @@
 """
 Top-level interface for build scripts to the releng package.
 """
+from __future__ import print_function
+
+import collections
 import os
 import glob
 import hashlib
 import re
 import shutil
+import sqlite3
 import subprocess
 
 from common import BuildError, CommandError, ConfigurationError
 from common import JobType, Project
 from options import BuildConfig, process_build_options, select_build_hosts
 from script import BuildScript, BuildScriptSettings
+import archive
+import cache
 import cmake
+import coverage
+import ninjalog
+import testimpact
+import testtimes
 import utils
 
 class BuildContext(object):
@@ -44,6 +54,13 @@ class BuildContext(object):
         self._cmd_runner = factory.cmd_runner
         self._executor = factory.executor
         self._projects = factory.projects
+        self._gerrit = factory.gerrit
+        self._timeline = factory.timeline
+        self._archive_digests = dict()
+        self._test_times = None
+        self._test_selection = None
+        self._test_selection_done = False
+        self._cache_env = factory.env
         self._version = None
         self.workspace = factory.workspace
         self.env, self.opts = process_build_options(factory, opts, script_settings)
@@ -60,7 +77,8 @@ class BuildContext(object):
         self._cwd.chdir(path)
 
     def run_cmd(self, cmd, ignore_failure=False, use_return_code=False,
-            use_output=False, failure_message=None, **kwargs):
+            use_output=False, failure_message=None, log_file=None,
+            echo_output=True, **kwargs):
         """Runs a command via subprocess.
 
         This wraps subprocess.call() and check_call() with error-handling code
@@ -82,12 +100,30 @@ class BuildContext(object):
             failure_message (Optional[str]): If set, provides a friendly
                 message about what in the build fails if this command fails.
                 This will be reported back to Gerrit.
+            log_file (Optional[str]): If set, the output of the command is
+                streamed to the console and also written to a log file with
+                this name in the common log directory (see
+                Workspace.get_path_for_logfile()), without keeping the whole
+                output in memory.  Mutually exclusive with use_output.
+            echo_output (Optional[bool]): If ``False`` and log_file is set,
+                the output is only written to the log file, and only the last
+                lines of it are printed to the console if the command fails.
 
         Returns:
             int: Command return code (if ``use_return_code=True``).
         """
+        if log_file is not None:
+            if use_output:
+                raise ConfigurationError('run_cmd() cannot both return the output and stream it to a log')
+            log_path = self.workspace.get_path_for_logfile(log_file)
         try:
-            if use_return_code:
+            if log_file is not None:
+                if use_return_code:
+                    return self._cmd_runner.call_streaming(cmd,
+                            log_path=log_path, echo=echo_output, **kwargs)
+                self._cmd_runner.check_call_streaming(cmd,
+                        log_path=log_path, echo=echo_output, **kwargs)
+            elif use_return_code:
                 return self._cmd_runner.call(cmd, **kwargs)
             elif use_output:
                 if not 'stderr' in kwargs:
@@ -101,6 +137,39 @@ class BuildContext(object):
                     failure_message = 'failed to execute: ' + e.cmd
                 raise BuildError(failure_message)
 
+    def run_cmds(self, cmds, ignore_failure=False, failure_message=None, **kwargs):
+        """Runs a batch of independent commands concurrently.
+
+        The commands are run using at most as many parallel processes as are
+        used for building (see the ``build-jobs`` build option).  The output
+        of each command is printed as one block when the command finishes,
+        with each line prefixed by a label of the command.  The labels are
+        sequence numbers over all commands started concurrently during the
+        build, so they do not match the positions in cmds after the first
+        batch.
+        Any arguments accepted by run_cmd() for subprocess.call() can also be
+        passed, and apply to all the commands.
+
+        Args:
+            cmds (List[str/list]): Commands to execute.
+            ignore_failure (Optional[bool]): If ``True``, failure to run any
+                of the commands is ignored.
+            failure_message (Optional[str]): If set, provides a friendly
+                message about what in the build fails if any command fails.
+                This will be reported back to Gerrit.
+
+        Returns:
+            List[int]: Exit codes of the commands, in the order of cmds.
+        """
+        try:
+            jobs = self._cmd_runner.run_many(cmds, max_jobs=self.env._build_jobs,
+                    check=not ignore_failure, **kwargs)
+        except CommandError as e:
+            if failure_message is None:
+                failure_message = 'failed to execute: ' + e.cmd
+            raise BuildError(failure_message)
+        return [job.returncode for job in jobs]
+
     def run_cmake(self, options):
         """Runs CMake with the provided options.
 
@@ -117,20 +186,25 @@ class BuildContext(object):
         Raises:
             BuildError: If CMake fails to configure the build system.
         """
-        options = options.copy()
-        options['CMAKE_C_COMPILER'] = self.env.c_compiler
-        options['CMAKE_CXX_COMPILER'] = self.env.cxx_compiler
-        options['CMAKE_INSTALL_PREFIX'] = self.workspace.install_dir
-        options.update(self.env.extra_cmake_options)
-        cmake_args = [self.env.cmake_command, self.workspace.get_project_dir(Project.GROMACS)]
-        if self.env.cmake_generator is not None:
-            cmake_args.extend(['-G', self.env.cmake_generator])
-        cmake_args.extend(
-                ['-D{0}={1}'.format(key, value)
-                    for key, value in sorted(options.iteritems())
-                    if value is not None])
-        self.run_cmd([self.env.cmake_command, '--version'])
-        self.run_cmd(cmake_args, failure_message='CMake configuration failed')
+        with self._timeline.span('run_cmake', 'step'):
+            options = options.copy()
+            options['CMAKE_C_COMPILER'] = self.env.c_compiler
+            options['CMAKE_CXX_COMPILER'] = self.env.cxx_compiler
+            options['CMAKE_INSTALL_PREFIX'] = self.workspace.install_dir
+            if self.job_type == JobType.GERRIT:
+                # Used for selecting the tests to run (see run_ctest()).
+                options.setdefault('CMAKE_EXPORT_COMPILE_COMMANDS', 'ON')
+            options.update(self.env._get_job_pool_options())
+            options.update(self.env.extra_cmake_options)
+            cmake_args = [self.env.cmake_command, self.workspace.get_project_dir(Project.GROMACS)]
+            if self.env.cmake_generator is not None:
+                cmake_args.extend(['-G', self.env.cmake_generator])
+            cmake_args.extend(
+                    ['-D{0}={1}'.format(key, value)
+                        for key, value in sorted(options.iteritems())
+                        if value is not None])
+            self.run_cmd([self.env.cmake_command, '--version'])
+            self.run_cmd(cmake_args, failure_message='CMake configuration failed')
 
     def build_target(self, target=None, parallel=True, keep_going=False,
             target_descr=None, failure_string=None, continue_on_failure=False):
@@ -158,24 +232,106 @@ class BuildContext(object):
             BuildError: If the target fails to build, and
                 ``continue_on_failure`` is not specified.
         """
-        cmd = self.env._get_build_cmd(target=target, parallel=parallel, keep_going=keep_going)
-        try:
-            self.run_cmd(cmd)
-        except BuildError:
-            if failure_string is None:
-                if target_descr is not None:
-                    what = target_descr
-                elif target is None:
-                    what = 'Default (all) target'
+        with self._timeline.span('build_target', 'step', target=target):
+            cmd = self.env._get_build_cmd(target=target, parallel=parallel, keep_going=keep_going)
+            ccache_stats = self._read_ccache_stats()
+            previous_ninja_log = self._read_ninja_log()
+            try:
+                self.run_cmd(cmd)
+            except BuildError:
+                if failure_string is None:
+                    if target_descr is not None:
+                        what = target_descr
+                    elif target is None:
+                        what = 'Default (all) target'
+                    else:
+                        what = target + ' target'
+                    failure_string = '{0} failed to build'.format(what)
+                if continue_on_failure:
+                    self._status_reporter.mark_failed(failure_string)
                 else:
-                    what = target + ' target'
-                failure_string = '{0} failed to build'.format(what)
-            if continue_on_failure:
-                self._status_reporter.mark_failed(failure_string)
-            else:
-                raise BuildError(failure_string)
+                    raise BuildError(failure_string)
+            finally:
+                self.env._add_build_peak_memory(self._executor.get_last_command_peak_memory())
+                self._write_ccache_stats(target, ccache_stats)
+                self._write_build_time_report(target, previous_ninja_log)
+
+    def _read_ninja_log(self):
+        """Returns the lines of .ninja_log, or nothing if not a Ninja build."""
+        if not self.env._is_ninja_build():
+            return []
+        try:
+            return list(self._executor.read_file(self._cwd.to_abs_path('.ninja_log')))
+        except (IOError, OSError):
+            return []
+
+    def _write_build_time_report(self, target, previous_lines):
+        """Writes the slowest build steps from .ninja_log into a log file.
 
-    def run_ctest(self, args, memcheck=False, failure_string=None):
+        Only the entries that are not in previous_lines (the log before the
+        build) are reported.  Ninja may recompact the log at the start of a
+        build, but it keeps the surviving entries unchanged, so this finds the
+        steps of this build also in that case, and none if nothing was rebuilt.
+        """
+        lines = self._read_ninja_log()
+        if not lines:
+            return
+        previous_lines = set(previous_lines)
+        steps = ninjalog.parse_ninja_log([x for x in lines if x not in previous_lines])
+        name = 'build-times.log'
+        if target is not None:
+            name = 'build-times-{0}.log'.format(target)
+        path = self.workspace.get_path_for_logfile(name)
+        ninjalog.write_build_time_report(self._executor, path, target, steps)
+
+    def _read_ccache_stats(self):
+        """Returns the ccache statistics counters, or None if not available.
+
+        The statistics are stored in the cache directory, which is shared
+        with other builds on the agent, so they are not reset; instead, the
+        counters are read before and after a build, and the difference is
+        reported (this includes any other builds that use the cache at the
+        same time).  Requires ccache 3.7 or later (for ``--print-stats``).
+        """
+        if self.env.ccache_command is None:
+            return None
+        try:
+            output = self._cmd_runner.check_output([self.env.ccache_command, '--print-stats'])
+        except CommandError as e:
+            print('Could not get ccache statistics: ' + str(e), file=self._cmd_runner.console)
+            return None
+        stats = collections.OrderedDict()
+        for line in output.splitlines():
+            fields = line.split('\t')
+            if len(fields) == 2 and not fields[0].endswith('timestamp'):
+                try:
+                    stats[fields[0]] = int(fields[1])
+                except ValueError:
+                    pass
+        return stats
+
+    def _write_ccache_stats(self, target, before):
+        """Writes ccache statistics of a build into a log file, if ccache is used.
+
+        Args:
+            target (str or None): Target that was built (for the file name).
+            before (Dict[str, int] or None): Counters from before the build.
+        """
+        if before is None:
+            return
+        after = self._read_ccache_stats()
+        if after is None:
+            return
+        lines = ['{0:<38} {1}\n'.format(name, value - before.get(name, 0))
+                for name, value in after.iteritems()]
+        name = 'ccache-stats.log'
+        if target is not None:
+            name = 'ccache-stats-{0}.log'.format(target)
+        path = self.workspace.get_path_for_logfile(name)
+        self._executor.write_file(path, ''.join(lines))
+
+    def run_ctest(self, args, memcheck=False, failure_string=None,
+            max_output_size=cmake.DEFAULT_MAX_TEST_OUTPUT):
         """Runs tests using CTest.
 
         The build is marked unstable if any test fails.
@@ -185,19 +341,128 @@ class BuildContext(object):
             memcheck (Optional[bool]): If ``true``, run CTest with a memory checker.
             failure_string (Optional[str]): If give, this message is used as
                 the failure message reported to Gerrit if the tests fail.
+            max_output_size (Optional[int]): Maximum number of characters of
+                output to report to Jenkins for each test (the end of the
+                output is kept).  ``None`` reports all output.
+        """
+        with self._timeline.span('run_ctest', 'step', memcheck=memcheck):
+            dtype = 'ExperimentalTest'
+            if memcheck:
+                dtype = 'ExperimentalMemCheck'
+            cmd = [self.env.ctest_command, '-D', dtype]
+            if not any(x.startswith('-j') or x.startswith('--parallel') for x in args):
+                cmd.append('-j{0}'.format(self.env._build_jobs))
+            cmd.extend(args)
+            selection = None
+            if testimpact.has_test_filter(args):
+                print('Test selection not used: the CTest arguments select the tests',
+                        file=self._cmd_runner.console)
+            else:
+                selection = self._get_test_selection()
+            if selection is not None and selection.tests is not None:
+                cmd.extend(['-R', testimpact.get_test_regex(selection.tests)])
+            self._write_ctest_cost_data()
+            try:
+                self._cmd_runner.check_call(cmd)
+            except CommandError as e:
+                if failure_string is None:
+                    failure_string = 'failed test: ' + e.cmd
+                self.mark_unstable(failure_string)
+            results = cmake.process_ctest_xml(self._executor, memcheck, max_output_size)
+            self._record_test_times(results)
+
+    def _get_test_selection(self):
+        """Selects the tests to run for a change in a per-patchset build.
+
+        See testimpact.py for details.  The selection is done on the first
+        call, and the result reused for later CTest runs.
+
+        Returns:
+            TestSelection or None: Tests to run, or ``None`` if selection
+                is not used for this build.
         """
-        dtype = 'ExperimentalTest'
-        if memcheck:
-            dtype = 'ExperimentalMemCheck'
-        cmd = [self.env.ctest_command, '-D', dtype]
-        cmd.extend(args)
+        if not self._test_selection_done:
+            self._test_selection_done = True
+            selection = self._select_tests_for_change()
+            if selection is not None:
+                if selection.tests is None:
+                    print('Running all tests: ' + selection.reason, file=self._cmd_runner.console)
+                else:
+                    note = 'Test selection: ' + selection.reason
+                    if selection.skipped:
+                        note += '; skipped ' + ', '.join(selection.skipped)
+                    print(note, file=self._cmd_runner.console)
+                    self._status_reporter.add_note(note)
+            self._test_selection = selection
+        return self._test_selection
+
+    def _is_build_of_triggering_change(self):
+        """Checks whether this is a per-patchset build of a GROMACS change.
+
+        Returns:
+            bool: Whether the GROMACS checkout is the change that triggered
+                the build, so that the change is ``HEAD^..HEAD``.
+        """
+        if self.job_type != JobType.GERRIT:
+            return False
+        if self._gerrit.get_triggering_project() != Project.GROMACS:
+            return False
+        project_info = self._projects.get_project_info(Project.GROMACS)
+        triggering_refspec = self._gerrit.get_triggering_refspec()
+        return not project_info.is_tarball \
+                and project_info.refspec.fetch == triggering_refspec.fetch
+
+    def _select_tests_for_change(self):
+        if self._cache_env.get('RELENG_DISABLE_TEST_SELECTION', None):
+            return None
+        if not self._is_build_of_triggering_change():
+            return None
+        source_dir = self.workspace.get_project_dir(Project.GROMACS)
+        cmd = ['git', 'diff', '--name-only', '--no-renames', 'HEAD^', 'HEAD']
         try:
-            self._cmd_runner.check_call(cmd)
-        except CommandError as e:
-            if failure_string is None:
-                failure_string = 'failed test: ' + e.cmd
-            self.mark_unstable(failure_string)
-        cmake.process_ctest_xml(self._executor, memcheck)
+            changed_files = self._cmd_runner.check_output(cmd, cwd=source_dir).splitlines()
+        except CommandError:
+            return testimpact.TestSelection(None, [], 'could not determine changed files')
+        return testimpact.select_tests(self._cmd_runner, self._executor,
+                source_dir, self._cwd.cwd, changed_files)
+
+    def _get_test_timing_store(self):
+        if self._test_times is None:
+            path = os.path.join(cache.get_cache_dir(self._cache_env, 'ctest'), 'times.sqlite')
+            self._executor.ensure_dir_exists(os.path.dirname(path))
+            self._test_times = testtimes.TestTimingStore(self._executor.connect_database(path))
+        return self._test_times
+
+    def _get_test_timing_key(self):
+        try:
+            project_info = self._projects.get_project_info(Project.GROMACS, expect_checkout=False)
+            branch = project_info.branch or ''
+        except ConfigurationError:
+            branch = ''
+        return branch, self.opts.get_config_string(exclude=('build-jobs',))
+
+    def _write_ctest_cost_data(self):
+        """Writes CTestCostData.txt from earlier runs, to start the longest tests first."""
+        try:
+            branch, config = self._get_test_timing_key()
+            history = self._get_test_timing_store().get_history(branch, config)
+        except sqlite3.Error as e:
+            print('Could not read test timings: ' + str(e), file=self._cmd_runner.console)
+            return
+        if not history:
+            return
+        self._executor.ensure_dir_exists('Testing/Temporary')
+        testtimes.write_cost_data(self._executor, 'Testing/Temporary/CTestCostData.txt', history)
+
+    def _record_test_times(self, results):
+        if not results:
+            return
+        try:
+            branch, config = self._get_test_timing_key()
+            self._get_test_timing_store().record(branch, config, results)
+        except sqlite3.Error as e:
+            # The timings only serve to speed up later builds.
+            print('Could not store test timings: ' + str(e), file=self._cmd_runner.console)
 
     def compute_md5(self, path):
         """Computes MD5 hash of a file.
@@ -208,10 +473,19 @@ class BuildContext(object):
         Returns:
             str: String with the computed hash in hexadecimal.
         """
+        return self._get_file_digests(path)['md5']
+
+    def _get_file_digests(self, path):
+        """Returns checksums of a file, reusing those from make_archive()."""
+        digests = self._archive_digests.get(self._cwd.to_abs_path(path), None)
+        if digests:
+            return digests
         md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
         for block in self._executor.read_file(path, binary=True):
             md5.update(block)
-        return md5.hexdigest()
+            sha256.update(block)
+        return { 'md5': md5.hexdigest(), 'sha256': sha256.hexdigest() }
 
     def read_cmake_variable_file(self, path):
         """Reads a file with CMake variable declarations (set commands).
@@ -238,12 +512,14 @@ class BuildContext(object):
             version (str): Version for the package.
         """
         project_info = self._projects.get_project_info(project)
+        digests = self._get_file_digests(file_name)
         values = {
                 'HEAD_HASH': project_info.head_hash,
                 'BUILD_NUMBER': os.environ['BUILD_NUMBER'],
                 'PACKAGE_FILE_NAME': file_name,
                 'PACKAGE_VERSION': version,
-                'MD5SUM': self.compute_md5(file_name)
+                'MD5SUM': digests['md5'],
+                'SHA256SUM': digests['sha256']
             }
         path = self.workspace.get_path_for_logfile('package-info.log')
         self.write_property_file(path, values)
@@ -269,41 +545,55 @@ class BuildContext(object):
         contents = re.sub(pattern, repl, contents)
         self._executor.write_file(path, contents)
 
-    def make_archive(self, path, root_dir=None, use_git=False, prefix=None):
-        """Creates a tar.gz archive.
+    def make_archive(self, path, root_dir=None, use_git=False, prefix=None,
+            compression='gz'):
+        """Creates a compressed tar archive.
+
+        The archive is written in a single pass with parallel compression
+        (using as many threads as the build), and its checksums are computed while it is written, so that
+        write_package_info() does not need to read it again.
 
         Args:
             path (str): Path to the archive to create without extension.
             root_dir (str): Root directory from which the archive should be
                 created.
+            use_git (Optional[bool]): If ``True``, archive HEAD of the git
+                repository in the current working directory instead of
+                root_dir.
+            prefix (Optional[str]): Name of the top-level directory in the
+                archive.  Defaults to the name of root_dir.
+            compression (Optional[str]): ``gz`` (the default), ``xz``, or
+                ``zst``.  The latter two require optional Python modules.
         """
-        if prefix:
-            prefix += '/'
-        if use_git:
-            if root_dir:
-                raise ConfigurationError("archiving with root dir with git not implemented")
-            cmd = ['git', 'archive', '-o', path + '.tar.gz']
-            cmd.append('--prefix=' + prefix)
-            cmd.extend(['-9', 'HEAD'])
-            self.run_cmd(cmd)
-        else:
-            path = self._cwd.to_abs_path(path)
-            # TODO: Check that root_dir is a subdirectory of the workspace
-            # (this all does not work if it is the workspace itself).
-            if not os.path.isabs(root_dir):
-                root_dir = os.path.join(self._cwd.cwd, root_dir)
-            org_dir = root_dir
-            root_dir, base_dir = os.path.split(root_dir)
-            # TODO: Instead of renaming the directory twice, we could use
-            # tarfile directly to create the archive.
-            if prefix:
-                base_dir = prefix
-                shutil.move(org_dir, os.path.join(root_dir, prefix))
-            if not base_dir:
-                base_dir = '.'
-            shutil.make_archive(path, 'gztar', root_dir, base_dir)
-            if prefix:
-                shutil.move(os.path.join(root_dir, prefix), org_dir)
+        with self._timeline.span('make_archive', 'step', path=path):
+            archive_path = self._cwd.to_abs_path(path + archive.get_extension(compression))
+            if use_git:
+                if root_dir:
+                    raise ConfigurationError("archiving with root dir with git not implemented")
+                project = self.workspace._find_project_for_path(self._cwd.cwd)
+                if project is not None:
+                    self.workspace.ensure_full_history(project)
+                cmd = ['git', 'archive', '--format=tar']
+                if prefix:
+                    cmd.append('--prefix=' + prefix + '/')
+                cmd.append('HEAD')
+                try:
+                    digests = self._cmd_runner.check_call_to_archive(cmd,
+                            archive_path, compression=compression,
+                            jobs=self.env._build_jobs)
+                except CommandError as e:
+                    raise BuildError('failed to execute: ' + e.cmd)
+            else:
+                # TODO: Check that root_dir is a subdirectory of the workspace
+                # (this all does not work if it is the workspace itself).
+                root_dir = self._cwd.to_abs_path(root_dir)
+                arcname = prefix
+                if not arcname:
+                    arcname = os.path.basename(root_dir) or '.'
+                digests = self._executor.make_archive(archive_path, root_dir,
+                        arcname, compression=compression, jobs=self.env._build_jobs)
+            if digests:
+                self._archive_digests[archive_path] = digests
 
     def publish_logs(self, logs, category=None):
         """Copies provided log(s) to Jenkins.
@@ -397,26 +687,110 @@ class BuildContext(object):
         self.mark_unstable('analyzer found issues')
         shutil.move(os.path.join(html_dir, subdirs[0]), output_dir)
 
-    def process_coverage_results(self, exclude=None):
+    def process_coverage_results(self, exclude=None, changes_only=False):
         """Processes results from coverage runs.
 
         Uses gcovr to process all coverage files found in the workspace
-        (from running a build compiled with --coverage).
+        (from running a build compiled with --coverage).  gcov is run in
+        parallel, using the number of build jobs for the agent, and the
+        results for each object file are cached on the agent, so that gcov
+        only needs to be rerun for objects with changed coverage data.
+
+        In addition to the Cobertura XML, the line coverage is written into
+        :file:`logs/coverage-lines.log`, which can be merged with results
+        from other configurations using merge_coverage_results() from
+        __init__.py.
 
         Args:
             exclude (List[str]): Exclusions to pass to gcovr -e (regexs).
+            changes_only (bool): In per-patchset builds of GROMACS changes,
+                only process the object files that depend on the files
+                touched by the change, and only report those files.
+                Coverage of the changed lines is written into
+                :file:`logs/coverage-changes.log` and summarized in the
+                build status.  Other builds process everything.
         """
-        releng_dir = self.workspace.get_project_dir(Project.RELENG)
-        gromacs_dir = self.workspace.get_project_dir(Project.GROMACS)
-        output_path = self.workspace.get_path_for_logfile('coverage.xml')
-        self.chdir(self.workspace.build_dir)
-        gcovr = os.path.join(releng_dir, 'scripts', 'gcovr-3.2')
-        cmd = [gcovr, '--xml', '-r', gromacs_dir, '-o', output_path, '.',
-                '--gcov-executable=' + self.env.gcov_command]
-        if exclude:
-            for x in exclude:
-                cmd.extend(['-e', x])
-        self.run_cmd(cmd, failure_message='gcovr failed')
+        with self._timeline.span('process_coverage_results', 'step'):
+            releng_dir = self.workspace.get_project_dir(Project.RELENG)
+            gromacs_dir = self.workspace.get_project_dir(Project.GROMACS)
+            output_path = self.workspace.get_path_for_logfile('coverage.xml')
+            self.chdir(self.workspace.build_dir)
+            changed_lines = None
+            if changes_only:
+                changed_lines = self._get_changed_lines(gromacs_dir)
+            gcovr = os.path.join(releng_dir, 'scripts', 'gcovr-3.2')
+            cmd = [gcovr, '--xml', '-r', gromacs_dir, '-o', output_path, '.',
+                    '--gcov-executable=' + self.env.gcov_command,
+                    '-j{0}'.format(self.env._build_jobs),
+                    '--cache-dir=' + cache.get_cache_dir(self._cache_env, 'gcov')]
+            if changed_lines is not None:
+                cmd.extend(self._get_gcovr_args_for_changes(gromacs_dir, changed_lines))
+            if exclude:
+                for x in exclude:
+                    cmd.extend(['-e', x])
+            self.run_cmd(cmd, failure_message='gcovr failed')
+            if changed_lines is None:
+                artifact_path = self.workspace.get_path_for_logfile('coverage-lines.log')
+                coverage.export_coverage_artifact(self._executor, output_path,
+                        artifact_path, gromacs_dir)
+            else:
+                file_coverage = coverage.get_changed_lines_coverage(self._executor,
+                        output_path, changed_lines)
+                report_path = self.workspace.get_path_for_logfile('coverage-changes.log')
+                summary = coverage.write_changed_lines_report(self._executor,
+                        report_path, file_coverage)
+                print(summary, file=self._cmd_runner.console)
+                self._status_reporter.add_note(summary)
+
+    def _get_changed_lines(self, source_dir):
+        """Returns the lines changed by the change being built.
+
+        Returns:
+            Dict[str, Set[int]] or None: Changed lines (see
+                coverage.parse_changed_lines()), or ``None`` if the changes
+                cannot be determined for this build.
+        """
+        if not self._is_build_of_triggering_change():
+            print('Processing coverage for all files: not a build of a single change',
+                    file=self._cmd_runner.console)
+            return None
+        cmd = ['git', 'diff', '-U0', '--no-renames', 'HEAD^', 'HEAD']
+        try:
+            diff = self._cmd_runner.check_output(cmd, cwd=source_dir)
+        except CommandError:
+            print('Processing coverage for all files: could not determine changed lines',
+                    file=self._cmd_runner.console)
+            return None
+        return coverage.parse_changed_lines(diff)
+
+    def _get_gcovr_args_for_changes(self, source_dir, changed_lines):
+        """Returns gcovr arguments that limit processing to changed files.
+
+        Only the gcov data for object files that depend on the changed files
+        is passed to gcovr (if the dependency information in the build tree
+        can be read), and only the changed files are included in the output.
+        """
+        args = []
+        try:
+            objects = testimpact.find_affected_objects(self._cmd_runner, self._executor,
+                    source_dir, self._cwd.cwd, changed_lines.keys())
+            reason = 'no dependency information in the build tree'
+        except (CommandError, IOError, OSError, ValueError) as e:
+            objects = None
+            reason = 'could not read dependencies: ' + str(e)
+        if objects is None:
+            print('Processing coverage for all objects: ' + reason, file=self._cmd_runner.console)
+        else:
+            list_path = os.path.join(self._cwd.cwd, 'coverage-datafiles.txt')
+            datafiles = []
+            for obj in objects:
+                base = os.path.splitext(obj)[0]
+                datafiles.extend([base + '.gcda\n', base + '.gcno\n'])
+            self._executor.write_file(list_path, ''.join(datafiles))
+            args.append('--datafile-list=' + list_path)
+        for path in sorted(changed_lines):
+            args.extend(['-f', re.escape(os.path.join(source_dir, path)) + '$'])
+        return args
 
     def set_version_info(self, version, regtest_md5sum):
         """Provides source version information from a build script.
@@ -441,23 +815,42 @@ class BuildContext(object):
         projects = factory.projects
         workspace = factory.workspace
         workspace._clear_workspace_dirs()
-        projects.checkout_project(factory.default_project)
-        build_script_path = workspace._resolve_build_input_file(build, '.py')
-        script = BuildScript(factory.executor, build_script_path)
-        context = factory.create_context(job_type, opts, script.settings)
-        for project in script.settings.extra_projects:
-            projects.checkout_project(project)
-        projects.print_project_info()
-        projects.check_projects()
-        out_of_source = script.settings.build_out_of_source or context.opts.out_of_source
-        workspace._init_build_dir(out_of_source)
-        if factory.default_project == Project.GROMACS:
-            gromacs_dir = workspace.get_project_dir(Project.GROMACS)
-            version = cmake.read_cmake_minimum_version(factory.executor, gromacs_dir)
-            context.env._set_cmake_minimum_version(version)
-        script.do_build(context, factory.cwd)
+        projects._set_job_type(job_type)
+        context = None
+        try:
+            projects.checkout_project(factory.default_project)
+            build_script_path = workspace._resolve_build_input_file(build, '.py')
+            script = BuildScript(factory.executor, build_script_path)
+            context = factory.create_context(job_type, opts, script.settings)
+            projects.checkout_projects(script.settings.extra_projects)
+            projects.print_project_info()
+            projects.check_projects()
+            out_of_source = script.settings.build_out_of_source or context.opts.out_of_source
+            workspace._init_build_dir(out_of_source)
+            if factory.default_project == Project.GROMACS:
+                gromacs_dir = workspace.get_project_dir(Project.GROMACS)
+                version = cmake.read_cmake_minimum_version(factory.executor, gromacs_dir)
+                context.env._set_cmake_minimum_version(version)
+            script.do_build(context, factory.cwd)
+        finally:
+            if context is not None:
+                context.env._record_peak_memory()
+            BuildContext._write_timeline(factory)
         return context
 
+    @staticmethod
+    def _write_timeline(factory):
+        """Writes the timing information of the build to logs/timeline.json."""
+        timeline = factory.timeline
+        try:
+            path = factory.workspace.get_path_for_logfile('timeline.json')
+            timeline.write_trace(factory.executor, path)
+        except (IOError, OSError) as e:
+            # Do not hide the actual build failure if we fail here.
+            print('Failed to write build timeline: ' + str(e),
+                    file=factory.executor.console)
+        timeline.print_summary(factory.executor.console)
+
     @staticmethod
     def _read_build_script_config(factory, script_name):
         projects = factory.projects
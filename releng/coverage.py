@@ -0,0 +1,316 @@
+"""
+Line coverage merged over multiple build configurations
+
+Code that is only compiled with some build options (e.g., different SIMD
+levels, GPU support, or MPI) is only covered by the coverage builds that use
+those options.  To get a combined report, each configuration exports its line
+coverage as a compact artifact, and the artifacts from all configurations are
+merged into a single Cobertura XML file.
+
+The artifact is a text file with a header line and a line with the source
+root of the configuration, followed by one line per source file::
+
+    source\t<source root>
+    <path>\t<hits on line 1>,<hits on line 2>,...
+
+where the hit count is empty for lines that do not contain code.  The files
+are sorted by directory and then by name, which is also the order of packages
+and classes in the Cobertura XML.  Any number of artifacts can thus be merged
+in a single pass, keeping only the hit counts for one file from each artifact
+(and the output for one package) in memory.
+
+Only line coverage is merged: gcovr only reports branch coverage as
+per-line summaries, which cannot be combined.
+
+For per-patchset builds, the coverage of only the lines changed by the
+change can also be reported (see parse_changed_lines() and
+write_changed_lines_report()).
+"""
+
+import array
+import heapq
+import itertools
+import re
+import time
+from xml.sax.saxutils import escape, quoteattr
+
+from common import ConfigurationError
+import utils
+
+_ARTIFACT_HEADER = 'releng-coverage 2\n'
+
+# Hit count stored for lines that do not contain code.
+_NO_CODE = -1
+
+_DIFF_FILE_RE = re.compile(r'^\+\+\+ (?:b/(.*)|/dev/null)$')
+_DIFF_HUNK_RE = re.compile(r'^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@')
+
+def export_coverage_artifact(executor, xml_path, artifact_path, source_dir):
+    """Writes line coverage from a Cobertura XML file into an artifact.
+
+    Args:
+        executor (Executor): Executor to use for file access.
+        xml_path (str): Cobertura XML file produced by gcovr.
+        artifact_path (str): Path to the artifact to write.
+        source_dir (str): Source root that the paths in the XML are
+            relative to.
+    """
+    files = []
+    classes = utils.iterparse_elements(executor.read_file(xml_path, binary=True),
+            ['packages', 'package', 'classes', 'class'])
+    for elem in classes:
+        hits = array.array('l')
+        for line in elem.iterfind('lines/line'):
+            number = int(line.get('number'))
+            if number >= len(hits):
+                hits.extend([_NO_CODE] * (number + 1 - len(hits)))
+            hits[number] = int(line.get('hits'))
+        files.append((_get_sort_key(elem.get('filename')), hits))
+    files.sort()
+    executor.write_file(artifact_path, _generate_artifact(source_dir, files))
+
+def merge_coverage_artifacts(executor, artifact_paths, output_path, source_dir=None):
+    """Merges coverage artifacts into a Cobertura XML file.
+
+    Hit counts for each line are summed over the artifacts.  The packages are
+    first written into a temporary file next to the output, since the totals
+    are only known after all the input has been processed.
+
+    Args:
+        executor (Executor): Executor to use for file access.
+        artifact_paths (List[str]): Artifacts written by
+            export_coverage_artifact().
+        output_path (str): Path to the Cobertura XML file to write.
+        source_dir (Optional[str]): Source directory to write into the XML.
+            Defaults to the source root of the first artifact.
+
+    Returns:
+        Dict: Number of files and lines, and the number of covered lines.
+
+    Raises:
+        ConfigurationError: If there are no artifacts to merge.
+    """
+    if not artifact_paths:
+        raise ConfigurationError('no coverage artifacts to merge '
+                '(did all the coverage builds fail?)')
+    if source_dir is None:
+        source_dir = _read_artifact_source(executor, artifact_paths[0])
+    readers = [_read_artifact(executor, path, index)
+            for index, path in enumerate(artifact_paths)]
+    files = _merge_files(heapq.merge(*readers))
+    totals = {'files': 0, 'lines': 0, 'coveredLines': 0}
+    packages_path = output_path + '.tmp'
+    executor.write_file(packages_path, _generate_packages(files, totals))
+    header = _get_xml_header(source_dir, totals)
+    footer = '</packages>\n</coverage>\n'
+    executor.write_file(output_path,
+            itertools.chain([header], executor.read_file(packages_path), [footer]))
+    executor.remove_path(packages_path)
+    return totals
+
+def parse_changed_lines(diff):
+    """Finds the lines that a change adds or modifies.
+
+    Args:
+        diff (str): Output from ``git diff -U0``.
+
+    Returns:
+        Dict[str, Set[int]]: Changed line numbers (in the new version) for
+            each file that has any.
+    """
+    changed = dict()
+    lines = None
+    in_header = False
+    for line in diff.splitlines():
+        if line.startswith('diff '):
+            in_header = True
+            lines = None
+            continue
+        if in_header:
+            match = _DIFF_FILE_RE.match(line)
+            if match and match.group(1):
+                lines = changed.setdefault(match.group(1), set())
+        match = _DIFF_HUNK_RE.match(line)
+        if match:
+            in_header = False
+            if lines is not None:
+                start = int(match.group(1))
+                count = 1 if match.group(2) is None else int(match.group(2))
+                lines.update(range(start, start + count))
+    return dict([(path, x) for path, x in changed.iteritems() if x])
+
+def get_changed_lines_coverage(executor, xml_path, changed_lines):
+    """Reads coverage of changed lines from a Cobertura XML file.
+
+    Args:
+        executor (Executor): Executor to use for file access.
+        xml_path (str): Cobertura XML file produced by gcovr (with paths
+            relative to the source root).
+        changed_lines (Dict[str, Set[int]]): Changed lines, as returned by
+            parse_changed_lines().
+
+    Returns:
+        List[Tuple[str, List[int], List[int]]]: Path, and covered and not
+            covered changed lines, for each file that has code on the
+            changed lines.
+    """
+    result = []
+    classes = utils.iterparse_elements(executor.read_file(xml_path, binary=True),
+            ['packages', 'package', 'classes', 'class'])
+    for elem in classes:
+        path = elem.get('filename').replace('\\', '/')
+        lines = changed_lines.get(path)
+        if not lines:
+            continue
+        covered = []
+        uncovered = []
+        for line in elem.iterfind('lines/line'):
+            number = int(line.get('number'))
+            if number in lines:
+                if int(line.get('hits')) > 0:
+                    covered.append(number)
+                else:
+                    uncovered.append(number)
+        if covered or uncovered:
+            result.append((path, sorted(covered), sorted(uncovered)))
+    return sorted(result)
+
+def write_changed_lines_report(executor, path, file_coverage):
+    """Writes a text report of coverage of changed lines.
+
+    Args:
+        executor (Executor): Executor to use for writing.
+        path (str): Path to the report to write.
+        file_coverage (List): Coverage as returned by
+            get_changed_lines_coverage().
+
+    Returns:
+        str: One-line summary of the coverage.
+    """
+    covered = sum([len(x[1]) for x in file_coverage])
+    total = covered + sum([len(x[2]) for x in file_coverage])
+    if total:
+        summary = 'Coverage of changed lines: {0} of {1} lines ({2:.1f}%)'.format(
+                covered, total, 100.0 * covered / total)
+    else:
+        summary = 'Coverage of changed lines: no code on the changed lines'
+    lines = [summary + '\n']
+    for filename, file_covered, file_uncovered in file_coverage:
+        lines.append('\n{0}: {1} of {2} lines covered\n'.format(filename,
+            len(file_covered), len(file_covered) + len(file_uncovered)))
+        if file_uncovered:
+            lines.append('  not covered: {0}\n'.format(_format_line_ranges(file_uncovered)))
+    executor.write_file(path, ''.join(lines))
+    return summary
+
+def _format_line_ranges(lines):
+    ranges = []
+    for line in lines:
+        if ranges and ranges[-1][1] == line - 1:
+            ranges[-1][1] = line
+        else:
+            ranges.append([line, line])
+    return ', '.join([str(first) if first == last else '{0}-{1}'.format(first, last)
+        for first, last in ranges])
+
+def _get_sort_key(path):
+    path = path.replace('\\', '/')
+    dirname, sep, basename = path.rpartition('/')
+    return dirname, basename
+
+def _get_path(key):
+    dirname, basename = key
+    if not dirname:
+        return basename
+    return dirname + '/' + basename
+
+def _generate_artifact(source_dir, files):
+    yield _ARTIFACT_HEADER
+    yield 'source\t{0}\n'.format(source_dir)
+    for key, hits in files:
+        values = ['' if x == _NO_CODE else str(x) for x in hits[1:]]
+        yield '{0}\t{1}\n'.format(_get_path(key), ','.join(values))
+
+def _read_artifact(executor, path, index):
+    """Yields (sort key, index, hit counts) for each file in an artifact.
+
+    The index makes the tuples from different artifacts unique, so that
+    heapq.merge() never compares the hit counts.
+    """
+    lines = iter(executor.read_file(path))
+    _read_artifact_header(path, lines)
+    for line in lines:
+        filename, values = line.rstrip('\n').split('\t')
+        hits = array.array('l', [_NO_CODE])
+        hits.extend([int(x) if x else _NO_CODE for x in values.split(',')])
+        yield _get_sort_key(filename), index, hits
+
+def _read_artifact_header(path, lines):
+    """Reads the header lines of an artifact and returns the source root."""
+    if next(lines, None) != _ARTIFACT_HEADER:
+        raise ConfigurationError(path + ': not a coverage artifact')
+    name, sep, source_dir = next(lines, '').rstrip('\n').partition('\t')
+    if name != 'source':
+        raise ConfigurationError(path + ': not a coverage artifact')
+    return source_dir
+
+def _read_artifact_source(executor, path):
+    return _read_artifact_header(path, iter(executor.read_file(path)))
+
+def _merge_files(entries):
+    for key, group in itertools.groupby(entries, lambda x: x[0]):
+        hits = None
+        for key, index, file_hits in group:
+            if hits is None:
+                hits = file_hits
+            else:
+                hits = _add_hits(hits, file_hits)
+        yield key, hits
+
+def _add_hits(hits, other):
+    if len(other) > len(hits):
+        hits, other = other, hits
+    for line, count in enumerate(other):
+        if count != _NO_CODE:
+            hits[line] = max(hits[line], 0) + count
+    return hits
+
+def _get_rate(covered, lines):
+    return str(covered / (1.0 * lines or 1.0))
+
+def _generate_packages(files, totals):
+    for dirname, group in itertools.groupby(files, lambda x: x[0][0]):
+        classes = []
+        package_lines = 0
+        package_covered = 0
+        for key, hits in group:
+            lines = [(number, count) for number, count in enumerate(hits) if count != _NO_CODE]
+            covered = len([x for x in lines if x[1] > 0])
+            classes.append(_format_class(key, lines, covered))
+            package_lines += len(lines)
+            package_covered += covered
+            totals['files'] += 1
+        totals['lines'] += package_lines
+        totals['coveredLines'] += package_covered
+        yield '<package name={0} line-rate="{1}" branch-rate="0.0" complexity="0.0">\n<classes>\n'.format(
+                quoteattr(dirname.replace('/', '.')), _get_rate(package_covered, package_lines))
+        for text in classes:
+            yield text
+        yield '</classes>\n</package>\n'
+
+def _format_class(key, lines, covered):
+    dirname, basename = key
+    lines_xml = ''.join(['<line number="{0}" hits="{1}" branch="false"/>'.format(number, count)
+        for number, count in lines])
+    return '<class name={0} filename={1} line-rate="{2}" branch-rate="0.0" complexity="0.0">' \
+            '<methods/><lines>{3}</lines></class>\n'.format(
+                    quoteattr(basename.replace('.', '_')), quoteattr(_get_path(key)),
+                    _get_rate(covered, len(lines)), lines_xml)
+
+def _get_xml_header(source_dir, totals):
+    return ('<?xml version="1.0" ?>\n'
+            "<!DOCTYPE coverage SYSTEM 'http://cobertura.sourceforge.net/xml/coverage-03.dtd'>\n"
+            '<coverage line-rate="{0}" branch-rate="0.0" timestamp="{1}" version="releng">\n'
+            '<sources>\n<source>{2}</source>\n</sources>\n<packages>\n').format(
+                    _get_rate(totals['coveredLines'], totals['lines']),
+                    int(time.time()), escape(source_dir))
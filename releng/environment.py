@@ -4,14 +4,18 @@ Build and Jenkins environment handling
 This file contains all the code that hardcodes details about the Jenkins build
 agent environment, such as paths to various executables.
 """
+from __future__ import print_function
 
 import os
+import sqlite3
 
 from common import ConfigurationError
 from common import Compiler,System
 import cmake
+import cache
 import agents
 import re
+import resources
 
 # TODO: Check that the paths returned/used actually exists and raise nice
 # errors instead of mysteriously breaking builds if the node configuration is
@@ -20,6 +24,9 @@ import re
 # different approaches may be used (some might set an environment variable,
 # others use an absolute path, or set a CMake option).
 
+# Maximum size of the compiler cache for each toolchain on an agent.
+_CCACHE_MAX_SIZE = '5G'
+
 def _to_version_tuple(version_string):
     return [int(x) for x in version_string.split('.')]
 
@@ -64,6 +71,9 @@ class BuildEnvironment(object):
            (for using as AMDAPPSDKROOT environment variable).
        extra_cmake_options (Dict[str, str]): Additional options to pass to
            CMake.
+       ccache_command (str or None): Name of the ccache executable, if
+           compilation is done through ccache.
+       ccache_dir (str or None): Cache directory used by ccache.
     """
 
     def __init__(self, factory):
@@ -88,14 +98,24 @@ class BuildEnvironment(object):
         self.libcxx_version = None
         self.extra_cmake_options = dict()
         self.gcc_exe = None
+        self.ccache_command = None
+        self.ccache_dir = None
 
         self._build_prefix_cmd = None
         self._cmd_runner = factory.cmd_runner
         self._workspace = factory.workspace
         self._node_name = factory.jenkins.node_name
         self._cmake_base_dir = None
+        self._cache_env = factory.env
+        self._use_ccache = False
 
-        self._build_jobs = agents.get_default_build_parallelism(self._node_name)
+        self._executor = factory.executor
+        self._build_jobs = None
+        self._link_jobs = None
+        self._sanitizers = []
+        self._config_string = None
+        self._memory_usage = None
+        self._build_peak_memory = None
 
         environment_command = agents.get_environment_subshell(self._node_name)
         if environment_command:
@@ -135,9 +155,16 @@ class BuildEnvironment(object):
         jobs = self._build_jobs if parallel else 1
         cmd.extend(['--', '-j{0}'.format(jobs)])
         if keep_going:
-            cmd.append('-k')
+            if self._is_ninja_build():
+                # Ninja takes the number of failures to tolerate, 0 is infinite.
+                cmd.extend(['-k', '0'])
+            else:
+                cmd.append('-k')
         return cmd
 
+    def _is_ninja_build(self):
+        return self.cmake_generator == 'Ninja'
+
     def _set_cmake_minimum_version(self, version):
         if self.cmake_version or not version:
             return
@@ -475,6 +502,16 @@ class BuildEnvironment(object):
     def _init_mpi(self):
         pass
 
+    def _init_ninja(self):
+        if self._cmd_runner.find_executable('ninja') is None:
+            raise ConfigurationError('ninja is not installed on the build host')
+        self.cmake_generator = 'Ninja'
+
+    def _init_ccache(self):
+        # The actual setup is done in _init_compiler_cache(), since it
+        # depends on the compiler selected by other options.
+        self._use_ccache = True
+
     def _manage_stdlib(self, use_stdlib_through_env_vars):
         """Coordinates the C++ standard library to use in the build
 
@@ -543,3 +580,133 @@ class BuildEnvironment(object):
         if use_stdlib_through_env_vars is None:
             use_stdlib_through_env_vars = True
         self._manage_stdlib(use_stdlib_through_env_vars)
+        self._init_build_jobs()
+        if self._use_ccache:
+            self._init_compiler_cache()
+
+    def _init_build_jobs(self):
+        """Chooses the build parallelism, unless set with build-jobs=
+
+        The default is computed from the resources currently available on
+        the agent and the estimated memory use of the jobs (see
+        resources.py).  If there is not enough memory to run all the jobs as
+        link jobs, link jobs are limited separately through CMake job pools
+        (see _get_job_pool_options()).  The chosen values are printed
+        together with the reasons, to make it possible to understand the
+        build times.
+        """
+        console = self._cmd_runner.console
+        if self._build_jobs is not None:
+            print('Building with -j{0} (from build-jobs=)'.format(self._build_jobs), file=console)
+            return
+        host_resources = self._executor.get_host_resources()
+        executors = agents.get_executor_count(self._node_name)
+        compile_memory, link_memory = resources.estimate_job_memory(
+                self._get_toolchains(), self._get_recorded_peak_memory())
+        jobs, reasons = host_resources.choose_build_jobs(executors, compile_memory)
+        if jobs is None:
+            jobs = agents.get_default_build_parallelism(self._node_name)
+            reasons.append('using the agent default')
+        self._build_jobs = jobs
+        print('Building with -j{0} ({1})'.format(jobs, ', '.join(reasons)), file=console)
+        link_jobs = host_resources.choose_link_jobs(jobs, compile_memory, link_memory)
+        if link_jobs < jobs:
+            self._link_jobs = link_jobs
+            print('Limiting link jobs to {0} ({1:.1f} GiB estimated per link job)'.format(
+                link_jobs, link_memory / 1024.0 ** 3), file=console)
+
+    def _get_job_pool_options(self):
+        """Returns CMake options that limit the number of parallel link jobs.
+
+        Job pools only have an effect with the Ninja generator, and
+        CMAKE_JOB_POOLS requires CMake 3.11.  This is called when running
+        CMake, since the CMake version is only final at that point.
+        """
+        if self._link_jobs is None or not self._is_ninja_build():
+            return dict()
+        if self.cmake_version is None:
+            self.cmake_version = cmake.get_cmake_version(self._cmd_runner, self.cmake_command)
+        if _is_older_version(self.cmake_version, '3.11'):
+            print('Not limiting link jobs: job pools require CMake 3.11',
+                    file=self._cmd_runner.console)
+            return dict()
+        return {
+                'CMAKE_JOB_POOLS': 'compile={0};link={1}'.format(self._build_jobs, self._link_jobs),
+                'CMAKE_JOB_POOL_COMPILE': 'compile',
+                'CMAKE_JOB_POOL_LINK': 'link'
+            }
+
+    def _get_toolchains(self):
+        """Returns the toolchains for estimating memory use (see resources.py)."""
+        toolchains = []
+        if self.compiler is not None:
+            toolchains.append(str(self.compiler))
+        if self.cuda_root is not None:
+            toolchains.append('cuda')
+        toolchains.extend(self._sanitizers)
+        return toolchains
+
+    def _get_memory_usage_store(self):
+        if self._memory_usage is None:
+            path = os.path.join(cache.get_cache_dir(self._cache_env, 'build'), 'memory.sqlite')
+            self._executor.ensure_dir_exists(os.path.dirname(path))
+            self._memory_usage = resources.MemoryUsageStore(self._executor.connect_database(path))
+        return self._memory_usage
+
+    def _get_recorded_peak_memory(self):
+        if self._config_string is None:
+            return None
+        try:
+            return self._get_memory_usage_store().get_peak(self._config_string)
+        except sqlite3.Error as e:
+            print('Could not read earlier memory use: ' + str(e), file=self._cmd_runner.console)
+            return None
+
+    def _add_build_peak_memory(self, peak):
+        """Notes the peak memory use of a build command (or ``None``)."""
+        if peak and (self._build_peak_memory is None or peak > self._build_peak_memory):
+            self._build_peak_memory = peak
+
+    def _record_peak_memory(self):
+        """Stores the peak memory use of the build for later builds."""
+        peak = self._build_peak_memory
+        if self._config_string is None or not peak:
+            return
+        try:
+            self._get_memory_usage_store().record(self._config_string, peak)
+        except sqlite3.Error as e:
+            print('Could not record memory use: ' + str(e), file=self._cmd_runner.console)
+
+    def _init_compiler_cache(self):
+        """Sets up compilation through ccache
+
+        The compilers are wrapped using CMAKE_<LANG>_COMPILER_LAUNCHER,
+        and the cache is shared between all builds on the agent that use
+        the same toolchain.  Separate cache directories are used for
+        different toolchains so that the size limit of one does not evict
+        results for another.
+        """
+        console = self._cmd_runner.console
+        if self.system == System.WINDOWS or self.compiler == Compiler.MSVC:
+            print('ccache does not support MSVC; building without it', file=console)
+            return
+        if self.clang_analyzer_output_dir is not None:
+            # scan-build only analyzes files that are actually compiled, so
+            # cache hits would silently skip the analysis.
+            print('ccache is not used with the clang static analyzer', file=console)
+            return
+        if self._cmd_runner.find_executable('ccache') is None:
+            print('ccache is not installed; building without it', file=console)
+            return
+        toolchain = 'default'
+        if self.compiler is not None:
+            toolchain = '{0}-{1}'.format(self.compiler, self.compiler_version)
+        self.ccache_command = 'ccache'
+        self.ccache_dir = os.path.join(cache.get_cache_dir(self._cache_env, 'ccache'), toolchain)
+        self.set_env_var('CCACHE_DIR', self.ccache_dir)
+        self.set_env_var('CCACHE_MAXSIZE', _CCACHE_MAX_SIZE)
+        # Make hits possible between different workspaces on the same agent.
+        self.set_env_var('CCACHE_BASEDIR', self._workspace.root)
+        self.set_env_var('CCACHE_NOHASHDIR', '1')
+        self.extra_cmake_options['CMAKE_C_COMPILER_LAUNCHER'] = self.ccache_command
+        self.extra_cmake_options['CMAKE_CXX_COMPILER_LAUNCHER'] = self.ccache_command
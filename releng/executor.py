@@ -13,17 +13,53 @@ expanding unit tests.
 """
 from __future__ import print_function
 
+import collections
+import contextlib
 from distutils.spawn import find_executable
+import json
 import os
 import pipes
+import Queue
 import re
 import shutil
+import sqlite3
+from StringIO import StringIO
 import subprocess
 import sys
-
-from common import AbortError, CommandError, System
+import tempfile
+import threading
+import time
+
+from common import AbortError, CommandError, ConfigurationError, System
+import agents
+import archive
+import cache
+import resources
 import utils
 
+# Number of trailing output lines kept in memory from streamed commands.
+_OUTPUT_TAIL_LINES = 100
+
+# Upper limit for the length of a single line read from a streamed command.
+_MAX_STREAM_LINE_LENGTH = 65536
+
+# Environment variables that differ between builds, but do not influence the
+# environment produced by toolchain setup scripts.  These are ignored when
+# checking whether a cached environment capture can be reused, and are never
+# imported from the cache.
+_VOLATILE_ENV_VARS_RE = re.compile(r'^(BUILD_\w*|JOB_\w*|GERRIT_\w*|JENKINS_\w*|HUDSON_\w*|RUN_\w*'
+        r'|NODE_\w*|CHECKOUT_\w*|\w+_REFSPEC|\w+_HASH|EXECUTOR_NUMBER|WORKSPACE'
+        r'|STATUS_FILE|PWD|OLDPWD|SHLVL|_)$')
+
+# Maximum age of a cached environment capture, in seconds.  The cache key
+# only covers the files that can be resolved from the command, so entries are
+# also recaptured periodically to pick up changes in files that they source
+# in turn.
+_ENV_CACHE_MAX_AGE = 24 * 60 * 60
+
+# Directory where Software Collections are registered (see _get_env_stamp_paths()).
+_SCL_PREFIXES_DIR = '/etc/scl/prefixes'
+
 def _read_file(path, binary):
     if binary:
         with open(path, 'rb') as fp:
@@ -39,6 +75,7 @@ class Executor(object):
 
     def __init__(self, factory):
         self._cwd = factory.cwd
+        self._last_peak_memory = None
 
     @property
     def console(self):
@@ -48,14 +85,114 @@ class Executor(object):
         sys.exit(exitcode)
 
     def call(self, cmd, **kwargs):
-        return subprocess.call(cmd, **kwargs)
+        process = subprocess.Popen(cmd, **kwargs)
+        returncode, self._last_peak_memory = resources.wait_for_process(process)
+        return returncode
 
     def check_call(self, cmd, **kwargs):
-        subprocess.check_call(cmd, **kwargs)
+        returncode = self.call(cmd, **kwargs)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
 
     def check_output(self, cmd, **kwargs):
         return subprocess.check_output(cmd, **kwargs)
 
+    def call_with_output(self, cmd, **kwargs):
+        """Runs a command and returns its exit code and combined output."""
+        if os.name != 'nt':
+            # Avoid leaking pipes of concurrently running commands to each
+            # other, which would delay end-of-output detection.
+            kwargs['close_fds'] = True
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, **kwargs)
+        output = process.communicate()[0]
+        return process.returncode, output
+
+    def spawn_detached(self, cmd, **kwargs):
+        """Starts a command in the background without waiting for it.
+
+        The command is detached from the build: it does not inherit the
+        console, and it is marked so that Jenkins does not kill it when the
+        build finishes.
+        """
+        env = dict(kwargs.pop('env', os.environ))
+        env['BUILD_ID'] = 'dontKillMe'
+        env['JENKINS_NODE_COOKIE'] = 'dontKillMe'
+        if os.name != 'nt':
+            kwargs['close_fds'] = True
+            kwargs['preexec_fn'] = os.setsid
+        with open(os.devnull, 'r+b') as devnull:
+            subprocess.Popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull,
+                    env=env, **kwargs)
+
+    def call_streaming(self, cmd, log_path=None, echo=True, **kwargs):
+        """Runs a command, streaming its output as it is produced.
+
+        The combined stdout/stderr of the command is read incrementally and
+        written to the console (if echo is set) and to log_path (if given).
+        Only the last lines of the output are kept in memory.
+
+        Returns:
+            Tuple[int, List[str]]: Exit code and the last lines of output.
+        """
+        tail = collections.deque(maxlen=_OUTPUT_TAIL_LINES)
+        log_fp = None
+        if log_path:
+            log_fp = open(self._cwd.to_abs_path(log_path), 'wb')
+        try:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT, **kwargs)
+            for line in iter(lambda: process.stdout.readline(_MAX_STREAM_LINE_LENGTH), b''):
+                if echo:
+                    self.console.write(line)
+                    self.console.flush()
+                if log_fp:
+                    log_fp.write(line)
+                tail.append(line.rstrip('\r\n'))
+            returncode = process.wait()
+        finally:
+            if log_fp:
+                log_fp.close()
+        return returncode, list(tail)
+
+    def make_archive(self, path, root_dir, arcname, compression='gz', jobs=None):
+        """Writes a compressed tar archive of a directory tree.
+
+        jobs is the number of compression threads (see archive.ArchiveWriter).
+
+        Returns:
+            Dict[str,str]: Checksums of the archive (see archive.ArchiveWriter).
+        """
+        path = self._cwd.to_abs_path(path)
+        root_dir = self._cwd.to_abs_path(root_dir)
+        with archive.ArchiveWriter(path, compression, jobs=jobs) as writer:
+            archive.write_tree(writer, root_dir, arcname)
+        return writer.digests
+
+    def call_to_archive(self, cmd, path, compression='gz', jobs=None, **kwargs):
+        """Runs a command that writes a tar stream, and compresses it into a file.
+
+        jobs is the number of compression threads (see archive.ArchiveWriter).
+
+        Returns:
+            Tuple[int, Dict[str,str]]: Exit code of the command and checksums
+                of the archive (``None`` if the command failed, in which case
+                no archive is written).
+        """
+        path = self._cwd.to_abs_path(path)
+        with archive.ArchiveWriter(path, compression, jobs=jobs) as writer:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, **kwargs)
+            try:
+                archive.copy_stream(process.stdout, writer)
+            except:
+                process.kill()
+                process.wait()
+                raise
+            returncode = process.wait()
+            if returncode != 0:
+                writer.abort()
+        return returncode, writer.digests
+
     def remove_path(self, path):
         """Deletes a file or a directory at a given path if it exists."""
         path = self._cwd.to_abs_path(path)
@@ -80,23 +217,74 @@ class Executor(object):
         if os.path.isfile(source):
             shutil.copy(source, dest)
 
+    def copy_tree(self, source, dest):
+        """Copies a directory tree.
+
+        Copy-on-write reflinks are used where the file system supports them,
+        so that the copy does not take additional space or time, and a
+        regular copy otherwise.  The copy never shares data with the source
+        that could be modified in place.
+        """
+        source = self._cwd.to_abs_path(source)
+        dest = self._cwd.to_abs_path(dest)
+        if sys.platform.startswith('linux'):
+            with open(os.devnull, 'wb') as devnull:
+                returncode = subprocess.call(['cp', '-a', '--reflink=always', source, dest],
+                        stdout=devnull, stderr=devnull)
+            if returncode == 0:
+                return
+            self.remove_path(dest)
+        shutil.copytree(source, dest, symlinks=True)
+
     def read_file(self, path, binary=False):
         """Iterates over lines in a file."""
         path = self._cwd.to_abs_path(path)
         return _read_file(path, binary)
 
     def write_file(self, path, contents):
-        """Writes a file with the given contents."""
+        """Writes a file with the given contents.
+
+        The contents can be either a string or an iterable of strings, which
+        allows writing large files without constructing them in memory.
+        """
         path = self._cwd.to_abs_path(path)
         with open(path, 'w') as fp:
-            fp.write(contents)
+            if isinstance(contents, basestring):
+                fp.write(contents)
+            else:
+                for chunk in contents:
+                    fp.write(chunk)
+
+    def connect_database(self, path):
+        """Opens an SQLite database, creating it if it does not exist."""
+        path = self._cwd.to_abs_path(path)
+        return sqlite3.connect(path, timeout=60)
+
+    def lock_file(self, path):
+        """Returns a context manager that holds an exclusive lock on a file."""
+        return cache.FileLock(self._cwd.to_abs_path(path))
 
     def find_executable_with_path(self, name, environment_path):
         """Returns the full path to the given executable,
-        including resolving symlinks."""
+        including resolving symlinks, or None if it is not found."""
         # If we at some point require Python 3.3, shutil.which() would be
         # more obvious.
-        return os.path.realpath(find_executable(name, environment_path))
+        path = find_executable(name, environment_path)
+        if path is None:
+            return None
+        return os.path.realpath(path)
+
+    def get_host_resources(self):
+        """Returns the resources available on the build host (see resources.py)."""
+        return resources.probe_host_resources()
+
+    def get_last_command_peak_memory(self):
+        """Returns the peak memory use of the last command run with call().
+
+        Also covers check_call().  The value is in bytes, or ``None`` if not
+        known (see resources.wait_for_process()).
+        """
+        return self._last_peak_memory
 
 class DryRunExecutor(object):
     """Executor replacement for manual testing dry runs."""
@@ -120,6 +308,25 @@ class DryRunExecutor(object):
     def check_output(self, cmd, **kwargs):
         return subprocess.check_output(cmd, **kwargs)
 
+    def call_with_output(self, cmd, **kwargs):
+        return 0, ''
+
+    def spawn_detached(self, cmd, **kwargs):
+        print('spawn: ' + ' '.join(cmd))
+
+    def call_streaming(self, cmd, log_path=None, echo=True, **kwargs):
+        if log_path:
+            print('log: ' + log_path)
+        return 0, []
+
+    def make_archive(self, path, root_dir, arcname, compression='gz', jobs=None):
+        print('archive {0} -> {1}'.format(root_dir, path))
+        return dict()
+
+    def call_to_archive(self, cmd, path, compression='gz', jobs=None, **kwargs):
+        print('archive: ' + path)
+        return 0, dict()
+
     def remove_path(self, path):
         print('delete: ' + path)
 
@@ -131,18 +338,44 @@ class DryRunExecutor(object):
         if os.path.isfile(source):
             shutil.copy(source, dest)
 
+    def copy_tree(self, source, dest):
+        print('copy {0} -> {1}'.format(source, dest))
+
     def read_file(self, path, binary=False):
         path = self._cwd.to_abs_path(path)
         return _read_file(path, binary)
 
     def write_file(self, path, contents):
+        if not isinstance(contents, basestring):
+            contents = ''.join(contents)
         print('write: ' + path + ' <<<')
         print(contents + '<<<')
 
+    def connect_database(self, path):
+        print('database: ' + path)
+        return sqlite3.connect(':memory:')
+
+    def lock_file(self, path):
+        print('lock: ' + path)
+        return _NullContext()
+
     def find_executable_with_path(self, name, environment_path):
         print('find: ' + name)
         return '/usr/local/bin/' + name
 
+    def get_host_resources(self):
+        return resources.probe_host_resources()
+
+    def get_last_command_peak_memory(self):
+        return None
+
+class _NullContext(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
 class CurrentDirectoryTracker(object):
     """Helper class for tracking the current directory for command execution."""
 
@@ -166,6 +399,77 @@ class CurrentDirectoryTracker(object):
     def popd(self):
         self.chdir(self._dirstack.pop())
 
+class CommandJob(object):
+    """A command submitted for concurrent execution with CommandRunner.submit().
+
+    Attributes:
+        label (str): Prefix used for the console output of the command.
+        cmd_string (str): The command as a properly escaped string.
+        returncode (int or None): Exit code of the command (``None`` until
+            the command has finished).
+        output (str or None): Combined stdout/stderr of the command.
+    """
+
+    def __init__(self, label, cmd, cmd_string, kwargs):
+        self.label = label
+        self.cmd_string = cmd_string
+        self.returncode = None
+        self.output = None
+        self._cmd = cmd
+        self._kwargs = kwargs
+        self._done = threading.Event()
+
+    @property
+    def failed(self):
+        return self.returncode != 0
+
+    def wait(self):
+        """Waits for the command to finish."""
+        self._done.wait()
+
+class _CommandPool(object):
+    """Bounds the number of concurrently executing commands.
+
+    Submitted commands are queued, and executed by at most max_jobs worker
+    threads.  Workers are started as needed, and run until close() is called.
+    """
+
+    def __init__(self, max_jobs):
+        if max_jobs < 1:
+            raise ConfigurationError('invalid number of parallel jobs: {0}'.format(max_jobs))
+        self.max_jobs = max_jobs
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = 0
+
+    def start(self, job, func):
+        self._queue.put((job, func))
+        with self._lock:
+            if self._workers >= self.max_jobs:
+                return
+            self._workers += 1
+        thread = threading.Thread(target=self._work, name='releng-pool')
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        """Stops the worker threads once all queued commands have finished."""
+        with self._lock:
+            for dummy in range(self._workers):
+                self._queue.put(None)
+            self._workers = 0
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            job, func = item
+            try:
+                func(job)
+            finally:
+                job._done.set()
+
 class CommandRunner(object):
 
     def __init__(self, factory):
@@ -176,6 +480,42 @@ class CommandRunner(object):
             self._shell_call_opts['executable'] = '/bin/bash'
         self._is_windows = factory.system and factory.system == System.WINDOWS
         self._executor = factory.executor
+        self._timeline = factory.timeline
+        self._node_name = factory.env.get('NODE_NAME', None)
+        self._pool = None
+        self._job_count = 0
+        self._console_lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def console(self):
+        """Stream for console output from commands run in the current thread.
+
+        This is the executor console, unless buffered_output() is active.
+        """
+        console = getattr(self._local, 'console', None)
+        if console is None:
+            console = self._executor.console
+        return console
+
+    @contextlib.contextmanager
+    def buffered_output(self):
+        """Buffers console output of commands run in the current thread.
+
+        Used as a context manager.  Within the with block, the output of
+        commands run from the current thread with call() or check_call() is
+        captured together with the "+ cmd" lines and other messages into the
+        returned StringIO instead of being written to the console.  The same
+        applies to stderr of commands run with check_output().  This
+        allows running commands from multiple threads, printing their output
+        afterwards in a deterministic order.
+        """
+        buf = StringIO()
+        self._local.console = buf
+        try:
+            yield buf
+        finally:
+            self._local.console = None
 
     def set_env_var(self, variable, value):
         if value is not None:
@@ -210,15 +550,111 @@ class CommandRunner(object):
         cmake -E environment.  Normally used to capture and import the
         environment resulting from sourcing a script that sets up the
         environment to use a particular build toolchain.
+
+        The changes to the environment are cached on disk, keyed on
+        env_dump_cmd, the current environment and the modification times of
+        files referenced in env_dump_cmd (such as the sourced scripts, and
+        the files of Software Collections and environment modules that it
+        loads), so that later builds on the same agent can skip running the
+        command.  Cached entries expire after _ENV_CACHE_MAX_AGE.
         """
+        cache_path = self._get_env_cache_path(env_dump_cmd)
+        cached = self._read_env_cache(cache_path)
+        if cached is not None:
+            print('+ {0} (cached)'.format(env_dump_cmd), file=self.console)
+            delta, messages = cached['env'], cached['messages']
+        else:
+            delta, messages = self._capture_env(env_dump_cmd)
+            self._write_env_cache(cache_path,
+                    { 'env': delta, 'messages': messages, 'time': time.time() })
+        for line in messages:
+            print(line, file=self.console)
+        self._env.update(delta)
+
+    def _capture_env(self, env_dump_cmd):
+        """Runs env_dump_cmd and returns the changes it makes to the environment."""
+        delta = dict()
+        messages = []
         new_env = self.check_output(env_dump_cmd, shell=True)
         if new_env:
             for line in new_env.splitlines():
                 if re.match(r'\w+=', line):
                     variable, value = line.strip().split('=', 1)
-                    self._env[variable] = value
+                    if self._env.get(variable, None) != value \
+                            and not _VOLATILE_ENV_VARS_RE.match(variable):
+                        delta[variable] = value
                 else:
-                    print(line, file=self._executor.console)
+                    messages.append(line)
+        return delta, messages
+
+    def _get_env_cache_path(self, env_dump_cmd):
+        input_env = sorted([(key, value) for key, value in self._env.iteritems()
+            if not _VOLATILE_ENV_VARS_RE.match(key)])
+        # The scripts that are sourced typically appear as plain or quoted
+        # paths in the command; the stamps of those that exist as files are
+        # included so that toolchain updates invalidate the cache.
+        tokens = re.findall(r'"([^"]+)"|(\S+)', env_dump_cmd)
+        paths = [quoted or plain for quoted, plain in tokens]
+        paths = [x for x in paths if os.path.isabs(x)]
+        paths.extend(self._get_env_stamp_paths(env_dump_cmd))
+        stamps = []
+        for path in paths:
+            if os.path.exists(path):
+                stamps.append([path, cache.get_file_stamp(path)])
+        key = cache.compute_key(env_dump_cmd, input_env, stamps)
+        return os.path.join(cache.get_cache_dir(self._env, 'env'), key + '.json')
+
+    def _get_env_stamp_paths(self, env_dump_cmd):
+        """Returns files loaded indirectly by env_dump_cmd.
+
+        The environment set up by ``scl enable`` and ``module load`` comes
+        from files that do not appear in the command itself: the enable
+        scripts of the collections (found through their registration in
+        _SCL_PREFIXES_DIR), and the modulefiles found in MODULEPATH.  For a
+        module directory (with one modulefile per version), the directory is
+        returned, since its modification time changes when versions are
+        added or removed.
+        """
+        paths = []
+        match = re.search(r'\bscl\s+enable\s+(.*?)(\s--\s|$)', env_dump_cmd)
+        if match:
+            for collection in match.group(1).split():
+                prefix_path = os.path.join(_SCL_PREFIXES_DIR, collection)
+                paths.append(prefix_path)
+                try:
+                    with open(prefix_path, 'r') as fp:
+                        prefix = fp.read().strip()
+                except (IOError, OSError):
+                    continue
+                paths.append(os.path.join(prefix, collection, 'enable'))
+        module_dirs = self._env.get('MODULEPATH', '').split(os.pathsep)
+        for match in re.finditer(r'\bmodule\s+load\s+([^&;|]*)', env_dump_cmd):
+            for name in match.group(1).split():
+                for module_dir in module_dirs:
+                    if not module_dir:
+                        continue
+                    path = os.path.join(module_dir, name)
+                    if os.path.exists(path):
+                        paths.append(path)
+                        break
+        return paths
+
+    def _read_env_cache(self, path):
+        try:
+            contents = json.loads(''.join(self._executor.read_file(path)))
+        except (IOError, OSError, ValueError):
+            return None
+        if time.time() - contents.get('time', 0) > _ENV_CACHE_MAX_AGE:
+            return None
+        return contents
+
+    def _write_env_cache(self, path, contents):
+        try:
+            self._executor.ensure_dir_exists(os.path.dirname(path))
+            self._executor.write_file(path, json.dumps(contents))
+        except (IOError, OSError):
+            # Failing to update the cache only makes later builds slower.
+            pass
 
     def call(self, cmd, **kwargs):
         """Runs a command via subprocess.call()
@@ -231,7 +667,12 @@ class CommandRunner(object):
         passed, e.g. cwd or env to make such calls in stateless ways.
         """
         cmd_string, kwargs = self._prepare_cmd(cmd, kwargs)
-        returncode = self._executor.call(cmd, **kwargs)
+        with self._timeline.span(cmd_string) as span:
+            if self._is_buffered:
+                returncode = self._call_buffered(cmd, kwargs)
+            else:
+                returncode = self._executor.call(cmd, **kwargs)
+            span.returncode = returncode
         self._handle_return_code(returncode)
         return returncode
 
@@ -247,8 +688,16 @@ class CommandRunner(object):
         """
         cmd_string, kwargs = self._prepare_cmd(cmd, kwargs)
         try:
-            self._executor.check_call(cmd, **kwargs)
+            with self._timeline.span(cmd_string) as span:
+                if self._is_buffered:
+                    returncode = self._call_buffered(cmd, kwargs)
+                    if returncode != 0:
+                        raise subprocess.CalledProcessError(returncode, cmd)
+                else:
+                    self._executor.check_call(cmd, **kwargs)
+                span.returncode = 0
         except subprocess.CalledProcessError as e:
+            span.returncode = e.returncode
             self._handle_return_code(e.returncode)
             raise CommandError(cmd_string)
 
@@ -264,18 +713,219 @@ class CommandRunner(object):
         ways.
         """
         cmd_string, kwargs = self._prepare_cmd(cmd, kwargs)
+        if self._is_buffered and 'stderr' not in kwargs:
+            with tempfile.TemporaryFile() as stderr:
+                kwargs['stderr'] = stderr
+                try:
+                    return self._check_output(cmd, cmd_string, kwargs)
+                finally:
+                    stderr.seek(0)
+                    self.console.write(stderr.read())
+        return self._check_output(cmd, cmd_string, kwargs)
+
+    def _check_output(self, cmd, cmd_string, kwargs):
         try:
-            return self._executor.check_output(cmd, **kwargs)
+            with self._timeline.span(cmd_string) as span:
+                output = self._executor.check_output(cmd, **kwargs)
+                span.returncode = 0
+            return output
         except subprocess.CalledProcessError as e:
+            span.returncode = e.returncode
             if e.output:
-                print(e.output, file=self._executor.console)
+                print(e.output, file=self.console)
             self._handle_return_code(e.returncode)
             raise CommandError(cmd_string)
 
+    def check_call_to_archive(self, cmd, path, compression='gz', jobs=None, **kwargs):
+        """Runs a command that writes a tar stream to stdout into an archive.
+
+        The output is compressed while the command runs, without writing
+        the uncompressed stream to disk.
+
+        Args:
+            cmd (List[str]): Command to run.
+            path (str): Path to the compressed archive to write.
+            compression (Optional[str]): Compression to use (see archive.py).
+            jobs (Optional[int]): Number of threads to use for compression.
+
+        Returns:
+            Dict[str,str]: Checksums of the archive.
+
+        Raises:
+            CommandError: If the command fails.
+        """
+        cmd_string, kwargs = self._prepare_cmd(cmd, kwargs)
+        with self._timeline.span(cmd_string) as span:
+            returncode, digests = self._executor.call_to_archive(cmd, path,
+                    compression=compression, jobs=jobs, **kwargs)
+            span.returncode = returncode
+        self._handle_return_code(returncode)
+        if returncode != 0:
+            raise CommandError(cmd_string)
+        return digests
+
+    def call_streaming(self, cmd, log_path=None, echo=True, **kwargs):
+        """Runs a command, streaming its output instead of buffering it.
+
+        The output of the command is written to the console as it is
+        produced, and optionally also to a log file.  Only a bounded number of
+        the last output lines is kept in memory; if echo is not set, these are
+        printed to the console if the command fails.
+        Any arguments accepted by subprocess.call() can also be passed.
+
+        Args:
+            cmd (str/list): Command to execute.
+            log_path (Optional[str]): Path to the file to write the output to.
+            echo (Optional[bool]): Whether to write the output also to the
+                console.
+
+        Returns:
+            int: Exit code of the command.
+        """
+        cmd_string, kwargs = self._prepare_cmd(cmd, kwargs)
+        with self._timeline.span(cmd_string) as span:
+            returncode, tail = self._executor.call_streaming(cmd,
+                    log_path=log_path, echo=echo, **kwargs)
+            span.returncode = returncode
+        if returncode != 0 and not echo and tail:
+            console = self.console
+            print('Last {0} lines of output:'.format(len(tail)), file=console)
+            for line in tail:
+                print(line, file=console)
+            if log_path:
+                print('(full output in {0})'.format(log_path), file=console)
+        self._handle_return_code(returncode)
+        return returncode
+
+    def check_call_streaming(self, cmd, log_path=None, echo=True, **kwargs):
+        """Runs a command via call_streaming(), raising CommandError on failure."""
+        if self.call_streaming(cmd, log_path=log_path, echo=echo, **kwargs) != 0:
+            raise CommandError(self._cmd_to_string(cmd, kwargs.get('shell', False)))
+
+    def submit(self, cmd, label=None, pool=None, **kwargs):
+        """Starts a command to run concurrently with other submitted commands.
+
+        At most a fixed number of submitted commands execute at the same time
+        (by default, the default build parallelism of the build agent);
+        the rest wait for a free slot.  The output of the command is captured,
+        and printed to the console in one block (each line prefixed with the
+        label of the command) once the command finishes, so that the output
+        of concurrent commands does not get interleaved.
+
+        Any arguments accepted by call() can also be passed.  In particular,
+        cwd and env can be used to give each command its own working directory
+        and environment; by default, the current values at the time of the
+        call are used.  Use wait() to wait for the submitted commands.
+
+        Returns:
+            CommandJob: Object representing the started command.
+        """
+        if pool is None:
+            pool = self._get_default_pool()
+        shell = kwargs.get('shell', False)
+        cmd_string = self._cmd_to_string(cmd, shell)
+        if shell:
+            kwargs.update(self._shell_call_opts)
+        if not 'cwd' in kwargs:
+            kwargs['cwd'] = self._cwd.cwd
+        if not 'env' in kwargs:
+            kwargs['env'] = dict(self._env)
+        self._job_count += 1
+        if label is None:
+            label = str(self._job_count)
+        job = CommandJob(label, cmd, cmd_string, kwargs)
+        utils.flush_output()
+        pool.start(job, self._run_job)
+        return job
+
+    def wait(self, jobs, check=True):
+        """Waits for commands started with submit() to finish.
+
+        All the commands are always waited for, even if some of them fail.
+
+        Args:
+            jobs (List[CommandJob]): Commands to wait for.
+            check (Optional[bool]): If ``True``, raise CommandError if any of
+                the commands failed.
+
+        Raises:
+            AbortError: If any of the commands was aborted.
+            CommandError: If any of the commands failed (and check is set).
+        """
+        for job in jobs:
+            job.wait()
+        aborted = [job for job in jobs if self._is_abort_code(job.returncode)]
+        if aborted:
+            raise AbortError(aborted[0].returncode)
+        failed = [job for job in jobs if job.failed]
+        if check and failed:
+            raise CommandError('; '.join([job.cmd_string for job in failed]))
+
+    def run_many(self, cmds, max_jobs=None, check=True, **kwargs):
+        """Runs a batch of independent commands concurrently.
+
+        Convenience wrapper for running a list of commands that all use the
+        same arguments with submit() and wait().
+
+        Args:
+            cmds (List[str/list]): Commands to execute.
+            max_jobs (Optional[int]): Maximum number of commands to run at
+                the same time.  If not given, the default build parallelism
+                of the build agent is used.
+            check (Optional[bool]): Passed to wait().
+
+        Returns:
+            List[CommandJob]: The executed commands, in the order of cmds.
+        """
+        pool = None
+        if max_jobs is not None:
+            pool = _CommandPool(max_jobs)
+        try:
+            jobs = [self.submit(cmd, pool=pool, **dict(kwargs)) for cmd in cmds]
+            self.wait(jobs, check=check)
+        finally:
+            if pool is not None:
+                pool.close()
+        return jobs
+
+    def _get_default_pool(self):
+        if self._pool is None:
+            self._pool = _CommandPool(agents.get_default_build_parallelism(self._node_name))
+        return self._pool
+
+    def _run_job(self, job):
+        with self._timeline.span(job.cmd_string, label=job.label) as span:
+            try:
+                job.returncode, job.output = self._executor.call_with_output(job._cmd, **job._kwargs)
+            except OSError as e:
+                job.returncode, job.output = 127, str(e) + '\n'
+            span.returncode = job.returncode
+        prefix = '[{0}] '.format(job.label)
+        lines = ['+ ' + job.cmd_string]
+        if job.output:
+            lines.extend(job.output.splitlines())
+        if job.returncode != 0:
+            lines.append('(exited with code {0})'.format(job.returncode))
+        with self._console_lock:
+            console = self._executor.console
+            for line in lines:
+                print(prefix + line, file=console)
+            console.flush()
+
+    @property
+    def _is_buffered(self):
+        return getattr(self._local, 'console', None) is not None
+
+    def _call_buffered(self, cmd, kwargs):
+        returncode, output = self._executor.call_with_output(cmd, **kwargs)
+        if output:
+            self.console.write(output)
+        return returncode
+
     def _prepare_cmd(self, cmd, kwargs):
         shell = kwargs.get('shell', False)
         cmd_string = self._cmd_to_string(cmd, shell)
-        print('+ ' + cmd_string, file=self._executor.console)
+        print('+ ' + cmd_string, file=self.console)
         if shell:
             kwargs.update(self._shell_call_opts)
         if not 'cwd' in kwargs:
@@ -296,20 +946,22 @@ class CommandRunner(object):
 
     def _handle_return_code(self, returncode):
         if returncode != 0:
-            print('(exited with code {0})'.format(returncode), file=self._executor.console)
+            print('(exited with code {0})'.format(returncode), file=self.console)
+        if self._is_abort_code(returncode):
+            raise AbortError(returncode)
+
+    def _is_abort_code(self, returncode):
         if self._is_windows:
             # Based on testing, at least a batch script returns -1 when aborted
             # as part of a workflow.
             # Timeouts do not work in Jenkins pipelines for bat scripts...
-            if returncode == -1:
-                raise AbortError(returncode)
+            return returncode == -1
         else:
             # Aborting a job seems to send SIGTERM to the child processes in
             # pipelines, which gives an exit code of 128+15 or -15.
             # Handle SIGKILL as well for robustness.
-            if returncode in (-15, -9, 137, 143):
-                raise AbortError(returncode)
+            return returncode in (-15, -9, 137, 143)
 
     def find_executable(self, name):
-        """Returns the full path to the given executable."""
+        """Returns the full path to the given executable, or None if not found."""
         return self._executor.find_executable_with_path(name, environment_path=self._env['PATH'])
@@ -9,6 +9,7 @@ from common import Project, System
 from context import BuildContext
 from executor import CommandRunner, CurrentDirectoryTracker, Executor
 from integration import GerritIntegration, JenkinsIntegration, ProjectsManager, StatusReporter
+from timeline import Timeline
 from workspace import Workspace
 
 class ContextFactory(object):
@@ -44,6 +45,7 @@ class ContextFactory(object):
         self._jenkins = None
         self._projects = None
         self._status_reporter = None
+        self._timeline = None
         self._workspace = None
 
     @property
@@ -73,6 +75,13 @@ class ContextFactory(object):
             self._init_cmd_runner()
         return self._cmd_runner
 
+    @property
+    def timeline(self):
+        """Returns the Timeline instance that collects timing for the build."""
+        if self._timeline is None:
+            self._timeline = Timeline()
+        return self._timeline
+
     @property
     def status_reporter(self):
         """Returns the StatusReporter instance for the build."""
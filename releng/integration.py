@@ -12,11 +12,13 @@ import base64
 import json
 import os
 import re
+import sys
+import threading
 import traceback
 import urllib
 
 from common import AbortError, BuildError, ConfigurationError
-from common import Project, System
+from common import CheckoutMode, JobType, Project, System
 import utils
 
 class RefSpec(object):
@@ -297,12 +299,23 @@ class ProjectInfo(object):
             }
 
 
+# Checkout modes used for project checkouts by default for different job
+# types, if not overridden by environment variables.  Partial checkouts keep
+# all commits (so that, e.g., git describe works for version detection).
+_DEFAULT_CHECKOUT_MODES = {
+        JobType.GERRIT: CheckoutMode.PARTIAL
+    }
+
 class ProjectsManager(object):
     """Manages project refspecs and checkouts.
 
     This class is mainly responsible of managing the state related to project
     checkouts, including those checked out external to the Python code (in
     pipeline code, or in Jenkins job configuration).
+
+    The checkout mode (see CheckoutMode) for projects checked out by this class
+    can be set with ``<PROJECT>_CHECKOUT_MODE`` or ``CHECKOUT_MODE``
+    environment variables; otherwise, it is determined by the job type.
     """
 
     def __init__(self, factory):
@@ -313,6 +326,7 @@ class ProjectsManager(object):
         self._workspace = factory.workspace
         self._projects = dict()
         self._branch = None
+        self._job_type = None
         self._init_projects()
 
     def _init_projects(self):
@@ -352,8 +366,9 @@ class ProjectsManager(object):
 
         self._resolve_missing_refspecs()
 
-        for project in initial_projects:
+        def set_checked_out(project):
             self._projects[project].set_checked_out(self._workspace, self._gerrit)
+        self._for_each_concurrently(sorted(initial_projects), set_checked_out)
 
     def _parse_refspec(self, project):
         env_name = '{0}_REFSPEC'.format(project.upper())
@@ -395,6 +410,17 @@ class ProjectsManager(object):
         projects = [p.project for p in self._projects.values() if p.is_checked_out]
         self._workspace._set_initial_checkouts(projects)
 
+    def _set_job_type(self, job_type):
+        """Sets the job type, used for selecting the default checkout mode."""
+        self._job_type = job_type
+
+    def _get_checkout_mode(self, project):
+        for env_name in ('{0}_CHECKOUT_MODE'.format(project.upper()), 'CHECKOUT_MODE'):
+            value = self._env.get(env_name, None)
+            if value:
+                return CheckoutMode.parse(value)
+        return _DEFAULT_CHECKOUT_MODES.get(self._job_type, CheckoutMode.FULL)
+
     def checkout_project(self, project):
         """Checks out the given project if not yet done for this build."""
         self._verify_project(project)
@@ -402,9 +428,62 @@ class ProjectsManager(object):
         if project_info.is_checked_out:
             return
         refspec = project_info.refspec
-        self._workspace._checkout_project(project, refspec)
+        checkout_mode = self._get_checkout_mode(project)
+        self._workspace._checkout_project(project, refspec, checkout_mode)
         project_info.set_checked_out(self._workspace, self._gerrit)
 
+    def checkout_projects(self, projects):
+        """Checks out the given projects concurrently.
+
+        Checking out a project and resolving its revisions involve multiple
+        network round-trips, which are overlapped between the projects.
+        The output from each project is printed in the order of the projects
+        once all of them have finished.
+        """
+        for project in projects:
+            self._verify_project(project)
+        self._for_each_concurrently(projects, self.checkout_project)
+
+    def _for_each_concurrently(self, projects, func):
+        """Calls func for each project in a separate thread.
+
+        Console output from commands run by func is buffered and printed in
+        the order of projects.  If any of the calls raises an exception, the
+        first one (in the order of projects) is re-raised after all have
+        finished.
+        """
+        if len(projects) < 2:
+            for project in projects:
+                func(project)
+            return
+        results = dict()
+        def run(project):
+            exc_info = None
+            with self._cmd_runner.buffered_output() as output:
+                try:
+                    func(project)
+                except:
+                    exc_info = sys.exc_info()
+            results[project] = (output.getvalue(), exc_info)
+        threads = []
+        for project in projects:
+            thread = threading.Thread(target=run, args=(project,), name='releng-' + project)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        console = self._executor.console
+        first_exc_info = None
+        for project in projects:
+            output, exc_info = results[project]
+            console.write(output)
+            if exc_info and not first_exc_info:
+                first_exc_info = exc_info
+        console.flush()
+        if first_exc_info:
+            raise first_exc_info[0], first_exc_info[1], first_exc_info[2]
+
     def get_project_info(self, project, expect_checkout=True):
         self._verify_project(project, expect_checkout)
         return self._projects[project]
@@ -436,29 +515,44 @@ class ProjectsManager(object):
         In the past, there have been problems with not all projects getting
         correctly checked out.  It is unknown whether this was a Jenkins bug
         or something else, and whether the issue still exists.
+
+        Projects that were checked out without full history (see
+        CheckoutMode) are checked out again with a full fetch if they are
+        at a wrong revision.
         """
         console = self._executor.console
         all_correct = True
         for project_info in self._projects.itervalues():
             if not project_info.is_checked_out:
                 continue
+            if not project_info.has_correct_hash():
+                self._retry_with_full_checkout(project_info)
             if not project_info.has_correct_hash():
                 print('Checkout of {0} failed: HEAD is {1}, expected {2}'.format(
-                    project, project_info.head_hash, project_info.remote_hash),
+                    project_info.project, project_info.head_hash, project_info.remote_hash),
                     file=console)
                 all_correct = False
         if not all_correct:
             raise BuildError('Checkout failed (Jenkins issue)')
 
+    def _retry_with_full_checkout(self, project_info):
+        project = project_info.project
+        if project_info.is_tarball:
+            return
+        checkout_mode = self._workspace._get_checkout_info(project).checkout_mode
+        if checkout_mode is None or checkout_mode == CheckoutMode.FULL:
+            return
+        print('Checkout of {0} is at a wrong revision, retrying with full history'.format(project),
+                file=self._executor.console)
+        self._workspace._checkout_project(project, project_info.refspec, CheckoutMode.FULL)
+        project_info.set_checked_out(self._workspace, self._gerrit)
+
     def get_build_revisions(self):
-        projects = []
-        for project in Project._values:
-            if project not in self._projects:
-                continue
-            info = self._projects[project]
-            info.load_missing_info(self._workspace, self._gerrit)
-            projects.append(info)
-        return [project.to_dict() for project in projects]
+        projects = [p for p in Project._values if p in self._projects]
+        def load_missing_info(project):
+            self._projects[project].load_missing_info(self._workspace, self._gerrit)
+        self._for_each_concurrently(projects, load_missing_info)
+        return [self._projects[project].to_dict() for project in projects]
 
     def override_refspec(self, project, refspec):
         self._verify_project(project)
@@ -615,6 +709,7 @@ class StatusReporter(object):
         self.failed = False
         self._aborted = False
         self._unsuccessful_reason = []
+        self._notes = []
         self.return_value = None
         self._tracebacks = tracebacks
 
@@ -643,6 +738,7 @@ class StatusReporter(object):
                 self._report_on_exception()
                 return False
         self._report()
+        self._workspace._run_deferred_maintenance()
         # Currently, we do not propagate even the aborted return value when
         # not requested to.  This means that the parent workflow build may
         # have a chance to write a summary to the build summary page before
@@ -675,6 +771,17 @@ class StatusReporter(object):
         else:
             self._unsuccessful_reason.extend(details)
 
+    def add_note(self, note):
+        """Records information about the build that does not affect its result.
+
+        Notes are printed at the end of the build, and included in the
+        status file if it is in JSON format.
+
+        Args:
+            note (str): Text of the note.
+        """
+        self._notes.append(note)
+
     def _report_on_exception(self):
         console = self._executor.console
         try:
@@ -694,6 +801,10 @@ class StatusReporter(object):
             result = 'UNSTABLE'
         if not self._aborted and self._unsuccessful_reason:
             reason = '\n'.join(self._unsuccessful_reason)
+        if self._notes and to_console:
+            console = self._executor.console
+            for note in self._notes:
+                print('NOTE: ' + note, file=console)
         if reason and to_console:
             console = self._executor.console
             print('Build FAILED:', file=console)
@@ -708,6 +819,8 @@ class StatusReporter(object):
                 }
             if self.return_value:
                 output['return_value'] = self.return_value
+            if self._notes:
+                output['notes'] = self._notes
             contents = json.dumps(output, indent=2)
         elif reason:
             contents = reason + '\n'
@@ -70,8 +70,9 @@ def _read_matrix_configs(executor, path):
     return configs
 
 def _check_matrix_configs(configs):
+    non_matrix_hosts = set(agents.find_non_matrix_hosts([x.host for x in configs]))
     for config in configs:
-        if config.host and not agents.is_matrix_host(config.host):
+        if config.host in non_matrix_hosts:
             raise ConfigurationError('non-matrix agent would execute this combination: ' + ' '.join(config.opts))
 
 def _create_return_value(configs):
@@ -0,0 +1,109 @@
+"""
+Build time analysis from the Ninja log
+
+Ninja records the start and end time of each build step in
+:file:`.ninja_log` in the build directory.  After building a target with the
+Ninja generator, the steps from the latest build are summarized into a report
+of the slowest translation units and link steps, which helps to find the
+hotspots that limit the build time.
+"""
+
+import re
+
+# Outputs of link steps: libraries, and executables (which have no extension
+# except on Windows).  Outputs under CMakeFiles/ without an extension are
+# from custom commands.
+_LINK_OUTPUT_RE = re.compile(r'(\.(a|lib|dll|dylib|exe)|\.so(\.\d+)*|(^|/)[^./]+)$')
+_OBJECT_OUTPUT_RE = re.compile(r'\.(o|obj)$')
+
+# Number of slowest steps of each kind listed in the report.
+_REPORT_STEPS = 20
+
+class BuildStep(object):
+    """Single build step from the Ninja log.
+
+    Attributes:
+        output (str): Output file of the step (relative to the build
+            directory).
+        start (float): Start time of the step in seconds from the start of
+            the build.
+        end (float): End time of the step in seconds from the start of the
+            build.
+    """
+
+    def __init__(self, output, start, end):
+        self.output = output
+        self.start = start
+        self.end = end
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+def parse_ninja_log(lines):
+    """Reads the steps from the latest build in a Ninja log.
+
+    The log is appended to by each Ninja invocation, and the times are
+    relative to the start of each invocation.  The steps of the latest
+    invocation are identified by the end times starting over from a smaller
+    value, like in the ninjatracing tool.  Steps with multiple outputs are
+    only reported once.
+
+    Args:
+        lines (Iterable[str]): Lines from :file:`.ninja_log`, or only the
+            lines appended by a build.
+
+    Returns:
+        List[BuildStep]: Steps from the latest build, in the order they
+            finished.
+    """
+    steps = []
+    last_end = 0
+    seen = set()
+    for line in lines:
+        if line.startswith('#'):
+            continue
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) < 5:
+            continue
+        start, end, output = int(fields[0]), int(fields[1]), fields[3]
+        if end < last_end:
+            steps = []
+            seen = set()
+        last_end = end
+        key = (start, end, fields[4])
+        if key in seen:
+            continue
+        seen.add(key)
+        steps.append(BuildStep(output, start / 1000.0, end / 1000.0))
+    return steps
+
+def write_build_time_report(executor, path, target, steps):
+    """Writes a report of the slowest build steps.
+
+    Args:
+        executor (Executor): Executor to use for writing.
+        path (str): Path to the report to write.
+        target (str or None): Target that was built (for the title).
+        steps (List[BuildStep]): Steps as returned by parse_ninja_log().
+    """
+    if not steps:
+        executor.write_file(path, 'Build of {0}: nothing rebuilt\n'.format(target or 'all'))
+        return
+    compile_steps = [x for x in steps if _OBJECT_OUTPUT_RE.search(x.output)]
+    link_steps = [x for x in steps if _LINK_OUTPUT_RE.search(x.output)
+            and not _OBJECT_OUTPUT_RE.search(x.output) and 'CMakeFiles/' not in x.output]
+    wall_time = max([x.end for x in steps])
+    lines = ['Build of {0}: {1} steps in {2:.1f} s\n'.format(
+        target or 'all', len(steps), wall_time)]
+    for title, selected in (('compile', compile_steps), ('link', link_steps)):
+        lines.append('  {0}: {1} steps, {2:.1f} s in total\n'.format(title,
+            len(selected), sum([x.duration for x in selected])))
+    for title, selected in (('compile', compile_steps), ('link', link_steps)):
+        if not selected:
+            continue
+        lines.append('\nSlowest {0} steps:\n'.format(title))
+        selected = sorted(selected, key=lambda x: (-x.duration, x.output))
+        for step in selected[:_REPORT_STEPS]:
+            lines.append('{0:8.1f} s  {1}\n'.format(step.duration, step.output))
+    executor.write_file(path, ''.join(lines))
@@ -67,16 +67,26 @@ class BuildOptions(object):
         self.__dict__[to_python_identifier(name)] = value
 
     def _process_options(self, handlers, opts):
-        opts = list(opts)
-        for handler in handlers:
-            found_opts = [x for x in opts if handler.matches(x)]
+        # Each option is handled by the first handler that matches it, and
+        # the handlers are called in the order they are defined.
+        index = _OptionIndex(handlers)
+        found = dict()
+        unknown = []
+        for opt in opts:
+            matches = index.find_handlers(opt)
+            if matches:
+                found.setdefault(matches[0], []).append(opt)
+            else:
+                unknown.append(opt)
+        for order in sorted(found):
+            handler = handlers[order]
+            found_opts = found[order]
             if not handler.allow_multiple and len(found_opts) > 1:
                 raise ConfigurationError('conflicting options found: ' + ' '.join(found_opts))
             for found_opt in found_opts:
-                opts.remove(found_opt)
                 self._handle_option(handler, found_opt)
-        if opts:
-            raise ConfigurationError('unknown options: ' + ' '.join(opts))
+        if unknown:
+            raise ConfigurationError('unknown options: ' + ' '.join(unknown))
 
     def _handle_option(self, handler, opt):
         value = handler.parse(opt)
@@ -89,6 +99,22 @@ class BuildOptions(object):
     def __contains__(self, item):
         return item in self._opts
 
+    def get_config_string(self, exclude=()):
+        """Returns a canonical string that identifies the set options.
+
+        Args:
+            exclude (Optional[List[str]]): Names of options to leave out.
+        """
+        values = []
+        for name, value in sorted(self._opts.iteritems()):
+            if value is None or name in exclude:
+                continue
+            if value is True:
+                values.append(name)
+            else:
+                values.append('{0}={1}'.format(name, value))
+        return ' '.join(values)
+
 class OptionTypes(object):
     """Factories for declaring options in build scripts."""
 
@@ -126,6 +152,58 @@ class OptionTypes(object):
 # Indicates that an option requires a label of the same name as the option.
 OPT = lambda opt, value: opt
 
+# Version suffix for options like gcc-4.8 (see _VersionOptionHandler).
+_VERSION_SUFFIX_RE = re.compile(r'-\d+(?:\.\d+)*$')
+
+class _OptionIndex(object):
+    """Finds the handlers for build options without checking every handler.
+
+    The handlers are indexed by the names they declare in get_keys(), and
+    each option is only checked against the handlers registered for names
+    that can be derived from it (the full option, the part before ``=``, or
+    the part before a version suffix).  The result for each distinct option
+    string is remembered, so the index is efficient also when processing a
+    large number of configurations.
+
+    Args:
+        handlers (List[_BuildOptionHandler]): Handlers to index.
+    """
+
+    def __init__(self, handlers):
+        self._handlers = handlers
+        self._index = dict()
+        self._results = dict()
+        for order, handler in enumerate(handlers):
+            for key in handler.get_keys():
+                self._index.setdefault(key, []).append(order)
+
+    def find_handlers(self, opt):
+        """Finds the handlers that match an option.
+
+        Returns:
+            List[int]: Positions of the matching handlers in the list passed
+                to the constructor, in increasing order.
+        """
+        result = self._results.get(opt, None)
+        if result is None:
+            candidates = set()
+            for key in _get_option_keys(opt):
+                candidates.update(self._index.get(key, ()))
+            result = sorted([x for x in candidates if self._handlers[x].matches(opt)])
+            self._results[opt] = result
+        return result
+
+def _get_option_keys(opt):
+    """Returns the handler names that an option string can match."""
+    keys = [opt]
+    name = opt.split('=', 1)[0]
+    if name != opt:
+        keys.append(name)
+    match = _VERSION_SUFFIX_RE.search(opt)
+    if match:
+        keys.append(opt[:match.start()])
+    return keys
+
 class _BuildOptionHandler(object):
     """Base class for build options.
 
@@ -165,6 +243,15 @@ class _BuildOptionHandler(object):
         """Dummy handler to avoid null checks in callers."""
         pass
 
+    def get_keys(self):
+        """Returns the option names under which this handler is indexed.
+
+        An option can only match this handler if one of these names is the
+        full option, the part before ``=``, or the part before a version
+        suffix (see _OptionIndex).
+        """
+        return [self.name]
+
     def matches(self, opt):
         """Checks whether this handler handles the provided option.
 
@@ -285,8 +372,12 @@ class _VersionOptionHandler(_BuildOptionHandler):
     The value of the option will be the version number (a string).
     """
 
+    def __init__(self, name, *args, **kwargs):
+        _BuildOptionHandler.__init__(self, name, *args, **kwargs)
+        self._regex = re.compile(re.escape(name) + r'-\d+(\.\d+)*$')
+
     def matches(self, opt):
-        return bool(re.match(self.name + r'-\d+(\.\d+)*$', opt))
+        return bool(self._regex.match(opt))
 
     def parse(self, opt):
         return opt[len(self.name)+1:]
@@ -297,6 +388,9 @@ class _BoolOptionHandler(_BuildOptionHandler):
     The value of the option will be ``True`` or ``False``.
     """
 
+    def get_keys(self):
+        return [self.name, 'no-' + self.name]
+
     def matches(self, opt):
         return opt in (self.name, 'no-' + self.name) \
                 or opt.startswith(self.name + '=')
@@ -331,6 +425,16 @@ def gpuhw_label(opt, value):
         return None
     return str(value).lower()
 
+class _LabelOnlyEnvironment(object):
+    """Stands in for BuildEnvironment when only host labels are needed.
+
+    All handler callbacks that _define_handlers() looks up resolve to None,
+    so the resulting handlers have no effect beyond parsing the options.
+    """
+
+    def __getattr__(self, name):
+        return None
+
 def _define_handlers(e, extra_options):
     """Defines the list of recognized build options."""
     # The options are processed in the order they are in the tuple, to support
@@ -371,7 +475,9 @@ def _define_handlers(e, extra_options):
             _EnumOptionHandler('gpuhw', Gpuhw, label=gpuhw_label),
             _SimpleOptionHandler('mpi', e._init_mpi, label=OPT),
             _SimpleOptionHandler('armpl', e._init_armpl, label=OPT),
-            _SimpleOptionHandler('tidy', label=OPT)
+            _SimpleOptionHandler('tidy', label=OPT),
+            _SimpleOptionHandler('ccache', e._init_ccache),
+            _SimpleOptionHandler('ninja', e._init_ninja)
         ]
     if extra_options and "opencl" in extra_options:
         # This build is running an old script where opencl was a bool,
@@ -422,16 +528,117 @@ def process_build_options(factory, opts, script_settings):
     if opts:
         opts = _remove_host_option(opts)
     o = BuildOptions(handlers, opts)
+    e._config_string = o.get_config_string(exclude=('build-jobs',))
+    e._sanitizers = [x for x in ('asan', 'tsan') if x in o and o[x]]
     e._finalize(script_settings.use_stdlib_through_env_vars)
     return (e, o)
 
+def _get_label_expression(opts):
+    """Returns the label expression from a ``label=`` option, if any."""
+    expressions = [x.split('=', 1)[1] for x in opts if x.lower().startswith('label=')]
+    if not expressions:
+        return None
+    return ' && '.join(['({0})'.format(x) for x in expressions])
+
 def _remove_host_option(opts):
     """Removes options that specify the execution host."""
     return list(filter(lambda x: not x.lower().startswith(('host=', 'label=')), opts))
 
+class OptionLabelResolver(object):
+    """Determines the host labels that build options require.
+
+    Unlike process_build_options(), this does not create a BuildEnvironment,
+    so resolving labels has no side effects and does not depend on the
+    current host.  The handlers are created once, and the labels for each
+    distinct option string are remembered, so the same resolver can be used
+    for any number of configurations.
+
+    Args:
+        extra_options (Optional[Dict]): Extra options declared by a build
+            script (see BuildScriptSettings).
+    """
+
+    def __init__(self, extra_options=None):
+        self._handlers = _define_handlers(_LabelOnlyEnvironment(), extra_options)
+        self._index = _OptionIndex(self._handlers)
+        self._labels = dict()
+
+    def get_labels(self, opts):
+        """Returns the labels required by a set of build options.
+
+        Options that are not recognized do not require any labels.
+
+        Args:
+            opts (List[str]): Build options.
+
+        Returns:
+            Set[str]: Labels that the build host must have.
+        """
+        labels = set()
+        for opt in opts:
+            labels.update(self._get_option_labels(opt))
+        return labels
+
+    def _get_option_labels(self, opt):
+        labels = self._labels.get(opt, None)
+        if labels is None:
+            labels = []
+            for order in self._index.find_handlers(opt):
+                handler = self._handlers[order]
+                label = handler.label(opt, handler.parse(opt))
+                if label:
+                    labels.append(label)
+            self._labels[opt] = labels
+        return labels
+
+_default_label_resolver = None
+
+def get_label_resolver():
+    """Returns a shared OptionLabelResolver for the built-in options."""
+    global _default_label_resolver
+    if _default_label_resolver is None:
+        _default_label_resolver = OptionLabelResolver()
+    return _default_label_resolver
+
+# Rough relative build costs for options that make a configuration notably
+# slower to build or test than a plain build (which has cost 1.0).  The
+# options are identified as in _get_option_keys(), so a version suffix does
+# not matter.  Options from build scripts (like asan) can also be listed.
+_BUILD_COST_FACTORS = {
+        'tsan': 3.0,
+        'asan': 2.0,
+        'tidy': 3.0,
+        'clang-static-analyzer': 2.0,
+        'cuda': 1.5,
+        'opencl': 1.5
+    }
+
+def estimate_build_cost(opts):
+    """Estimates the relative cost of building a configuration.
+
+    Args:
+        opts (List[str]): Build options.
+
+    Returns:
+        float: Cost relative to a configuration without any expensive
+            options.
+    """
+    cost = 1.0
+    for opt in opts:
+        for key in _get_option_keys(opt.lower()):
+            if key in _BUILD_COST_FACTORS:
+                cost *= _BUILD_COST_FACTORS[key]
+                break
+    return cost
+
 def select_build_hosts(factory, configs):
     """Selects build host for each configuration.
 
+    The hosts are selected for all the configurations together, balancing
+    the estimated load between the build agents (see agents.assign_hosts()).
+    A ``label=`` option in a configuration is a Jenkins label expression
+    that further restricts the possible hosts.
+
     Args:
         factory (ContextFactory): Factory to access other objects.
         List[MatrixConfig]: List of build options for each configuration.
@@ -440,24 +647,18 @@ def select_build_hosts(factory, configs):
         List[MatrixConfig]: The input configurations with ``host=`` or ``label=``
             option added/replaced.
     """
-    e = BuildEnvironment(factory)
-    handlers = _define_handlers(e, None)
-    result = []
+    resolver = get_label_resolver()
+    builds = []
     for config in configs:
+        expression = _get_label_expression(config.opts)
         config.opts = _remove_host_option(config.opts)
-        opts = config.opts
-        labels = set()
-        for handler in handlers:
-            found_opts = [x for x in opts if handler.matches(x)]
-            for found_opt in found_opts:
-                value = handler.parse(found_opt)
-                label = handler.label(found_opt, value)
-                if label:
-                    labels.add(label)
+        labels = resolver.get_labels(config.opts)
         config.labels = list(labels)
-        config.host = agents.pick_host(labels, config.opts)
+        builds.append((labels, expression, estimate_build_cost(config.opts)))
+    hosts = agents.assign_hosts(builds)
+    for config, host in zip(configs, hosts):
+        config.host = host
         if not config.host:
-            reason = 'no build agent supports this combination: ' + ' '.join(opts)
+            reason = 'no build agent supports this combination: ' + ' '.join(config.opts)
             factory.status_reporter.mark_failed(reason)
-        result.append(config)
-    return result
+    return list(configs)
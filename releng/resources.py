@@ -0,0 +1,350 @@
+"""
+Resources available for a build on the build agent
+
+The default build parallelism is chosen based on the resources that the agent
+actually has available when the build starts: the number of CPUs (limited by
+a CPU quota of the container, if any), how many executors share the agent,
+the current load, and the available memory per compile job.  The static
+values in agents.py are only used if the resources cannot be determined.
+
+Link steps (and some toolchains, like nvcc, or sanitizer builds) need much
+more memory than typical compile jobs.  The memory needed per job is
+estimated per toolchain, and refined from the peak memory use measured in
+earlier builds of the same configuration on the agent, which is stored in an
+agent-local SQLite database (in the cache directory, see cache.py).  The peak
+is measured for each build command separately (see wait_for_process()), so
+other commands run by the build do not affect it.  With the Ninja generator
+(and CMake 3.11 or newer), link steps are limited separately using CMake job
+pools, so that the link jobs fit in memory next to the compile jobs that run
+at the same time.
+"""
+
+import errno
+import math
+import multiprocessing
+import os
+import sys
+
+_GIB = 1024.0 ** 3
+
+# Estimated peak memory use of a single compile job.
+_DEFAULT_MEMORY_PER_JOB = 1024 ** 3
+
+# Estimated peak memory use of compile and link jobs (in GiB) for
+# toolchains that need more than the default (key None).  For a build using
+# multiple toolchains (e.g., a compiler and CUDA), the maximum is used.
+_TOOLCHAIN_MEMORY = {
+        None: (1.0, 2.0),
+        'icc': (1.5, 3.0),
+        'cuda': (2.0, 3.0),
+        'asan': (2.0, 4.0),
+        'tsan': (3.0, 6.0)
+    }
+
+# Number of most recent builds that a decrease in the stored peak memory use
+# is approximately averaged over.  Increases are taken into use immediately.
+_PEAK_MEMORY_WINDOW = 10
+
+_MEMORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS peak_memory (
+    config TEXT NOT NULL PRIMARY KEY,
+    runs INTEGER NOT NULL,
+    peak INTEGER NOT NULL
+)
+"""
+
+# Files that provide the CPU quota with cgroups v2 and v1.
+_CGROUP2_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+_CGROUP1_CPU_DIRS = ('/sys/fs/cgroup/cpu', '/sys/fs/cgroup/cpu,cpuacct')
+
+# Files that provide the memory limit, usage, and statistics with cgroups v2
+# and v1, and the statistic that gives the reclaimable page cache.
+_CGROUP2_MEMORY = ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current',
+        '/sys/fs/cgroup/memory.stat', 'inactive_file')
+_CGROUP1_MEMORY = ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+        '/sys/fs/cgroup/memory/memory.usage_in_bytes',
+        '/sys/fs/cgroup/memory/memory.stat', 'total_inactive_file')
+
+class HostResources(object):
+    """Resources of the build agent at the time of the probe.
+
+    Any of the attributes can be ``None`` if it could not be determined.
+
+    Attributes:
+        cpu_count (int or None): Number of CPUs (hardware threads).
+        cpu_quota (float or None): Number of CPUs that the CPU quota of the
+            cgroup allows using, or ``None`` if there is no quota.
+        load_average (float or None): One-minute load average.
+        available_memory (int or None): Memory available for new processes,
+            in bytes.
+    """
+
+    def __init__(self, cpu_count=None, cpu_quota=None, load_average=None,
+            available_memory=None):
+        self.cpu_count = cpu_count
+        self.cpu_quota = cpu_quota
+        self.load_average = load_average
+        self.available_memory = available_memory
+
+    def choose_build_jobs(self, executors, memory_per_job=_DEFAULT_MEMORY_PER_JOB):
+        """Chooses the number of parallel jobs for a build.
+
+        The CPUs are divided evenly between the executors of the agent.  If
+        the load is already higher than the other builds should cause, the
+        number of jobs is reduced (but at most by half, since the load
+        average reacts slowly), and it is also limited so that each job has
+        memory_per_job of memory available.
+
+        Args:
+            executors (int): Number of executors sharing the agent.
+            memory_per_job (int): Estimated peak memory use of a job, in bytes.
+
+        Returns:
+            Tuple[int, List[str]]: Number of jobs (``None`` if the number of
+                CPUs is not known), and the reasons for the choice.
+        """
+        if not self.cpu_count:
+            return None, ['number of CPUs not known']
+        cpus = self.cpu_count
+        reasons = ['{0} CPUs'.format(cpus)]
+        if self.cpu_quota is not None and self.cpu_quota < cpus:
+            cpus = max(1, int(math.ceil(self.cpu_quota)))
+            reasons.append('CPU quota of {0:.1f} CPUs'.format(self.cpu_quota))
+        jobs = max(1, cpus // executors)
+        if executors > 1:
+            reasons.append('{0} executors on the agent'.format(executors))
+        if self.load_average is not None:
+            idle = int(cpus - self.load_average)
+            limited = max(idle, (jobs + 1) // 2, 1)
+            if limited < jobs:
+                jobs = limited
+                reasons.append('load average {0:.1f}'.format(self.load_average))
+        if self.available_memory is not None:
+            memory_jobs = max(1, self.available_memory // memory_per_job)
+            if memory_jobs < jobs:
+                jobs = memory_jobs
+                reasons.append('{0:.1f} GiB of available memory ({1:.1f} GiB per job)'.format(
+                    self.available_memory / _GIB, memory_per_job / _GIB))
+        return jobs, reasons
+
+    def choose_link_jobs(self, jobs, compile_memory, link_memory):
+        """Chooses how many of the build jobs can be link jobs.
+
+        The remaining jobs are assumed to be compile jobs running at the
+        same time, so the link jobs only get the memory that those leave
+        available.
+
+        Args:
+            jobs (int): Total number of parallel jobs.
+            compile_memory (int): Estimated peak memory use of a compile
+                job, in bytes.
+            link_memory (int): Estimated peak memory use of a link job, in
+                bytes.
+
+        Returns:
+            int: Number of parallel link jobs.
+        """
+        if self.available_memory is None or link_memory <= compile_memory:
+            return jobs
+        spare_memory = self.available_memory - jobs * compile_memory
+        return max(1, min(jobs, spare_memory // (link_memory - compile_memory)))
+
+class MemoryUsageStore(object):
+
+    """Stores the peak memory use of builds between builds.
+
+    Args:
+        connection (sqlite3.Connection): Database to store the values in.
+    """
+
+    def __init__(self, connection):
+        self._conn = connection
+        with self._conn:
+            self._conn.execute(_MEMORY_SCHEMA)
+
+    def record(self, config, peak):
+        """Records the peak memory use (in bytes) of a build configuration."""
+        with self._conn:
+            row = self._conn.execute('SELECT runs, peak FROM peak_memory WHERE config=?',
+                    (config,)).fetchone()
+            runs, stored = 0, 0
+            if row is not None:
+                runs, stored = row
+            runs += 1
+            if peak < stored:
+                peak = stored + (peak - stored) // min(runs, _PEAK_MEMORY_WINDOW)
+            self._conn.execute('INSERT OR REPLACE INTO peak_memory (config, runs, peak)'
+                    ' VALUES (?, ?, ?)', (config, runs, peak))
+
+    def get_peak(self, config):
+        """Returns the stored peak memory use of a configuration, or None."""
+        row = self._conn.execute('SELECT peak FROM peak_memory WHERE config=?',
+                (config,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+def estimate_job_memory(toolchains, peak=None):
+    """Estimates the peak memory use of compile and link jobs.
+
+    Args:
+        toolchains (List[str]): Toolchains used in the build (keys of
+            _TOOLCHAIN_MEMORY; others use the default).
+        peak (Optional[int]): Peak memory use measured in earlier builds of
+            the same configuration, in bytes.  It is the largest use of any
+            single job, so it replaces the estimate for link jobs, and also
+            limits the estimate for compile jobs.
+
+    Returns:
+        Tuple[int, int]: Estimated memory use (in bytes) of a compile job and
+            of a link job.
+    """
+    estimates = [_TOOLCHAIN_MEMORY[None]]
+    estimates.extend([_TOOLCHAIN_MEMORY[x] for x in toolchains if x in _TOOLCHAIN_MEMORY])
+    compile_memory = int(max([x[0] for x in estimates]) * _GIB)
+    link_memory = int(max([x[1] for x in estimates]) * _GIB)
+    if peak:
+        compile_memory = min(compile_memory, peak)
+        link_memory = peak
+    return compile_memory, link_memory
+
+def wait_for_process(process):
+    """Waits for a process to finish, and returns its peak memory use.
+
+    The peak is the largest resident set size of the process and of any of
+    its descendants, so for a build command it is the peak memory use of the
+    largest compile or link job.  Unlike getrusage(RUSAGE_CHILDREN), it does
+    not include other commands run by the current process.
+
+    Args:
+        process (subprocess.Popen): Process to wait for.
+
+    Returns:
+        Tuple[int, int or None]: Exit code of the process, and the peak
+            memory use in bytes (``None`` if it cannot be determined, e.g.,
+            on Windows).
+    """
+    if not hasattr(os, 'wait4'):
+        return process.wait(), None
+    while True:
+        try:
+            pid, status, usage = os.wait4(process.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    peak = usage.ru_maxrss
+    if not peak:
+        return process.returncode, None
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return process.returncode, peak
+
+def probe_host_resources():
+    """Determines the resources of the current host.
+
+    Returns:
+        HostResources: Resources of the host.
+    """
+    try:
+        cpu_count = multiprocessing.cpu_count()
+    except NotImplementedError:
+        cpu_count = None
+    try:
+        load_average = os.getloadavg()[0]
+    except (AttributeError, OSError):
+        load_average = None
+    return HostResources(cpu_count=cpu_count, cpu_quota=_get_cpu_quota(),
+            load_average=load_average, available_memory=_get_available_memory())
+
+def _read_text(path):
+    try:
+        with open(path, 'r') as fp:
+            return fp.read()
+    except (IOError, OSError):
+        return None
+
+def _get_cpu_quota():
+    text = _read_text(_CGROUP2_CPU_MAX)
+    if text is not None:
+        return _parse_cpu_max(text)
+    for cpu_dir in _CGROUP1_CPU_DIRS:
+        quota = _read_text(os.path.join(cpu_dir, 'cpu.cfs_quota_us'))
+        period = _read_text(os.path.join(cpu_dir, 'cpu.cfs_period_us'))
+        if quota is not None and period is not None:
+            return _parse_cpu_max(quota.strip() + ' ' + period.strip())
+    return None
+
+def _parse_cpu_max(text):
+    """Parses the CPU quota from ``<quota> <period>`` (quota may be max or -1)."""
+    try:
+        quota, period = text.split()
+        if quota in ('max', '-1'):
+            return None
+        return float(quota) / float(period)
+    except ValueError:
+        return None
+
+def _get_available_memory():
+    available = None
+    text = _read_text('/proc/meminfo')
+    if text is not None:
+        available = _parse_meminfo(text)
+    for limit_path, usage_path, stat_path, inactive_name in (_CGROUP2_MEMORY, _CGROUP1_MEMORY):
+        limit = _read_text(limit_path)
+        usage = _read_text(usage_path)
+        if limit is None or usage is None:
+            continue
+        try:
+            limit = int(limit)
+            usage = int(usage)
+        except ValueError:
+            # memory.max is "max" if there is no limit.
+            break
+        # The usage includes page cache (e.g., from a fresh checkout), which
+        # the kernel reclaims under pressure; exclude it like docker does.
+        stat = _read_text(stat_path)
+        if stat is not None:
+            usage -= min(usage, _parse_memory_stat(stat).get(inactive_name, 0))
+        cgroup_available = max(0, limit - usage)
+        if available is None or cgroup_available < available:
+            available = cgroup_available
+        break
+    return available
+
+def _parse_memory_stat(text):
+    """Returns the values from the contents of a cgroup memory.stat file."""
+    values = dict()
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            try:
+                values[fields[0]] = int(fields[1])
+            except ValueError:
+                pass
+    return values
+
+def _parse_meminfo(text):
+    """Returns available memory in bytes from the contents of /proc/meminfo.
+
+    Kernels older than 3.14 do not report MemAvailable, and the sum of free
+    memory and page cache is used instead.
+    """
+    values = dict()
+    for line in text.splitlines():
+        name, sep, value = line.partition(':')
+        fields = value.split()
+        if fields:
+            try:
+                values[name] = int(fields[0]) * 1024
+            except ValueError:
+                pass
+    if 'MemAvailable' in values:
+        return values['MemAvailable']
+    if 'MemFree' in values:
+        return values['MemFree'] + values.get('Buffers', 0) + values.get('Cached', 0)
+    return None
@@ -0,0 +1,59 @@
+import unittest
+
+from releng.common import ConfigurationError
+from releng.agents import assign_hosts, find_hosts, find_non_matrix_hosts
+from releng.agents import _LabelIndex
+
+class TestLabelIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = _LabelIndex({
+                'a': {'gcc-5', 'mpi', 'cuda-8.0'},
+                'b': {'gcc-5', 'clang-6'},
+                'c': {'clang-6', 'mpi'}
+            })
+
+    def _hosts(self, expression):
+        return self.index.get_hosts(self.index.get_expression_mask(expression))
+
+    def test_Labels(self):
+        self.assertEqual(self.index.get_hosts(self.index.get_mask({'gcc-5'})), ['a', 'b'])
+        self.assertEqual(self.index.get_hosts(self.index.get_mask({'gcc-5', 'mpi'})), ['a'])
+        self.assertEqual(self.index.get_hosts(self.index.get_mask({'gcc-5', 'unknown'})), [])
+        self.assertEqual(self.index.get_hosts(self.index.get_mask(())), ['a', 'b', 'c'])
+
+    def test_Expressions(self):
+        self.assertEqual(self._hosts('clang-6'), ['b', 'c'])
+        self.assertEqual(self._hosts('gcc-5&&mpi || c'), ['a', 'c'])
+        self.assertEqual(self._hosts('gcc-5 && (mpi || c)'), ['a'])
+        self.assertEqual(self._hosts('!mpi'), ['b'])
+        self.assertEqual(self._hosts('!(gcc-5 && clang-6) && !a'), ['c'])
+        self.assertEqual(self._hosts('unknown || b'), ['b'])
+
+    def test_InvalidExpressions(self):
+        for expression in ('', 'a &&', '|| a', '(a || b', 'a b', 'a)', 'a & b'):
+            with self.assertRaises(ConfigurationError):
+                self.index.get_expression_mask(expression)
+
+class TestHostQueries(unittest.TestCase):
+    def test_FindHosts(self):
+        result = find_hosts([({'cuda-5.0', 'gcc-4.6'}, None), (set(), 'msvc-2013 || bs_mac'),
+            ({'no-such-label'}, None), (set(), None)])
+        self.assertEqual(result, [['bs_nix1204', 'bs_nix1310'], ['bs_mac'], [],
+            ['docker-ubuntu-15.04']])
+
+    def test_NonMatrixHosts(self):
+        hosts = ['bs_mac', None, 'bs_nix-docs', 'docker-ubuntu-15.04', 'bs_nix-docs']
+        self.assertEqual(find_non_matrix_hosts(hosts), ['bs_nix-docs', 'docker-ubuntu-15.04'])
+
+    def test_AssignWithExpression(self):
+        hosts = assign_hosts([
+                ({'gcc-4.4'}, None, 1.0),
+                ({'gcc-4.4'}, 'bs_nix1204 || bs_nix1310', 1.0),
+                ({'gcc-4.4'}, '!bs_mic && !bs_nix-amd', 1.0),
+                (set(), None, 1.0),
+                ({'msvc-2013'}, 'bs_mac', 1.0)
+            ])
+        self.assertEqual(hosts, ['bs_mac', 'bs_nix1310', 'bs_mac', 'docker-ubuntu-15.04', None])
+
+if __name__ == '__main__':
+    unittest.main()
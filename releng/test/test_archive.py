@@ -0,0 +1,74 @@
+import gzip
+import hashlib
+import os.path
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from releng.archive import ArchiveWriter, write_tree
+
+class TestArchiveWriter(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmpdir, 'source')
+        os.makedirs(os.path.join(self.source_dir, 'sub'))
+        self.contents = {
+                'a.txt': 'a' * 1000,
+                'sub/b.bin': os.urandom(50000)
+            }
+        for name, contents in self.contents.iteritems():
+            with open(os.path.join(self.source_dir, name), 'wb') as fp:
+                fp.write(contents)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _create(self, block_size):
+        path = os.path.join(self.tmpdir, 'out.tar.gz')
+        with ArchiveWriter(path, jobs=3, block_size=block_size) as writer:
+            write_tree(writer, self.source_dir, 'pkg-1.0')
+        return path, writer.digests
+
+    def _count_members(self, data):
+        return data.count('\x1f\x8b\x08\x00\x00\x00\x00\x00')
+
+    def _check_archive(self, path, digests):
+        with tarfile.open(path, 'r:gz') as tar:
+            names = sorted(tar.getnames())
+            self.assertEqual(names, ['pkg-1.0', 'pkg-1.0/a.txt', 'pkg-1.0/sub', 'pkg-1.0/sub/b.bin'])
+            for name, contents in self.contents.iteritems():
+                self.assertEqual(tar.extractfile('pkg-1.0/' + name).read(), contents)
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        self.assertEqual(digests['md5'], hashlib.md5(data).hexdigest())
+        self.assertEqual(digests['sha256'], hashlib.sha256(data).hexdigest())
+        return data
+
+    def test_SingleMember(self):
+        path, digests = self._create(block_size=1024 * 1024)
+        data = self._check_archive(path, digests)
+        self.assertEqual(self._count_members(data), 1)
+
+    def test_ParallelMembers(self):
+        path, digests = self._create(block_size=4096)
+        data = self._check_archive(path, digests)
+        self.assertGreater(self._count_members(data), 10)
+        uncompressed = gzip.open(path).read()
+        self.assertEqual(len(uncompressed) % tarfile.RECORDSIZE, 0)
+
+    def test_RenamedWhenClosed(self):
+        self._create(block_size=4096)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['out.tar.gz', 'source'])
+
+    def test_RemovedOnError(self):
+        path = os.path.join(self.tmpdir, 'out.tar.gz')
+        with self.assertRaises(IOError):
+            with ArchiveWriter(path, jobs=3, block_size=4096) as writer:
+                writer.write('x' * 10000)
+                raise IOError('read failed')
+        self.assertIs(writer.digests, None)
+        self.assertEqual(os.listdir(self.tmpdir), ['source'])
+
+if __name__ == '__main__':
+    unittest.main()
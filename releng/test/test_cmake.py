@@ -59,6 +59,32 @@ class TestRunBuild(unittest.TestCase):
         self.helper.assertOutputFile("Testing/Temporary/CTest.xml", """\
                 <testsuites><testsuite name="CTest"><testcase classname="CTest" name="Test1" time="0.1"><failure message="Failed" /><system-out>some output</system-out></testcase></testsuite></testsuites>""")
 
+    def test_CTestOutputLimit(self):
+        self.helper.add_input_file("Testing/YYYYMMDD-HHMM/Test.xml", """\
+                <Site>
+                  <Testing>
+                    <TestList>
+                      <Test>./Test1</Test>
+                    </TestList>
+                    <Test Status="passed">
+                      <Name>Test1</Name>
+                      <Results>
+                        <NamedMeasurement name="Execution Time">
+                          <Value>0.1</Value>
+                        </NamedMeasurement>
+                        <Measurement>
+                          <Value>first line &amp; more output</Value>
+                        </Measurement>
+                      </Results>
+                    </Test>
+                  </Testing>
+                </Site>
+                """)
+        process_ctest_xml(self.helper.executor, memcheck=False, max_output_size=11)
+        self.helper.assertOutputFile("Testing/Temporary/CTest.xml", """\
+                <testsuites><testsuite name="CTest"><testcase classname="CTest" name="Test1" time="0.1"><system-out>[... 13 characters of output omitted ...]
+                more output</system-out></testcase></testsuite></testsuites>""")
+
     def test_CTestAsanFailure(self):
         self.helper.add_input_file("Testing/YYYYMMDD-HHMM/DynamicAnalysis.xml", """\
                 <Site>
@@ -1,13 +1,14 @@
 import os.path
+import textwrap
 import unittest
 # With Python 2.7, this needs to be separately installed.
 # With Python 3.3 and up, this should change to unittest.mock.
 import mock
 
-from releng.common import JobType
+from releng.common import CommandError, ConfigurationError, JobType, Project
 from releng.context import BuildContext
 
-from releng.test.utils import TestHelper
+from releng.test.utils import RepositoryTestState, TestHelper
 
 class TestRunBuild(unittest.TestCase):
     def setUp(self):
@@ -66,6 +67,309 @@ class TestRunBuild(unittest.TestCase):
                 'script/build.py', JobType.GERRIT, None)
 
 
+class TestCompilerCache(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, env={ 'RELENG_CACHE_DIR': '/cache' })
+
+    def _run_build(self, opts):
+        self.helper.add_input_file('script/build.py',
+                """\
+                def do_build(context):
+                    context.run_cmake(dict())
+                    context.build_target()
+                """)
+        BuildContext._run_build(self.helper.factory,
+                'script/build.py', JobType.GERRIT, opts)
+        cmake_calls = [x for x in self.helper.executor.check_call.call_args_list
+                if any(arg.startswith('-DCMAKE_INSTALL_PREFIX=') for arg in x[0][0])]
+        self.assertEqual(len(cmake_calls), 1)
+        return cmake_calls[0][0][0], cmake_calls[0][1]['env']
+
+    def test_Ccache(self):
+        cmd, env = self._run_build(['gcc-7', 'ccache'])
+        self.assertIn('-DCMAKE_C_COMPILER_LAUNCHER=ccache', cmd)
+        self.assertIn('-DCMAKE_CXX_COMPILER_LAUNCHER=ccache', cmd)
+        self.assertEqual(env['CCACHE_DIR'], '/cache/ccache/gcc-7')
+        self.assertEqual(env['CCACHE_BASEDIR'], '/ws')
+        self.assertEqual(self.helper._output_files['/ws/logs/ccache-stats.log'],
+                'direct_cache_hit                       0\n'
+                'cache_miss                             0\n')
+
+    def test_CcacheWithStaticAnalyzer(self):
+        cmd, env = self._run_build(['clang-3.8', 'clang-static-analyzer-3.8', 'ccache'])
+        self.assertNotIn('-DCMAKE_CXX_COMPILER_LAUNCHER=ccache', cmd)
+        self.assertNotIn('CCACHE_DIR', env)
+        self.assertNotIn('/ws/logs/ccache-stats.log', self.helper._output_files)
+
+    def test_CcacheStatsOfBuild(self):
+        outputs = [
+                'stats_updated_timestamp\t1500000000\ndirect_cache_hit\t100\ncache_miss\t20\n',
+                'stats_updated_timestamp\t1500000600\ndirect_cache_hit\t130\ncache_miss\t25\n'
+            ]
+        check_output = self.helper.executor.check_output.side_effect
+        def _check_output(cmd, **kwargs):
+            if cmd[0] == 'ccache':
+                return outputs.pop(0)
+            return check_output(cmd, **kwargs)
+        self.helper.executor.check_output.side_effect = _check_output
+        self._run_build(['gcc-7', 'ccache'])
+        ccache_calls = [x[0][0] for x in self.helper.executor.check_output.call_args_list
+                if x[0][0][0] == 'ccache']
+        self.assertEqual(ccache_calls, [['ccache', '--print-stats']] * 2)
+        self.assertEqual(self.helper._output_files['/ws/logs/ccache-stats.log'],
+                'direct_cache_hit                       30\n'
+                'cache_miss                             5\n')
+
+    def test_CcacheNotInstalled(self):
+        self.helper.executor.find_executable_with_path.side_effect = \
+                lambda name, environment_path: None if name == 'ccache' else '/usr/bin/' + name
+        cmd, env = self._run_build(['gcc-7', 'ccache'])
+        self.assertNotIn('-DCMAKE_CXX_COMPILER_LAUNCHER=ccache', cmd)
+        self.assertNotIn('CCACHE_DIR', env)
+        self.assertNotIn('/ws/logs/ccache-stats.log', self.helper._output_files)
+
+
+class TestPeakMemory(unittest.TestCase):
+    def test_RecordedOncePerBuild(self):
+        helper = TestHelper(self, workspace='/ws')
+        helper.executor.get_last_command_peak_memory.side_effect = [3000, 2000]
+        helper.add_input_file('script/build.py',
+                """\
+                build_options = ['gcc-7']
+                def do_build(context):
+                    context.run_cmake(dict())
+                    context.build_target(target='lib')
+                    context.build_target(target='tests')
+                """)
+        context = BuildContext._run_build(helper.factory,
+                'script/build.py', JobType.GERRIT, None)
+        store = context.env._get_memory_usage_store()
+        self.assertEqual(store.get_peak(context.env._config_string), 3000)
+        rows = store._conn.execute('SELECT runs FROM peak_memory').fetchall()
+        self.assertEqual(rows, [(1,)])
+
+
+class TestNinjaBuild(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, workspace='/ws')
+        self.helper.add_input_file('/ws/gromacs/.ninja_log', """\
+                # ninja log v5
+                0\t9000\t0\tsrc/CMakeFiles/lib.dir/old.cpp.o\t1111
+                """)
+        self.helper.executor.check_call.side_effect = self._check_call
+
+    def _check_call(self, cmd, **kwargs):
+        if '--build' in cmd:
+            self.helper._input_files['/ws/gromacs/.ninja_log'].extend([
+                    '0\t2000\t0\tsrc/CMakeFiles/lib.dir/a.cpp.o\taaaa\n',
+                    '2000\t3500\t0\tbin/gmx\tbbbb\n'
+                ])
+
+    def test_NinjaBuild(self):
+        self.helper.add_input_file('script/build.py',
+                """\
+                build_options = ['gcc-7', 'ninja', 'build-jobs=3']
+                def do_build(context):
+                    context.run_cmake(dict())
+                    context.build_target(target='tests', keep_going=True)
+                """)
+        BuildContext._run_build(self.helper.factory,
+                'script/build.py', JobType.GERRIT, None)
+        cmds = [x[0][0] for x in self.helper.executor.check_call.call_args_list]
+        cmake_cmd = [x for x in cmds if any(arg.startswith('-DCMAKE_INSTALL_PREFIX=') for arg in x)][0]
+        self.assertEqual(cmake_cmd[2:4], ['-G', 'Ninja'])
+        self.assertIn(['cmake', '--build', '.', '--target', 'tests', '--', '-j3', '-k', '0'], cmds)
+        self.helper.assertOutputFile('/ws/logs/build-times-tests.log', """\
+                Build of tests: 2 steps in 3.5 s
+                  compile: 1 steps, 2.0 s in total
+                  link: 1 steps, 1.5 s in total
+
+                Slowest compile steps:
+                     2.0 s  src/CMakeFiles/lib.dir/a.cpp.o
+
+                Slowest link steps:
+                     1.5 s  bin/gmx
+                """)
+
+    def test_RecompactedLog(self):
+        def _check_call(cmd, **kwargs):
+            if '--build' in cmd:
+                self.helper._input_files['/ws/gromacs/.ninja_log'] = [
+                        '# ninja log v5\n',
+                        '0\t2000\t0\tsrc/CMakeFiles/lib.dir/a.cpp.o\taaaa\n'
+                    ]
+        self.helper.executor.check_call.side_effect = _check_call
+        self.helper.add_input_file('script/build.py',
+                """\
+                build_options = ['gcc-7', 'ninja', 'build-jobs=3']
+                def do_build(context):
+                    context.run_cmake(dict())
+                    context.build_target()
+                """)
+        BuildContext._run_build(self.helper.factory,
+                'script/build.py', JobType.GERRIT, None)
+        self.assertTrue(self.helper._output_files['/ws/logs/build-times.log'].startswith(
+                'Build of all: 1 steps in 2.0 s\n'))
+
+    def test_NothingRebuilt(self):
+        self.helper.executor.check_call.side_effect = None
+        self.helper.add_input_file('script/build.py',
+                """\
+                build_options = ['gcc-7', 'ninja', 'build-jobs=3']
+                def do_build(context):
+                    context.run_cmake(dict())
+                    context.build_target(target='tests')
+                """)
+        BuildContext._run_build(self.helper.factory,
+                'script/build.py', JobType.GERRIT, None)
+        self.helper.assertOutputFile('/ws/logs/build-times-tests.log', """\
+                Build of tests: nothing rebuilt
+                """)
+
+    def test_NinjaNotInstalled(self):
+        self.helper.executor.find_executable_with_path.side_effect = \
+                lambda name, environment_path: None if name == 'ninja' else '/usr/bin/' + name
+        self.helper.add_input_file('script/build.py',
+                """\
+                build_options = ['gcc-7', 'ninja']
+                def do_build(context):
+                    context.run_cmake(dict())
+                """)
+        with self.assertRaises(ConfigurationError):
+            BuildContext._run_build(self.helper.factory,
+                    'script/build.py', JobType.GERRIT, None)
+
+
+class TestMakeArchive(unittest.TestCase):
+    def test_CompressionUsesBuildJobs(self):
+        helper = TestHelper(self, workspace='/ws')
+        helper.executor.make_archive.return_value = dict()
+        helper.add_input_file('script/build.py',
+                """\
+                def do_build(context):
+                    context.make_archive('/ws/package', root_dir='/ws/gromacs')
+                """)
+        BuildContext._run_build(helper.factory,
+                'script/build.py', JobType.GERRIT, None)
+        helper.executor.make_archive.assert_called_once_with('/ws/package.tar.gz',
+                '/ws/gromacs', 'gromacs', compression='gz', jobs=2)
+
+
+class TestRunCTest(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, workspace='/ws')
+        self.helper.add_input_file('Testing/TAG', 'TAG\n')
+        self.helper.add_input_file('Testing/TAG/Test.xml', """\
+                <Site><Testing>
+                  <Test Status="passed">
+                    <Name>SlowTest</Name>
+                    <Results>
+                      <NamedMeasurement name="Execution Time"><Value>12.5</Value></NamedMeasurement>
+                      <Measurement><Value>output</Value></Measurement>
+                    </Results>
+                  </Test>
+                </Testing></Site>
+                """)
+        self.helper.add_input_file('script/build.py',
+                """\
+                build_options = ['gcc-7', 'build-jobs=4']
+                def do_build(context):
+                    context.run_ctest([])
+                    context.run_ctest(['--output-on-failure'])
+                """)
+
+    def test_CostDataFromEarlierRun(self):
+        BuildContext._run_build(self.helper.factory,
+                'script/build.py', JobType.GERRIT, None)
+        ctest_calls = [x[0][0] for x in self.helper.executor.check_call.call_args_list
+                if x[0][0][0] == 'ctest']
+        self.assertEqual(ctest_calls, [
+                ['ctest', '-D', 'ExperimentalTest', '-j4'],
+                ['ctest', '-D', 'ExperimentalTest', '-j4', '--output-on-failure']
+            ])
+        self.helper.assertOutputFile('Testing/Temporary/CTestCostData.txt', """\
+                SlowTest 1 12.500000
+                ---
+                """)
+
+class TestProcessCoverageResults(unittest.TestCase):
+    def setUp(self):
+        commits = RepositoryTestState()
+        commits.set_commit(Project.GROMACS, change_number=3456)
+        commits.set_commit(Project.RELENG)
+        self.helper = TestHelper(self, commits=commits, workspace='/ws', env={
+                'GERRIT_PROJECT': 'gromacs',
+                'GERRIT_REFSPEC': commits.gromacs.refspec,
+                'RELENG_CACHE_DIR': '/cache'
+            })
+        check_output = self.helper.executor.check_output.side_effect
+        def _check_output(cmd, **kwargs):
+            if cmd[:3] == ['git', 'diff', '-U0']:
+                return textwrap.dedent("""\
+                    diff --git a/src/a.cpp b/src/a.cpp
+                    --- a/src/a.cpp
+                    +++ b/src/a.cpp
+                    @@ -3 +3,2 @@ int f()
+                    -    return 1;
+                    +    int x = 1;
+                    +    return x;
+                    """)
+            return check_output(cmd, **kwargs)
+        self.helper.executor.check_output.side_effect = _check_output
+        self.helper.add_input_file('/ws/logs/coverage.xml', """\
+                <coverage><packages><package name="src"><classes>
+                  <class filename="src/a.cpp"><lines>
+                    <line number="1" hits="1"/><line number="3" hits="1"/><line number="4" hits="0"/>
+                  </lines></class>
+                </classes></package></packages></coverage>
+                """)
+        self.helper.add_input_file('script/build.py',
+                """\
+                build_options = ['gcc-7']
+                def do_build(context):
+                    context.process_coverage_results(changes_only=True)
+                """)
+
+    @mock.patch('releng.testimpact.find_affected_objects')
+    def test_ChangesOnly(self, find_affected_objects):
+        find_affected_objects.return_value = ['/ws/build/src/CMakeFiles/lib.dir/a.cpp.o']
+        with self.helper.factory.status_reporter:
+            BuildContext._run_build(self.helper.factory,
+                    'script/build.py', JobType.GERRIT, None)
+        gcovr_calls = [x[0][0] for x in self.helper.executor.check_call.call_args_list
+                if x[0][0][0].endswith('gcovr-3.2')]
+        self.assertEqual(len(gcovr_calls), 1)
+        self.assertIn('--datafile-list=/ws/gromacs/coverage-datafiles.txt', gcovr_calls[0])
+        self.assertEqual(gcovr_calls[0][-2:], ['-f', r'\/ws\/gromacs\/src\/a\.cpp$'])
+        self.helper.assertOutputFile('/ws/gromacs/coverage-datafiles.txt', """\
+                /ws/build/src/CMakeFiles/lib.dir/a.cpp.gcda
+                /ws/build/src/CMakeFiles/lib.dir/a.cpp.gcno
+                """)
+        self.helper.assertOutputFile('/ws/logs/coverage-changes.log', """\
+                Coverage of changed lines: 1 of 2 lines (50.0%)
+
+                src/a.cpp: 1 of 2 lines covered
+                  not covered: 4
+                """)
+        self.assertNotIn('/ws/logs/coverage-lines.log', self.helper._output_files)
+        self.assertIn('NOTE: Coverage of changed lines: 1 of 2 lines (50.0%)\n',
+                self.helper._console.getvalue())
+
+    @mock.patch('releng.testimpact.find_affected_objects')
+    def test_ChangesOnlyWithoutDependencies(self, find_affected_objects):
+        find_affected_objects.side_effect = CommandError('ninja -t deps')
+        with self.helper.factory.status_reporter:
+            BuildContext._run_build(self.helper.factory,
+                    'script/build.py', JobType.GERRIT, None)
+        gcovr_calls = [x[0][0] for x in self.helper.executor.check_call.call_args_list
+                if x[0][0][0].endswith('gcovr-3.2')]
+        self.assertEqual(len(gcovr_calls), 1)
+        self.assertFalse(any(x.startswith('--datafile-list=') for x in gcovr_calls[0]))
+        self.assertEqual(gcovr_calls[0][-2:], ['-f', r'\/ws\/gromacs\/src\/a\.cpp$'])
+        self.assertIn('Processing coverage for all objects: could not read dependencies',
+                self.helper._console.getvalue())
+
+
 class TestReadBuildScriptConfig(unittest.TestCase):
     def setUp(self):
         self.helper = TestHelper(self)
@@ -0,0 +1,137 @@
+import os.path
+import shutil
+import tempfile
+import textwrap
+import unittest
+import xml.etree.ElementTree as ET
+
+from releng.common import ConfigurationError, Project
+from releng.coverage import export_coverage_artifact, merge_coverage_artifacts
+from releng.coverage import parse_changed_lines
+from releng.factory import ContextFactory
+
+def _cobertura_xml(classes):
+    lines = ['<?xml version="1.0" ?>', '<coverage line-rate="0.5">',
+            '<sources><source>/src</source></sources>', '<packages>']
+    for package, filename, hits in classes:
+        lines.append('<package name="{0}"><classes>'.format(package))
+        lines.append('<class name="x" filename="{0}"><methods/><lines>'.format(filename))
+        for number, count in hits:
+            lines.append('<line number="{0}" hits="{1}" branch="false"/>'.format(number, count))
+        lines.append('</lines></class></classes></package>')
+    lines.extend(['</packages>', '</coverage>'])
+    return '\n'.join(lines)
+
+class TestCoverageMerge(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        factory = ContextFactory(default_project=Project.GROMACS, system='Linux',
+                env={ 'WORKSPACE': self.tmpdir })
+        self.executor = factory.executor
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def _export(self, name, classes):
+        xml_path = self._path(name + '.xml')
+        with open(xml_path, 'w') as fp:
+            fp.write(_cobertura_xml(classes))
+        artifact_path = self._path(name + '.txt')
+        export_coverage_artifact(self.executor, xml_path, artifact_path, '/ws/gromacs')
+        return artifact_path
+
+    def test_Export(self):
+        path = self._export('simd', [
+                ('src.b', 'src/b/z.cpp', [(2, 0)]),
+                ('src', 'src/y.cpp', [(1, 3), (3, 0)])
+            ])
+        with open(path) as fp:
+            self.assertEqual(fp.read(), textwrap.dedent("""\
+                releng-coverage 2
+                source\t/ws/gromacs
+                src/y.cpp\t3,,0
+                src/b/z.cpp\t,0
+                """))
+
+    def test_Merge(self):
+        paths = [
+                self._export('avx', [
+                    ('src', 'src/y.cpp', [(1, 3), (3, 0)]),
+                    ('src.b', 'src/b/z.cpp', [(2, 0)])
+                ]),
+                self._export('sse', [
+                    ('src', 'src/x.cpp', [(1, 1)]),
+                    ('src', 'src/y.cpp', [(3, 2), (5, 0)])
+                ]),
+                self._export('gpu', [
+                    ('src', 'src/y.cpp', [(1, 1)])
+                ])
+            ]
+        output_path = self._path('coverage.xml')
+        totals = merge_coverage_artifacts(self.executor, paths, output_path)
+        self.assertEqual(totals, {'files': 3, 'lines': 5, 'coveredLines': 3})
+        self.assertFalse(os.path.exists(output_path + '.tmp'))
+        root = ET.parse(output_path).getroot()
+        self.assertEqual(root.get('line-rate'), '0.6')
+        self.assertEqual(root.find('sources/source').text, '/ws/gromacs')
+        packages = root.findall('packages/package')
+        self.assertEqual([x.get('name') for x in packages], ['src', 'src.b'])
+        classes = root.findall('packages/package/classes/class')
+        self.assertEqual([x.get('filename') for x in classes],
+                ['src/x.cpp', 'src/y.cpp', 'src/b/z.cpp'])
+        hits = [(int(x.get('number')), int(x.get('hits'))) for x in classes[1].findall('lines/line')]
+        self.assertEqual(hits, [(1, 4), (3, 2), (5, 0)])
+        self.assertEqual(classes[1].get('name'), 'y_cpp')
+        self.assertEqual(packages[1].get('line-rate'), '0.0')
+        merge_coverage_artifacts(self.executor, paths, output_path, '/src')
+        root = ET.parse(output_path).getroot()
+        self.assertEqual(root.find('sources/source').text, '/src')
+
+    def test_MergeNoArtifacts(self):
+        output_path = os.path.join(self.tmpdir, 'coverage.xml')
+        with self.assertRaises(ConfigurationError):
+            merge_coverage_artifacts(self.executor, [], output_path)
+        self.assertFalse(os.path.exists(output_path))
+
+class TestParseChangedLines(unittest.TestCase):
+    def test_Diff(self):
+        diff = textwrap.dedent("""\
+            diff --git a/src/a.cpp b/src/a.cpp
+            index 1234..5678 100644
+            --- a/src/a.cpp
+            +++ b/src/a.cpp
+            @@ -3 +3,2 @@ int f()
+            -    return 1;
+            +    int x = 1;
+            +++ b/not/a/file
+            @@ -10,2 +11 @@
+            -a
+            -b
+            +c
+            @@ -20 +20,0 @@
+            -d
+            diff --git a/docs/removed.rst b/docs/removed.rst
+            deleted file mode 100644
+            --- a/docs/removed.rst
+            +++ /dev/null
+            @@ -1 +0,0 @@
+            -text
+            diff --git a/src/new.h b/src/new.h
+            new file mode 100644
+            --- /dev/null
+            +++ b/src/new.h
+            @@ -0,0 +1,3 @@
+            +a
+            +b
+            +c
+            """)
+        self.assertEqual(parse_changed_lines(diff), {
+                'src/a.cpp': set([3, 4, 11]),
+                'src/new.h': set([1, 2, 3])
+            })
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+import os.path
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from releng.common import AbortError, CommandError
+from releng.executor import Executor
+
+from releng.test.utils import TestHelper
+
+class TestRunMany(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self)
+        self.runner = self.helper.factory.cmd_runner
+
+    def test_Success(self):
+        self.helper.executor.call_with_output.return_value = (0, 'line 1\nline 2\n')
+        jobs = self.runner.run_many([['echo', 'foo']], cwd='/build')
+        self.assertEqual([job.returncode for job in jobs], [0])
+        self.helper.executor.call_with_output.assert_called_once_with(
+                ['echo', 'foo'], cwd='/build', env=self.helper.factory.env)
+        self.helper.assertConsoleOutput("""\
+                [1] + echo foo
+                [1] line 1
+                [1] line 2
+                """)
+
+    def test_Failure(self):
+        def call_with_output(cmd, **kwargs):
+            if cmd[0] == 'false':
+                return 1, ''
+            return 0, ''
+        self.helper.executor.call_with_output.side_effect = call_with_output
+        cmds = [['true'], ['false', 'a'], ['true'], ['false', 'b']]
+        with self.assertRaises(CommandError) as cm:
+            self.runner.run_many(cmds, max_jobs=2)
+        self.assertEqual(cm.exception.cmd, 'false a; false b')
+        self.assertEqual(self.helper.executor.call_with_output.call_count, 4)
+
+    def test_WorkerThreadsBounded(self):
+        threads = set()
+        def call_with_output(cmd, **kwargs):
+            threads.add(threading.current_thread())
+            return 0, ''
+        self.helper.executor.call_with_output.side_effect = call_with_output
+        jobs = self.runner.run_many([['true']] * 50, max_jobs=3)
+        self.assertEqual([job.returncode for job in jobs], [0] * 50)
+        self.assertLessEqual(len(threads), 3)
+
+    def test_FailureNoCheck(self):
+        self.helper.executor.call_with_output.return_value = (2, '')
+        jobs = self.runner.run_many([['false']], check=False)
+        self.assertEqual(jobs[0].returncode, 2)
+
+    def test_Abort(self):
+        self.helper.executor.call_with_output.return_value = (143, '')
+        with self.assertRaises(AbortError):
+            self.runner.run_many([['sleep', '100']], check=False)
+
+class TestBufferedOutput(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self)
+        self.runner = self.helper.factory.cmd_runner
+
+    def test_CheckOutputStderr(self):
+        def check_output(cmd, **kwargs):
+            kwargs['stderr'].write('remote: progress\n')
+            return 'abc\n'
+        self.helper.executor.check_output.side_effect = check_output
+        with self.runner.buffered_output() as output:
+            result = self.runner.check_output(['git', 'fetch'])
+        self.assertEqual(result, 'abc\n')
+        self.assertEqual(output.getvalue(), '+ git fetch\nremote: progress\n')
+        self.helper.assertConsoleOutput('')
+
+class TestCallStreaming(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self)
+        self.runner = self.helper.factory.cmd_runner
+
+    def test_FailureWithoutEcho(self):
+        self.helper.executor.call_streaming.return_value = (1, ['last 1', 'last 2'])
+        with self.assertRaises(CommandError):
+            self.runner.check_call_streaming(['make'], log_path='/ws/logs/make.log', echo=False)
+        self.helper.assertConsoleOutput("""\
+                + make
+                Last 2 lines of output:
+                last 1
+                last 2
+                (full output in /ws/logs/make.log)
+                (exited with code 1)
+                """)
+
+    def test_TeeToLogFile(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            executor = Executor(self.helper.factory)
+            log_path = os.path.join(tmpdir, 'output.log')
+            cmd = [sys.executable, '-c', 'for i in range(300): print(i)']
+            returncode, tail = executor.call_streaming(cmd, log_path=log_path, echo=False)
+            self.assertEqual(returncode, 0)
+            self.assertEqual(tail, [str(i) for i in range(200, 300)])
+            with open(log_path) as fp:
+                self.assertEqual(fp.read(), ''.join(['{0}\n'.format(i) for i in range(300)]))
+        finally:
+            shutil.rmtree(tmpdir)
+
+class TestCommandPeakMemory(unittest.TestCase):
+    @unittest.skipUnless(hasattr(os, 'wait4'), 'requires os.wait4()')
+    def test_PerCommand(self):
+        executor = Executor(TestHelper(self).factory)
+        size = 200 * 1024 * 1024
+        executor.check_call([sys.executable, '-c', 'x = " " * {0}'.format(size)])
+        self.assertGreater(executor.get_last_command_peak_memory(), size)
+        self.assertEqual(executor.call([sys.executable, '-c', 'import sys; sys.exit(3)']), 3)
+        self.assertLess(executor.get_last_command_peak_memory(), size)
+
+class TestImportEnv(unittest.TestCase):
+    def test_CachedEnvironment(self):
+        env = { 'PATH': '/usr/bin', 'BUILD_NUMBER': '1' }
+        helper = TestHelper(self, env=env)
+        helper.executor.check_output.side_effect = lambda cmd, **kwargs: \
+                'Toolchain ready\nPATH=/opt/cc/bin:/usr/bin\nCC=cc\nBUILD_NUMBER=1\n'
+        runner = helper.factory.cmd_runner
+        runner.import_env('. /opt/cc/env.sh && cmake -E environment')
+        self.assertEqual(runner.get_env_var('CC'), 'cc')
+        self.assertEqual(len(helper._output_files), 1)
+        cache_path, contents = helper._output_files.items()[0]
+
+        env = { 'PATH': '/usr/bin', 'BUILD_NUMBER': '2' }
+        helper = TestHelper(self, env=env)
+        helper.add_input_file(cache_path, contents)
+        runner = helper.factory.cmd_runner
+        runner.import_env('. /opt/cc/env.sh && cmake -E environment')
+        self.assertFalse(helper.executor.check_output.called)
+        self.assertEqual(runner.get_env_var('PATH'), '/opt/cc/bin:/usr/bin')
+        self.assertEqual(runner.get_env_var('CC'), 'cc')
+        self.assertEqual(runner.get_env_var('BUILD_NUMBER'), '2')
+        helper.assertConsoleOutput("""\
+                + . /opt/cc/env.sh && cmake -E environment (cached)
+                Toolchain ready
+                """)
+
+    def test_ExpiredCache(self):
+        helper = TestHelper(self, env={ 'PATH': '/usr/bin' })
+        helper.executor.check_output.side_effect = lambda cmd, **kwargs: 'CC=cc\n'
+        runner = helper.factory.cmd_runner
+        with mock.patch('time.time', return_value=1000.0):
+            runner.import_env('. /opt/cc/env.sh && cmake -E environment')
+        cache_path, contents = helper._output_files.items()[0]
+
+        helper = TestHelper(self, env={ 'PATH': '/usr/bin' })
+        helper.add_input_file(cache_path, contents)
+        helper.executor.check_output.side_effect = lambda cmd, **kwargs: 'CC=cc2\n'
+        runner = helper.factory.cmd_runner
+        with mock.patch('time.time', return_value=1000.0 + 2 * 24 * 60 * 60):
+            runner.import_env('. /opt/cc/env.sh && cmake -E environment')
+        self.assertTrue(helper.executor.check_output.called)
+        self.assertEqual(runner.get_env_var('CC'), 'cc2')
+
+    def test_ModuleChangeInvalidatesCache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            module_dir = os.path.join(tmpdir, 'modules')
+            os.makedirs(os.path.join(module_dir, 'cuda'))
+            env = { 'PATH': '/usr/bin', 'MODULEPATH': module_dir }
+            cmd = '. /usr/share/modules/init/sh && module load cuda && cmake -E environment'
+            helper = TestHelper(self, env=env)
+            helper.executor.check_output.side_effect = lambda cmd, **kwargs: 'CC=cc\n'
+            helper.factory.cmd_runner.import_env(cmd)
+            first_path = helper._output_files.keys()[0]
+
+            helper = TestHelper(self, env=env)
+            helper.executor.check_output.side_effect = lambda cmd, **kwargs: 'CC=cc\n'
+            helper.factory.cmd_runner.import_env(cmd)
+            self.assertEqual(helper._output_files.keys(), [first_path])
+
+            with open(os.path.join(module_dir, 'cuda', '9.1'), 'w') as fp:
+                fp.write('#%Module\n')
+            os.utime(os.path.join(module_dir, 'cuda'), (0, 0))
+            helper = TestHelper(self, env=env)
+            helper.executor.check_output.side_effect = lambda cmd, **kwargs: 'CC=cc\n'
+            helper.factory.cmd_runner.import_env(cmd)
+            self.assertNotEqual(helper._output_files.keys(), [first_path])
+        finally:
+            shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
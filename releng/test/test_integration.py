@@ -5,7 +5,7 @@ import unittest
 # With Python 3.3 and up, this should change to unittest.mock.
 import mock
 
-from releng.common import AbortError, BuildError, Project
+from releng.common import AbortError, BuildError, CheckoutMode, JobType, Project
 from releng.integration import BuildParameters, ParameterTypes, RefSpec
 from releng.test.utils import RepositoryTestState, TestHelper
 
@@ -205,6 +205,52 @@ class TestProjectsManager(unittest.TestCase):
         projects.checkout_project(Project.GROMACS)
         # TODO: Verify some of the results
 
+    def test_CheckoutProjectsConcurrently(self):
+        commits = RepositoryTestState()
+        commits.set_commit(Project.GROMACS)
+        commits.set_commit(Project.REGRESSIONTESTS)
+        commits.set_commit(Project.RELENG)
+        helper = TestHelper(self, commits=commits, env={
+                'RELENG_DISABLE_GIT_MIRRORS': '1'
+            })
+        def call_with_output(cmd, **kwargs):
+            return 0, 'output from {0} in {1}\n'.format(cmd[1], os.path.basename(kwargs['cwd']))
+        helper.executor.call_with_output.side_effect = call_with_output
+        projects = helper.factory.projects
+        projects.checkout_projects([Project.REGRESSIONTESTS, Project.GROMACS])
+        self.assertTrue(projects.get_project_info(Project.GROMACS).is_checked_out)
+        self.assertTrue(projects.get_project_info(Project.REGRESSIONTESTS).is_checked_out)
+        self.assertFalse(helper.executor.check_call.called)
+        console = helper._console.getvalue().splitlines()
+        self.assertEqual([x for x in console if x.startswith('output from')], [
+                'output from init in regressiontests',
+                'output from fetch in regressiontests',
+                'output from checkout in regressiontests',
+                'output from clean in regressiontests',
+                'output from init in gromacs',
+                'output from fetch in gromacs',
+                'output from checkout in gromacs',
+                'output from clean in gromacs'
+            ])
+
+    def test_CheckoutMode(self):
+        helper = TestHelper(self, env={
+                'CHECKOUT_MODE': 'shallow',
+                'REGRESSIONTESTS_CHECKOUT_MODE': 'Full'
+            })
+        projects = helper.factory.projects
+        self.assertEqual(projects._get_checkout_mode(Project.GROMACS), CheckoutMode.SHALLOW)
+        self.assertEqual(projects._get_checkout_mode(Project.REGRESSIONTESTS), CheckoutMode.FULL)
+
+    def test_CheckoutModeFromJobType(self):
+        helper = TestHelper(self)
+        projects = helper.factory.projects
+        self.assertEqual(projects._get_checkout_mode(Project.GROMACS), CheckoutMode.FULL)
+        projects._set_job_type(JobType.GERRIT)
+        self.assertEqual(projects._get_checkout_mode(Project.GROMACS), CheckoutMode.PARTIAL)
+        projects._set_job_type(JobType.NIGHTLY)
+        self.assertEqual(projects._get_checkout_mode(Project.GROMACS), CheckoutMode.FULL)
+
     def test_GetBuildRevisions(self):
         commits = RepositoryTestState()
         commits.set_commit(Project.GROMACS, change_number=1234)
@@ -420,6 +466,18 @@ class TestStatusReporterJson(unittest.TestCase):
                 'reason': None
             })
 
+    def test_SuccessWithNote(self):
+        with self.helper.factory.status_reporter as status_reporter:
+            status_reporter.add_note('Skipped tests')
+        self.helper.assertConsoleOutput("""\
+                NOTE: Skipped tests
+                """)
+        self.helper.assertOutputJsonFile('ws/logs/status.json', {
+                'result': 'SUCCESS',
+                'reason': None,
+                'notes': ['Skipped tests']
+            })
+
     def test_Failure(self):
         with self.helper.factory.status_reporter as status_reporter:
             status_reporter.mark_failed('Failure reason')
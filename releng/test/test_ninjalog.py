@@ -0,0 +1,50 @@
+import textwrap
+import unittest
+
+from releng.ninjalog import parse_ninja_log, write_build_time_report
+
+from releng.test.utils import TestHelper
+
+_NINJA_LOG = """\
+# ninja log v5
+0\t1500\t0\tsrc/CMakeFiles/lib.dir/old.cpp.o\t1111
+1500\t2000\t0\tlib/libold.so\t2222
+100\t1000\t0\tsrc/CMakeFiles/lib.dir/b.cpp.o\tbbbb
+0\t3000\t0\tsrc/CMakeFiles/lib.dir/a.cpp.o\taaaa
+3000\t7500\t0\tlib/libgromacs.so.4.0.0\tcccc
+3000\t7500\t0\tlib/libgromacs.so.4\tcccc
+7500\t7600\t0\tsrc/CMakeFiles/version-info\teeee
+7500\t8000\t0\tbin/gmx\tdddd
+"""
+
+class TestNinjaLog(unittest.TestCase):
+    def test_ParseLatestBuild(self):
+        steps = parse_ninja_log(textwrap.dedent(_NINJA_LOG).splitlines(True))
+        self.assertEqual([(x.output, round(x.duration, 3)) for x in steps], [
+                ('src/CMakeFiles/lib.dir/b.cpp.o', 0.9),
+                ('src/CMakeFiles/lib.dir/a.cpp.o', 3.0),
+                ('lib/libgromacs.so.4.0.0', 4.5),
+                ('src/CMakeFiles/version-info', 0.1),
+                ('bin/gmx', 0.5)
+            ])
+
+    def test_Report(self):
+        helper = TestHelper(self)
+        steps = parse_ninja_log(textwrap.dedent(_NINJA_LOG).splitlines(True))
+        write_build_time_report(helper.executor, 'report.log', None, steps)
+        helper.assertOutputFile('report.log', """\
+                Build of all: 5 steps in 8.0 s
+                  compile: 2 steps, 3.9 s in total
+                  link: 2 steps, 5.0 s in total
+
+                Slowest compile steps:
+                     3.0 s  src/CMakeFiles/lib.dir/a.cpp.o
+                     0.9 s  src/CMakeFiles/lib.dir/b.cpp.o
+
+                Slowest link steps:
+                     4.5 s  lib/libgromacs.so.4.0.0
+                     0.5 s  bin/gmx
+                """)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,14 @@
 import unittest
+# With Python 2.7, this needs to be separately installed.
+# With Python 3.3 and up, this should change to unittest.mock.
+import mock
 
 from releng.test.utils import TestHelper
 
-from releng.common import Enum, Simd
-from releng.options import OptionTypes
-from releng.options import process_build_options
+from releng.common import ConfigurationError, Enum, Simd
+from releng.options import BuildConfig, OptionLabelResolver, OptionTypes
+from releng.options import estimate_build_cost, process_build_options, select_build_hosts
+from releng.resources import HostResources
 from releng.script import BuildScriptSettings
 
 class TestProcessBuildOptions(unittest.TestCase):
@@ -16,6 +20,9 @@ class TestProcessBuildOptions(unittest.TestCase):
         e, o = process_build_options(self.helper.factory, None, self.settings)
         self.assertIs(o.gcc, None)
         self.assertIs(o.tsan, None)
+        self.assertEqual(e._build_jobs, 2)
+        self.assertIn('Building with -j2 (4 CPUs, 2 executors on the agent)',
+                self.helper._console.getvalue())
 
     def test_BasicOptions(self):
         opts = ['gcc-4.8', 'build-jobs=3', 'simd=reference', 'x11']
@@ -24,9 +31,63 @@ class TestProcessBuildOptions(unittest.TestCase):
         self.assertEqual(o.gcc, '4.8')
         self.assertEqual(o.build_jobs, 3)
         self.assertEqual(o['build-jobs'], 3)
+        self.assertEqual(e._build_jobs, 3)
+        self.assertFalse(self.helper.executor.get_host_resources.called)
         self.assertEqual(o.simd, Simd.REFERENCE)
         self.assertEqual(o.x11, True)
 
+    def test_MemoryLimitedJobs(self):
+        gib = 1024 ** 3
+        self.helper.executor.get_host_resources.return_value = \
+                HostResources(cpu_count=16, available_memory=20 * gib)
+        opts = ['gcc-5', 'cuda-9.0', 'cmake-3.13.4', 'ninja']
+        e, o = process_build_options(self.helper.factory, opts, self.settings)
+        self.assertEqual(e._build_jobs, 8)
+        pool_options = e._get_job_pool_options()
+        self.assertEqual(pool_options['CMAKE_JOB_POOLS'], 'compile=8;link=4')
+        self.assertEqual(pool_options['CMAKE_JOB_POOL_LINK'], 'link')
+        e._add_build_peak_memory(3 * gib)
+        e._add_build_peak_memory(4 * gib)
+        e._add_build_peak_memory(None)
+        e._record_peak_memory()
+        e, o = process_build_options(self.helper.factory, opts, self.settings)
+        self.assertEqual(e._build_jobs, 8)
+        self.assertEqual(e._get_job_pool_options()['CMAKE_JOB_POOLS'], 'compile=8;link=2')
+
+    def test_JobPoolsRequireNinjaAndCmake311(self):
+        self.helper.executor.get_host_resources.return_value = \
+                HostResources(cpu_count=16, available_memory=20 * 1024 ** 3)
+        e, o = process_build_options(self.helper.factory, ['gcc-5', 'cuda-9.0', 'cmake-3.13.4'],
+                self.settings)
+        self.assertEqual(e._get_job_pool_options(), dict())
+        e, o = process_build_options(self.helper.factory, ['gcc-5', 'cuda-9.0', 'cmake-3.9.6', 'ninja'],
+                self.settings)
+        self.assertEqual(e._get_job_pool_options(), dict())
+        self.assertIn('Not limiting link jobs: job pools require CMake 3.11',
+                self.helper._console.getvalue())
+
+    def test_SanitizerMemory(self):
+        self.helper.executor.get_host_resources.return_value = \
+                HostResources(cpu_count=16, available_memory=20 * 1024 ** 3)
+        e, o = process_build_options(self.helper.factory, ['clang-6', 'tsan'], self.settings)
+        self.assertIn('tsan', e._get_toolchains())
+        self.assertEqual(e._build_jobs, 6)
+        self.assertEqual(e._link_jobs, 1)
+
+    def test_SimilarNames(self):
+        opts = ['clang-static-analyzer-3.8', 'clang-3.8', 'mpi', 'gpuhw=NVIDIA']
+        e, o = process_build_options(self.helper.factory, opts, self.settings)
+        self.assertEqual(o.clang, '3.8')
+        self.assertEqual(o.clang_static_analyzer, '3.8')
+        self.assertIs(o.mpi, True)
+        self.assertEqual(o.gpuhw, 'nvidia')
+
+    def test_InvalidOptions(self):
+        with self.assertRaisesRegexp(ConfigurationError, 'conflicting options found: gcc-4.8 gcc-5'):
+            process_build_options(self.helper.factory, ['gcc-4.8', 'x11', 'gcc-5'], self.settings)
+        with self.assertRaisesRegexp(ConfigurationError, 'unknown options: gcc-4.x foo'):
+            process_build_options(self.helper.factory, ['gcc-4.x', 'x11', 'foo'], self.settings)
+
     def test_ExtraOptions(self):
         TestEnum = Enum.create('TestEnum', 'foo', 'bar')
         self.settings.extra_options = {
@@ -41,3 +102,42 @@ class TestProcessBuildOptions(unittest.TestCase):
         self.assertEqual(o.ex_bool, True)
         self.assertEqual(o.ex_string, 'foo')
         self.assertEqual(o.ex_enum, TestEnum.BAR)
+
+class TestOptionLabelResolver(unittest.TestCase):
+    def test_BuildCost(self):
+        self.assertEqual(estimate_build_cost(['gcc-5', 'mpi']), 1.0)
+        self.assertEqual(estimate_build_cost(['clang-6', 'TSAN', 'cuda-9.0']), 4.5)
+
+    def test_Labels(self):
+        resolver = OptionLabelResolver()
+        opts = ['gcc-4.8', 'cuda-9.0', 'simd=avx2_256', 'simd=reference',
+                'gpuhw=nvidia', 'no-opencl', 'mpi', 'build-jobs=3', 'unknown']
+        labels = resolver.get_labels(opts)
+        self.assertEqual(labels, set(['gcc-4.8', 'cuda-9.0', 'avx2_256', 'nvidia', 'mpi']))
+        self.assertEqual(resolver.get_labels(opts), labels)
+
+    @mock.patch('releng.options.BuildEnvironment')
+    def test_SelectHostsWithoutEnvironment(self, environment):
+        helper = TestHelper(self)
+        configs = select_build_hosts(helper.factory, [BuildConfig(['gcc-4.6', 'gpuhw=nvidia', 'cuda-5.0'])])
+        self.assertFalse(environment.called)
+        self.assertEqual(configs[0].host, 'bs_nix1310')
+        self.assertEqual(sorted(configs[0].labels), ['cuda-5.0', 'gcc-4.6', 'nvidia'])
+
+    def test_SelectHostsBalancesLoad(self):
+        helper = TestHelper(self)
+        opts = ['gcc-4.8 cuda-8.0', 'gcc-4.8 cuda-8.0', 'gcc-4.8 cuda-8.0 asan',
+                'msvc-2015', 'gcc-5', 'gcc-5']
+        configs = select_build_hosts(helper.factory, [BuildConfig(x.split()) for x in opts])
+        self.assertEqual([x.host for x in configs],
+                ['bs_nix1204', 'bs_nix1204', 'bs_nix1310',
+                    'bs-win2012r2', 'bs_nix-amd', 'bs_mic'])
+
+    def test_SelectHostsWithLabelExpression(self):
+        helper = TestHelper(self)
+        configs = select_build_hosts(helper.factory, [
+                BuildConfig(['gcc-4.8', 'cuda-8.0', 'label=!bs_nix1310']),
+                BuildConfig(['gcc-5', 'label=bs_mic || bs_gpu01', 'label=!bs_mic'])
+            ])
+        self.assertEqual([x.host for x in configs], ['bs_nix1204', 'bs_gpu01'])
+        self.assertEqual(configs[0].opts, ['gcc-4.8', 'cuda-8.0'])
@@ -0,0 +1,109 @@
+import sqlite3
+import unittest
+# With Python 2.7, this needs to be separately installed.
+# With Python 3.3 and up, this should change to unittest.mock.
+import mock
+
+from releng.resources import HostResources, MemoryUsageStore, estimate_job_memory
+from releng.resources import _get_available_memory, _parse_cpu_max, _parse_meminfo
+
+_GIB = 1024 ** 3
+
+class TestChooseBuildJobs(unittest.TestCase):
+    def test_SharedByExecutors(self):
+        jobs, reasons = HostResources(cpu_count=16).choose_build_jobs(2)
+        self.assertEqual(jobs, 8)
+        self.assertEqual(reasons, ['16 CPUs', '2 executors on the agent'])
+
+    def test_CpuQuota(self):
+        jobs, reasons = HostResources(cpu_count=32, cpu_quota=5.5).choose_build_jobs(1)
+        self.assertEqual(jobs, 6)
+        self.assertEqual(reasons, ['32 CPUs', 'CPU quota of 5.5 CPUs'])
+
+    def test_Load(self):
+        resources = HostResources(cpu_count=16, load_average=11.0)
+        self.assertEqual(resources.choose_build_jobs(2), (5, ['16 CPUs',
+            '2 executors on the agent', 'load average 11.0']))
+        resources.load_average = 30.0
+        self.assertEqual(resources.choose_build_jobs(2)[0], 4)
+        resources.load_average = 4.0
+        self.assertEqual(resources.choose_build_jobs(2)[0], 8)
+
+    def test_Memory(self):
+        resources = HostResources(cpu_count=16, available_memory=3 * _GIB + 100)
+        jobs, reasons = resources.choose_build_jobs(1)
+        self.assertEqual(jobs, 3)
+        self.assertEqual(reasons[-1], '3.0 GiB of available memory (1.0 GiB per job)')
+        resources.available_memory = 100
+        self.assertEqual(resources.choose_build_jobs(1)[0], 1)
+
+    def test_Unknown(self):
+        self.assertEqual(HostResources().choose_build_jobs(2)[0], None)
+
+class TestJobMemory(unittest.TestCase):
+    def test_Estimates(self):
+        self.assertEqual(estimate_job_memory([]), (_GIB, 2 * _GIB))
+        self.assertEqual(estimate_job_memory(['gcc', 'cuda']), (2 * _GIB, 3 * _GIB))
+        self.assertEqual(estimate_job_memory(['icc'], peak=5 * _GIB), (1.5 * _GIB, 5 * _GIB))
+        self.assertEqual(estimate_job_memory(['icc'], peak=_GIB // 2), (_GIB // 2, _GIB // 2))
+        self.assertEqual(estimate_job_memory(['clang', 'tsan']), (3 * _GIB, 6 * _GIB))
+
+    def test_LinkJobs(self):
+        resources = HostResources(cpu_count=16, available_memory=20 * _GIB)
+        self.assertEqual(resources.choose_link_jobs(8, 2 * _GIB, 3 * _GIB), 4)
+        self.assertEqual(resources.choose_link_jobs(2, 2 * _GIB, 3 * _GIB), 2)
+        self.assertEqual(resources.choose_link_jobs(8, 2 * _GIB, 20 * _GIB), 1)
+        self.assertEqual(resources.choose_link_jobs(8, 3 * _GIB, 2 * _GIB), 8)
+        self.assertEqual(HostResources(cpu_count=16).choose_link_jobs(8, _GIB, 3 * _GIB), 8)
+
+    def test_Store(self):
+        store = MemoryUsageStore(sqlite3.connect(':memory:'))
+        self.assertIs(store.get_peak('gcc-5'), None)
+        store.record('gcc-5', 1000)
+        store.record('gcc-5', 3000)
+        self.assertEqual(store.get_peak('gcc-5'), 3000)
+        store.record('gcc-5', 2000)
+        self.assertEqual(store.get_peak('gcc-5'), 2666)
+        self.assertIs(store.get_peak('gcc-7'), None)
+
+class TestProbeParsing(unittest.TestCase):
+    def test_CpuMax(self):
+        self.assertEqual(_parse_cpu_max('max 100000\n'), None)
+        self.assertEqual(_parse_cpu_max('-1 100000'), None)
+        self.assertEqual(_parse_cpu_max('250000 100000\n'), 2.5)
+        self.assertEqual(_parse_cpu_max('garbage'), None)
+
+    def test_Meminfo(self):
+        self.assertEqual(_parse_meminfo('MemTotal: 100 kB\nMemFree: 10 kB\nMemAvailable: 40 kB\n'), 40 * 1024)
+        self.assertEqual(_parse_meminfo('MemFree: 10 kB\nBuffers: 1 kB\nCached: 20 kB\n'), 31 * 1024)
+        self.assertEqual(_parse_meminfo(''), None)
+
+    def _get_available_memory(self, files):
+        with mock.patch('releng.resources._read_text', side_effect=files.get):
+            return _get_available_memory()
+
+    def test_Cgroup2MemoryExcludesPageCache(self):
+        self.assertEqual(self._get_available_memory({
+                '/proc/meminfo': 'MemAvailable: {0} kB\n'.format(64 * 1024 * 1024),
+                '/sys/fs/cgroup/memory.max': str(8 * _GIB) + '\n',
+                '/sys/fs/cgroup/memory.current': str(7 * _GIB) + '\n',
+                '/sys/fs/cgroup/memory.stat': 'anon {0}\nfile {1}\ninactive_file {2}\n'.format(
+                    _GIB, 6 * _GIB, 5 * _GIB)
+            }), 6 * _GIB)
+
+    def test_Cgroup1MemoryExcludesPageCache(self):
+        self.assertEqual(self._get_available_memory({
+                '/sys/fs/cgroup/memory/memory.limit_in_bytes': str(8 * _GIB) + '\n',
+                '/sys/fs/cgroup/memory/memory.usage_in_bytes': str(7 * _GIB) + '\n',
+                '/sys/fs/cgroup/memory/memory.stat': 'cache {0}\ninactive_file 0\ntotal_inactive_file {1}\n'.format(
+                    6 * _GIB, 5 * _GIB)
+            }), 6 * _GIB)
+
+    def test_CgroupMemoryWithoutStat(self):
+        self.assertEqual(self._get_available_memory({
+                '/sys/fs/cgroup/memory.max': str(8 * _GIB) + '\n',
+                '/sys/fs/cgroup/memory.current': str(7 * _GIB) + '\n'
+            }), _GIB)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import json
+import os.path
+import shutil
+import tempfile
+import textwrap
+import unittest
+# With Python 2.7, this needs to be separately installed.
+# With Python 3.3 and up, this should change to unittest.mock.
+import mock
+
+from releng.common import CommandError, Project
+from releng.factory import ContextFactory
+from releng.testimpact import find_affected_objects, get_test_regex, has_test_filter, select_tests
+
+class TestSelectTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmpdir, 'gromacs')
+        self.build_dir = os.path.join(self.tmpdir, 'build')
+        self._write('build/src/gromacs/mdlib/tests/CTestTestfile.cmake', """\
+                add_test(MdlibUnitTest "{0}/bin/mdlib-test" "--gtest_output=xml")
+                """.format(self.build_dir))
+        self._write('build/src/gromacs/fft/tests/CTestTestfile.cmake', """\
+                add_test([=[FFTUnitTests]=] "{0}/bin/fft-test")
+                """.format(self.build_dir))
+        commands = []
+        for target, subdir, source in (
+                ('libgromacs', 'src/gromacs', 'src/gromacs/mdlib/update.cpp'),
+                ('mdlib-test', 'src/gromacs/mdlib/tests', 'src/gromacs/mdlib/tests/update.cpp'),
+                ('fft-test', 'src/gromacs/fft/tests', 'src/gromacs/fft/tests/fft.cpp')):
+            commands.append({
+                    'directory': os.path.join(self.build_dir, subdir),
+                    'command': 'c++ -o CMakeFiles/{0}.dir/x.cpp.o -c {1}'.format(target,
+                        os.path.join(self.source_dir, source)),
+                    'file': os.path.join(self.source_dir, source)
+                })
+        self._write('build/compile_commands.json', json.dumps(commands))
+        self._write('build/src/gromacs/mdlib/tests/CMakeFiles/mdlib-test.dir/depend.make', """\
+                src/gromacs/mdlib/tests/CMakeFiles/mdlib-test.dir/x.cpp.o: {0}/src/testutils/refdata.h
+                """.format(self.source_dir))
+        factory = ContextFactory(default_project=Project.GROMACS, system='Linux',
+                env={ 'WORKSPACE': self.tmpdir })
+        self.executor = factory.executor
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, path, contents):
+        path = os.path.join(self.tmpdir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write(textwrap.dedent(contents))
+
+    def _select(self, changed_files):
+        return select_tests(None, self.executor, self.source_dir, self.build_dir, changed_files)
+
+    def test_TestOnlyChange(self):
+        selection = self._select(['src/gromacs/mdlib/tests/update.cpp', 'docs/index.rst'])
+        self.assertEqual(selection.tests, ['MdlibUnitTest'])
+        self.assertEqual(selection.skipped, ['FFTUnitTests'])
+
+    def test_HeaderAndReferenceData(self):
+        selection = self._select(['src/testutils/refdata.h',
+            'src/gromacs/fft/tests/refdata/FFTTest_Real.xml'])
+        self.assertEqual(selection.tests, ['FFTUnitTests', 'MdlibUnitTest'])
+        self.assertEqual(selection.skipped, [])
+
+    def test_LibraryChangeRunsAll(self):
+        selection = self._select(['src/gromacs/mdlib/tests/update.cpp', 'src/gromacs/mdlib/update.cpp'])
+        self.assertIs(selection.tests, None)
+
+    def test_BuildSystemChangeRunsAll(self):
+        selection = self._select(['src/gromacs/mdlib/tests/CMakeLists.txt'])
+        self.assertIs(selection.tests, None)
+        self.assertIn('build system', selection.reason)
+
+    def test_UnknownFileRunsAll(self):
+        selection = self._select(['admin/script.sh'])
+        self.assertIs(selection.tests, None)
+
+    def test_InvalidCompileCommandsRunsAll(self):
+        self._write('build/compile_commands.json', '[{')
+        selection = self._select(['src/gromacs/mdlib/tests/update.cpp'])
+        self.assertIs(selection.tests, None)
+        self.assertIn('could not read dependencies', selection.reason)
+
+    def test_NinjaFailureRunsAll(self):
+        self._write('build/build.ninja', '')
+        cmd_runner = mock.Mock()
+        cmd_runner.check_output.side_effect = CommandError('ninja -t deps')
+        selection = select_tests(cmd_runner, self.executor, self.source_dir, self.build_dir,
+                ['src/gromacs/mdlib/tests/update.cpp'])
+        self.assertIs(selection.tests, None)
+        self.assertIn('could not read dependencies', selection.reason)
+
+    def test_AffectedObjects(self):
+        objects = find_affected_objects(None, self.executor, self.source_dir, self.build_dir,
+                ['src/testutils/refdata.h', 'src/gromacs/fft/tests/fft.cpp'])
+        self.assertEqual(objects, [
+                os.path.join(self.build_dir, 'src/gromacs/fft/tests/CMakeFiles/fft-test.dir/x.cpp.o'),
+                os.path.join(self.build_dir, 'src/gromacs/mdlib/tests/CMakeFiles/mdlib-test.dir/x.cpp.o')
+            ])
+
+    def test_CompilerDependMakeWithPhonyRules(self):
+        self._write('build/src/gromacs/fft/tests/CMakeFiles/fft-test.dir/compiler_depend.make', """\
+                # CMAKE generated file: DO NOT EDIT!
+                # Generated by "Unix Makefiles" Generator, CMake Version 3.20
+
+                src/gromacs/fft/tests/CMakeFiles/fft-test.dir/x.cpp.o: {0}/src/gromacs/fft/tests/fft.cpp \\
+                  {0}/src/gromacs/fft/fft.h \\
+                  {0}/src/testutils/testasserts.h
+
+                {0}/src/gromacs/fft/fft.h:
+
+                {0}/src/testutils/testasserts.h:
+                """.format(self.source_dir))
+        selection = self._select(['src/testutils/testasserts.h'])
+        self.assertEqual(selection.tests, ['FFTUnitTests'])
+        selection = self._select(['src/gromacs/fft/fft.h'])
+        self.assertEqual(selection.tests, ['FFTUnitTests'])
+
+    def test_Regex(self):
+        self.assertEqual(get_test_regex(['A', 'B.x']), r'^(A|B\.x)$')
+
+    def test_TestFilter(self):
+        self.assertFalse(has_test_filter(['--output-on-failure', '-j4']))
+        self.assertTrue(has_test_filter(['-R', 'Mdlib']))
+        self.assertTrue(has_test_filter(['-LE', 'Slow']))
+        self.assertTrue(has_test_filter(['--exclude-regex=Mdlib']))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import sqlite3
+import unittest
+
+from releng.cmake import CTestResult
+from releng.testtimes import TestTimingStore, write_cost_data
+
+from releng.test.utils import TestHelper
+
+class TestTestTimingStore(unittest.TestCase):
+    def setUp(self):
+        self.store = TestTimingStore(sqlite3.connect(':memory:'))
+
+    def test_AverageOverRuns(self):
+        self.store.record('master', 'gcc-7', [CTestResult('Slow', 10.0, True)])
+        self.store.record('master', 'gcc-7', [CTestResult('Slow', 20.0, False)])
+        self.assertEqual(self.store.get_history('master', 'gcc-7'),
+                [('Slow', 2, 15.0, True)])
+
+    def test_FallbackToOtherConfigs(self):
+        self.store.record('master', 'gcc-7', [CTestResult('A', 1.0, False), CTestResult('B', 4.0, True)])
+        self.store.record('master', 'clang-6', [CTestResult('A', 3.0, True)])
+        self.assertEqual(self.store.get_history('master', 'icc-18'),
+                [('A', 2, 2.0, False), ('B', 1, 4.0, False)])
+        self.assertEqual(self.store.get_history('release-2018', 'gcc-7'),
+                [('A', 2, 2.0, False), ('B', 1, 4.0, False)])
+
+class TestWriteCostData(unittest.TestCase):
+    def test_Format(self):
+        helper = TestHelper(self)
+        history = [('A', 2, 1.5, False), ('B', 1, 30.0, True)]
+        write_cost_data(helper.executor, 'CTestCostData.txt', history)
+        helper.assertOutputFile('CTestCostData.txt', """\
+                A 2 1.500000
+                B 1 30.000000
+                ---
+                B
+                """)
+
+if __name__ == '__main__':
+    unittest.main()
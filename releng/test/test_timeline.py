@@ -0,0 +1,51 @@
+import StringIO
+import textwrap
+import unittest
+
+from releng.timeline import Timeline
+
+class FakeClock(object):
+    def __init__(self, values):
+        self._values = iter(values)
+
+    def __call__(self):
+        return next(self._values)
+
+class TestTimeline(unittest.TestCase):
+    def setUp(self):
+        clock = FakeClock([100.0, 101.0, 102.0, 105.5, 110.0])
+        rusage = FakeClock([(1.0, 0.5, 1024), (1.0, 0.5, 1024),
+            (3.0, 1.0, 204800), (3.0, 1.0, 204800)])
+        self.timeline = Timeline(clock=clock, rusage=rusage)
+        with self.timeline.span('build_target', 'step', target='all'):
+            with self.timeline.span('make -j4') as span:
+                span.returncode = 2
+
+    def test_Trace(self):
+        events = self.timeline.to_trace()['traceEvents']
+        self.assertEqual(events[0]['ph'], 'M')
+        self.assertEqual(events[1], {
+                'name': 'make -j4', 'cat': 'cmd', 'ph': 'X',
+                'ts': 2000000, 'dur': 3500000, 'pid': 1, 'tid': 0,
+                'args': { 'returncode': 2, 'user_time': 2.0, 'sys_time': 0.5,
+                    'max_rss': 204800 }
+            })
+        self.assertEqual(events[2]['name'], 'build_target')
+        self.assertEqual(events[2]['ts'], 1000000)
+        self.assertEqual(events[2]['dur'], 9000000)
+        self.assertEqual(events[2]['args']['target'], 'all')
+
+    def test_Summary(self):
+        console = StringIO.StringIO()
+        self.timeline.print_summary(console)
+        self.assertEqual(console.getvalue(), textwrap.dedent("""\
+                Build timeline summary:
+                    wall(s)   user(s)    sys(s)   rss(MB)  exit  step/command
+                Build steps:
+                        9.0       2.0       0.5       200     -  build_target
+                Slowest commands:
+                        3.5       2.0       0.5       200     2  make -j4
+                """))
+
+if __name__ == '__main__':
+    unittest.main()
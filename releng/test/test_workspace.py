@@ -0,0 +1,207 @@
+import os.path
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+from releng.common import CheckoutMode, JobType, Project
+from releng.factory import ContextFactory
+from releng.integration import RefSpec
+from releng.workspace import Workspace
+
+from releng.test.utils import TestHelper
+
+def _git(cwd, *args):
+    cmd = ['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com']
+    cmd.extend(args)
+    return subprocess.check_output(cmd, cwd=cwd).strip()
+
+class GitCheckoutTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.upstream = os.path.join(self.tmpdir, 'upstream')
+        os.makedirs(self.upstream)
+        _git(self.upstream, 'init', '-q')
+        with open(os.path.join(self.upstream, 'file.txt'), 'w') as fp:
+            fp.write('contents\n')
+        _git(self.upstream, 'add', 'file.txt')
+        _git(self.upstream, 'commit', '-q', '-m', 'Initial')
+        _git(self.upstream, 'branch', '-f', 'main')
+        _git(self.upstream, 'config', 'uploadpack.allowFilter', 'true')
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _add_commit(self, contents):
+        with open(os.path.join(self.upstream, 'file.txt'), 'w') as fp:
+            fp.write(contents)
+        _git(self.upstream, 'commit', '-q', '-a', '-m', 'Change')
+        _git(self.upstream, 'branch', '-f', 'main')
+        return _git(self.upstream, 'rev-parse', 'HEAD')
+
+    def _create_workspace(self, workspace_name, env=None):
+        full_env = {
+                'PATH': os.environ['PATH'],
+                'HOME': self.tmpdir,
+                'WORKSPACE': os.path.join(self.tmpdir, workspace_name),
+                'RELENG_CACHE_DIR': self.cache_dir
+            }
+        if env:
+            full_env.update(env)
+        factory = ContextFactory(default_project=Project.GROMACS, system='Linux', env=full_env)
+        factory.gerrit.get_git_url = lambda project: 'file://' + self.upstream
+        return Workspace(factory)
+
+    def _checkout(self, workspace_name, env=None, checkout_mode=CheckoutMode.FULL, remote_hash=None):
+        workspace = self._create_workspace(workspace_name, env)
+        refspec = RefSpec('refs/heads/main', remote_hash)
+        workspace._checkout_project(Project.GROMACS, refspec, checkout_mode)
+        self.workspace = workspace
+        return workspace.get_project_dir(Project.GROMACS)
+
+class TestGitMirror(GitCheckoutTestCase):
+    def test_CheckoutThroughMirror(self):
+        head = _git(self.upstream, 'rev-parse', 'HEAD')
+        for workspace_name in ('ws1', 'ws2'):
+            project_dir = self._checkout(workspace_name)
+            self.assertEqual(_git(project_dir, 'rev-parse', 'HEAD'), head)
+            self.assertTrue(os.path.isfile(os.path.join(project_dir, 'file.txt')))
+        mirror_dir = os.path.join(self.cache_dir, 'git', 'gromacs.git')
+        self.assertEqual(_git(mirror_dir, 'rev-parse', 'refs/releng/heads/main'), head)
+        alternates_path = os.path.join(project_dir, '.git', 'objects', 'info', 'alternates')
+        with open(alternates_path) as fp:
+            self.assertEqual(fp.read().strip(), os.path.join(mirror_dir, 'objects'))
+
+    def test_MirrorRemoved(self):
+        self._checkout('ws')
+        shutil.rmtree(self.cache_dir)
+        head = self._add_commit('changed\n')
+        project_dir = self._checkout('ws')
+        self.assertEqual(_git(project_dir, 'rev-parse', 'HEAD'), head)
+        _git(project_dir, 'fsck', '--no-progress')
+
+class TestCheckoutModes(GitCheckoutTestCase):
+    def setUp(self):
+        GitCheckoutTestCase.setUp(self)
+        self.first = _git(self.upstream, 'rev-parse', 'HEAD')
+        self.head = self._add_commit('changed\n')
+        self.env = { 'RELENG_DISABLE_GIT_MIRRORS': '1' }
+
+    def _is_shallow(self, project_dir):
+        return _git(project_dir, 'rev-parse', '--is-shallow-repository') == 'true'
+
+    def test_Shallow(self):
+        project_dir = self._checkout('ws', self.env, CheckoutMode.SHALLOW)
+        self.assertEqual(_git(project_dir, 'rev-parse', 'HEAD'), self.head)
+        self.assertTrue(self._is_shallow(project_dir))
+        self.workspace.ensure_full_history(Project.GROMACS)
+        self.assertFalse(self._is_shallow(project_dir))
+        self.assertEqual(_git(project_dir, 'rev-list', '--count', 'HEAD'), '2')
+
+    def test_ShallowWithOlderHash(self):
+        project_dir = self._checkout('ws', self.env, CheckoutMode.SHALLOW, remote_hash=self.first)
+        self.assertEqual(_git(project_dir, 'rev-parse', 'HEAD'), self.first)
+        self.assertFalse(self._is_shallow(project_dir))
+
+    def test_FullAfterShallow(self):
+        self._checkout('ws', self.env, CheckoutMode.SHALLOW)
+        project_dir = self._checkout('ws', self.env, CheckoutMode.FULL)
+        self.assertFalse(self._is_shallow(project_dir))
+
+    def test_Partial(self):
+        project_dir = self._checkout('ws', self.env, CheckoutMode.PARTIAL)
+        self.assertEqual(_git(project_dir, 'rev-parse', 'HEAD'), self.head)
+        self.assertEqual(_git(project_dir, 'rev-list', '--count', 'HEAD'), '2')
+        self.assertEqual(_git(project_dir, 'rev-list', '--objects', '--missing=print', 'HEAD').count('?'), 1)
+
+class TestTarballCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.org_cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        source_dir = os.path.join(self.tmpdir, 'gromacs-2018')
+        os.makedirs(os.path.join(source_dir, 'src'))
+        with open(os.path.join(source_dir, 'src', 'file.txt'), 'w') as fp:
+            fp.write('original\n')
+        tarball_dir = os.path.join(self.tmpdir, 'tarballs', 'gromacs')
+        os.makedirs(tarball_dir)
+        with tarfile.open(os.path.join(tarball_dir, 'gromacs-2018.tar.gz'), 'w:gz') as tar:
+            tar.add(source_dir, 'gromacs-2018')
+        shutil.rmtree(source_dir)
+        with open(os.path.join(tarball_dir, 'package-info.log'), 'w') as fp:
+            fp.write('HEAD_HASH = 1234abcd\nMD5SUM = 0123456789abcdef\n'
+                    'PACKAGE_FILE_NAME = gromacs-2018.tar.gz\nPACKAGE_VERSION = 2018\n')
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        os.chdir(self.org_cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def _checkout(self, workspace_name):
+        env = {
+                'PATH': os.environ['PATH'],
+                'WORKSPACE': os.path.join(self.tmpdir, workspace_name),
+                'RELENG_CACHE_DIR': self.cache_dir
+            }
+        factory = ContextFactory(default_project=Project.GROMACS, system='Linux', env=env)
+        os.makedirs(env['WORKSPACE'])
+        workspace = Workspace(factory)
+        refspec = RefSpec('tarballs/gromacs', executor=factory.executor)
+        workspace._checkout_project(Project.GROMACS, refspec)
+        return factory, workspace.get_project_dir(Project.GROMACS)
+
+    def test_ReuseExtractedTree(self):
+        factory, project_dir1 = self._checkout('ws1')
+        factory, project_dir2 = self._checkout('ws2')
+        path1 = os.path.join(project_dir1, 'src', 'file.txt')
+        path2 = os.path.join(project_dir2, 'src', 'file.txt')
+        entries = os.listdir(os.path.join(self.cache_dir, 'tarballs'))
+        self.assertEqual(len(entries), 2)
+        self.assertIn('cache.lock', entries)
+        with open(path2, 'r+') as fp:
+            fp.write('modified\n')
+        with open(path1) as fp:
+            self.assertEqual(fp.read(), 'original\n')
+        with open(path2) as fp:
+            self.assertEqual(fp.read(), 'modified\n')
+        factory, project_dir3 = self._checkout('ws3')
+        with open(os.path.join(project_dir3, 'src', 'file.txt')) as fp:
+            self.assertEqual(fp.read(), 'original\n')
+
+class TestGitMaintenance(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, workspace='/ws')
+        self.workspace = self.helper.factory.workspace
+
+    def _set_counts(self, count, packs):
+        output = 'count: {0}\nsize: 10\nin-pack: 100\npacks: {1}\nsize-pack: 10\n'
+        self.helper.executor.check_output.side_effect = \
+                lambda cmd, **kwargs: output.format(count, packs)
+
+    def test_NoMaintenanceNeeded(self):
+        self._set_counts(100, 2)
+        self.workspace._check_git_maintenance('/ws/gromacs')
+        with self.helper.factory.status_reporter:
+            pass
+        self.assertFalse(self.helper.executor.spawn_detached.called)
+
+    def test_TooManyLooseObjects(self):
+        self._set_counts(7000, 2)
+        self.workspace._check_git_maintenance('/ws/gromacs')
+        self.assertFalse(self.helper.executor.spawn_detached.called)
+        with self.helper.factory.status_reporter:
+            pass
+        self.helper.executor.spawn_detached.assert_called_once_with(
+                ['git', 'gc', '--quiet'], cwd='/ws/gromacs')
+
+    def test_TooManyPacks(self):
+        self._set_counts(0, 50)
+        self.workspace._check_git_maintenance('/ws/releng')
+        self.workspace._run_deferred_maintenance()
+        self.helper.executor.spawn_detached.assert_called_once_with(
+                ['git', 'gc', '--quiet'], cwd='/ws/releng')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 import json
 import os.path
+import sqlite3
 from StringIO import StringIO
 import textwrap
 import urlparse
@@ -10,6 +11,7 @@ import mock
 from releng.common import CommandError, Project
 from releng.executor import Executor
 from releng.factory import ContextFactory
+from releng.resources import HostResources
 
 class CommitInfo(object):
     def __init__(self, project, refspec, sha1, branch, change_number, patch_number):
@@ -111,6 +113,9 @@ class TestHelper(object):
         self.executor.check_output.side_effect = self._check_output
         self.executor.read_file.side_effect = self._read_file
         self.executor.write_file.side_effect = self._write_file
+        self.executor.connect_database.side_effect = self._connect_database
+        self.executor.get_host_resources.return_value = HostResources(cpu_count=4)
+        self.executor.get_last_command_peak_memory.return_value = None
         self.reset_console_output()
 
         if env is None:
@@ -135,6 +140,7 @@ class TestHelper(object):
             self.reset_console_output()
         self._input_files = dict()
         self._output_files = dict()
+        self._databases = dict()
 
     def reset_console_output(self):
         self._console = StringIO()
@@ -150,6 +156,10 @@ class TestHelper(object):
             if not commit:
                 raise CommandError('commit not found: ' + cmd[4])
             return '{0} {1}\n'.format(commit.sha1, commit.title)
+        elif cmd[:2] == ['git', 'count-objects']:
+            return 'count: 0\nsize: 0\nin-pack: 0\npacks: 0\nsize-pack: 0\n'
+        elif cmd == ['ccache', '--print-stats']:
+            return 'stats_updated_timestamp\t1500000000\ndirect_cache_hit\t0\ncache_miss\t0\n'
         elif cmd[:2] == ['git', 'ls-remote']:
             git_url = urlparse.urlsplit(cmd[2])
             project = Project.parse(os.path.splitext(git_url.path[1:])[0])
@@ -177,14 +187,21 @@ class TestHelper(object):
             return json.dumps(data) + '\nstats'
         return None
 
-    def _read_file(self, path):
+    def _read_file(self, path, binary=False):
         if path not in self._input_files:
             raise IOError(path + ': not part of test')
         return self._input_files[path]
 
     def _write_file(self, path, contents):
+        if not isinstance(contents, basestring):
+            contents = ''.join(contents)
         self._output_files[path] = contents
 
+    def _connect_database(self, path):
+        if path not in self._databases:
+            self._databases[path] = sqlite3.connect(':memory:')
+        return self._databases[path]
+
     def add_input_file(self, path, contents):
         lines = textwrap.dedent(contents).splitlines(True)
         self._input_files[path] = lines
@@ -0,0 +1,299 @@
+"""
+Selection of tests affected by a change
+
+For per-patchset (Gerrit) builds, running only the tests that can be affected
+by the files changed in the patchset saves a lot of time on most changes.
+The selection uses the dependency information from the build system:
+
+ - Tests are found from the :file:`CTestTestfile.cmake` files in the build
+   tree.  The basename of the test command identifies the test binary, which
+   is also the name of the CMake target that builds it.
+ - Each object file is mapped to the sources and headers it depends on
+   (from :file:`compile_commands.json`, ``ninja -t deps``, and the
+   :file:`depend.make` files from the Makefile generators), and to the
+   target that it belongs to (from the :file:`CMakeFiles/{target}.dir/`
+   path).
+
+A changed file selects the tests whose binaries compile it, and the tests in
+the corresponding source directory (e.g., for reference data).  The selection
+errs on the side of running too much: the full suite is run if the change
+touches the build system, any file compiled into something else than a test
+binary (e.g., the library that all the tests link to), or any file that the
+build system does not know about.  Changes only under :file:`docs/` do not
+select any tests.  If the dependency information cannot be read, or the CTest
+arguments of the build script already select tests (see has_test_filter()),
+all tests are run.
+
+The same dependency information also provides the object files affected by a
+change (see find_affected_objects()), which limits the coverage data that
+needs to be processed for differential coverage.
+"""
+
+import collections
+import json
+import os
+import re
+
+from common import CommandError
+
+class TestSelection(object):
+    """Result of test impact analysis.
+
+    Attributes:
+        tests (List[str] or None): Names of the tests to run, or ``None`` if
+            the full suite should be run.
+        skipped (List[str]): Names of the tests that do not need to be run.
+        reason (str): Explanation for the selection.
+    """
+
+    def __init__(self, tests, skipped, reason):
+        self.tests = tests
+        self.skipped = skipped
+        self.reason = reason
+
+_BUILD_SYSTEM_FILE_RE = re.compile(r'(^|/)(CMakeLists\.txt|[^/]*\.cmake(\.in)?|[^/]*\.cmakein)$|^cmake/')
+_NO_TEST_IMPACT_RE = re.compile(r'^docs/')
+_ADD_TEST_RE = re.compile(r'^\s*add_test\(\s*(?:\[(=*)\[(.*?)\]\1\]|"([^"]*)"|([^\s)]+))\s+'
+        r'(?:\[(=*)\[(.*?)\]\5\]|"([^"]*)"|([^\s)]+))')
+_MAKE_RULE_RE = re.compile(r'^(.+?):(?:\s+(.*)|$)')
+_OBJECT_TARGET_RE = re.compile(r'(?:^|/)CMakeFiles/([^/]+)\.dir/')
+
+# CTest options that select a subset of the tests.
+_CTEST_FILTER_OPTIONS = ('-R', '-E', '-L', '-LE', '-I', '--tests-regex',
+        '--exclude-regex', '--label-regex', '--label-exclude', '--tests-information')
+
+def select_tests(cmd_runner, executor, source_dir, build_dir, changed_files):
+    """Selects the tests affected by a set of changed files.
+
+    Args:
+        cmd_runner (CommandRunner): Runner for build system queries.
+        executor (Executor): Executor for reading files.
+        source_dir (str): Root of the source tree.
+        build_dir (str): Root of the (configured and built) build tree.
+        changed_files (List[str]): Changed files, relative to source_dir.
+
+    Returns:
+        TestSelection: Tests to run.
+    """
+    tests = _find_tests(executor, build_dir)
+    if not tests:
+        return TestSelection(None, [], 'no tests found in the build tree')
+    for path in changed_files:
+        if _BUILD_SYSTEM_FILE_RE.search(path):
+            return TestSelection(None, [], 'build system file changed: ' + path)
+    try:
+        dependencies = _read_dependencies(cmd_runner, executor, source_dir, build_dir)
+    except (CommandError, IOError, OSError, ValueError) as e:
+        return TestSelection(None, [], 'could not read dependencies: ' + str(e))
+    if not dependencies:
+        return TestSelection(None, [], 'no dependency information in the build tree')
+    binaries = collections.defaultdict(set)
+    for name, test_dir, binary in tests:
+        binaries[binary].add(name)
+    users = collections.defaultdict(set)
+    for target, deps in dependencies.iteritems():
+        for dep in deps:
+            users[dep].add(target)
+    selected = set()
+    for path in changed_files:
+        found = False
+        for target in users.get(path, ()):
+            if target not in binaries:
+                return TestSelection(None, [],
+                        '{0} is compiled into {1}, which is not a test binary'.format(path, target))
+            selected.update(binaries[target])
+            found = True
+        for name, test_dir, binary in tests:
+            if test_dir and (path + '/').startswith(test_dir + '/'):
+                selected.add(name)
+                found = True
+        if not found and not _NO_TEST_IMPACT_RE.search(path):
+            return TestSelection(None, [], 'not known to the build system: ' + path)
+    all_names = [name for name, test_dir, binary in tests]
+    skipped = sorted(set(all_names) - selected)
+    return TestSelection(sorted(selected), skipped,
+            'changes affect {0} of {1} tests'.format(len(selected), len(all_names)))
+
+def find_affected_objects(cmd_runner, executor, source_dir, build_dir, changed_files):
+    """Finds the object files that depend on any of a set of changed files.
+
+    Args:
+        cmd_runner (CommandRunner): Runner for build system queries.
+        executor (Executor): Executor for reading files.
+        source_dir (str): Root of the source tree.
+        build_dir (str): Root of the (configured and built) build tree.
+        changed_files (List[str]): Changed files, relative to source_dir.
+
+    Returns:
+        List[str] or None: Absolute paths to the affected object files, or
+            ``None`` if there is no dependency information in the build tree.
+
+    Raises:
+        CommandError: If querying the dependencies from Ninja fails.
+        IOError, OSError, ValueError: If a dependency file cannot be read
+            or parsed.
+    """
+    objects = _read_object_dependencies(cmd_runner, executor, build_dir)
+    if not objects:
+        return None
+    source_dir = os.path.normpath(source_dir)
+    changed = set(changed_files)
+    affected = []
+    for obj, deps in objects.iteritems():
+        for dep in deps:
+            if _get_source_path(dep, source_dir) in changed:
+                affected.append(os.path.normpath(obj))
+                break
+    return sorted(affected)
+
+def has_test_filter(ctest_args):
+    """Checks whether CTest arguments already select a subset of the tests.
+
+    Test selection is not combined with such arguments, since the
+    combination could easily run no tests at all.
+    """
+    for arg in ctest_args:
+        if arg in _CTEST_FILTER_OPTIONS or arg.split('=', 1)[0] in _CTEST_FILTER_OPTIONS:
+            return True
+    return False
+
+def get_test_regex(tests):
+    """Returns a regular expression for ``ctest -R`` that matches exactly the given tests."""
+    if not tests:
+        return '^$'
+    return '^({0})$'.format('|'.join([re.escape(x) for x in tests]))
+
+def _walk_build_tree(build_dir):
+    for dirpath, dirnames, filenames in os.walk(build_dir):
+        dirnames.sort()
+        yield dirpath, dirnames, filenames
+
+def _find_tests(executor, build_dir):
+    """Finds the tests from CTestTestfile.cmake files in a build tree.
+
+    Returns:
+        List[Tuple[str, str, str]]: Name of each test, the directory where it
+            is defined (relative to the build directory, which matches the
+            source directory relative to the source root), and the name of
+            the test binary.
+    """
+    tests = []
+    for dirpath, dirnames, filenames in _walk_build_tree(build_dir):
+        if 'CMakeFiles' in dirnames:
+            dirnames.remove('CMakeFiles')
+        if 'CTestTestfile.cmake' not in filenames:
+            continue
+        test_dir = os.path.relpath(dirpath, build_dir).replace(os.sep, '/')
+        if test_dir == '.':
+            test_dir = ''
+        for line in executor.read_file(os.path.join(dirpath, 'CTestTestfile.cmake')):
+            match = _ADD_TEST_RE.match(line)
+            if not match:
+                continue
+            name = match.group(2) or match.group(3) or match.group(4)
+            command = match.group(6) or match.group(7) or match.group(8)
+            binary = os.path.basename(command.replace('\\', '/'))
+            if binary.lower().endswith('.exe'):
+                binary = binary[:-4]
+            tests.append((name, test_dir, binary))
+    return tests
+
+def _read_dependencies(cmd_runner, executor, source_dir, build_dir):
+    """Reads the files that each target compiles.
+
+    Returns:
+        Dict[str, Set[str]]: For each target, the files within the source
+            tree (relative to source_dir) that its objects depend on.
+    """
+    objects = _read_object_dependencies(cmd_runner, executor, build_dir)
+    source_dir = os.path.normpath(source_dir)
+    dependencies = collections.defaultdict(set)
+    for obj, deps in objects.iteritems():
+        match = _OBJECT_TARGET_RE.search(obj.replace(os.sep, '/'))
+        if not match:
+            continue
+        target = match.group(1)
+        for dep in deps:
+            path = _get_source_path(dep, source_dir)
+            if path is not None:
+                dependencies[target].add(path)
+    return dependencies
+
+def _get_source_path(path, source_dir):
+    """Returns path relative to source_dir, or None if it is outside it."""
+    path = os.path.relpath(os.path.normpath(path), source_dir)
+    if path.startswith(os.pardir):
+        return None
+    return path.replace(os.sep, '/')
+
+def _read_object_dependencies(cmd_runner, executor, build_dir):
+    """Reads the files that each object file depends on.
+
+    Returns:
+        Dict[str, Set[str]]: For each object file, the files it depends on
+            (all as absolute paths).
+    """
+    objects = collections.defaultdict(set)
+    compile_commands = os.path.join(build_dir, 'compile_commands.json')
+    if os.path.isfile(compile_commands):
+        for entry in json.loads(''.join(executor.read_file(compile_commands))):
+            output = _get_compile_output(entry)
+            if output:
+                directory = entry['directory']
+                objects[os.path.join(directory, output)].add(os.path.join(directory, entry['file']))
+    if os.path.isfile(os.path.join(build_dir, 'build.ninja')):
+        output = cmd_runner.check_output(['ninja', '-t', 'deps'], cwd=build_dir)
+        _parse_ninja_deps(output.splitlines(), build_dir, objects)
+    for dirpath, dirnames, filenames in _walk_build_tree(build_dir):
+        for name in ('depend.make', 'compiler_depend.make'):
+            if name in filenames:
+                _parse_make_deps(executor.read_file(os.path.join(dirpath, name)), build_dir, objects)
+    return objects
+
+def _get_compile_output(entry):
+    if 'output' in entry:
+        return entry['output']
+    args = entry.get('arguments', None)
+    if args is None:
+        args = entry.get('command', '').split()
+    for index, arg in enumerate(args):
+        if arg == '-o' and index + 1 < len(args):
+            return args[index + 1]
+        if arg.startswith('-o') and len(arg) > 2:
+            return arg[2:]
+        if arg.startswith('/Fo'):
+            return arg[3:]
+    return None
+
+def _parse_ninja_deps(lines, build_dir, objects):
+    obj = None
+    for line in lines:
+        if not line.strip():
+            obj = None
+        elif not line[0].isspace():
+            obj = os.path.join(build_dir, line.split(':', 1)[0])
+        elif obj is not None:
+            objects[obj].add(os.path.join(build_dir, line.strip()))
+
+def _parse_make_deps(lines, build_dir, objects):
+    obj = None
+    for line in lines:
+        text = line.strip()
+        if text.startswith('#'):
+            continue
+        continued = text.endswith('\\')
+        if continued:
+            text = text[:-1]
+        if obj is None:
+            match = _MAKE_RULE_RE.match(text)
+            if not match:
+                continue
+            text = match.group(2) or ''
+            if not text.strip() and not continued:
+                # Phony rule for a header, as written by gcc -MP.
+                continue
+            obj = os.path.join(build_dir, match.group(1).strip())
+        for dep in text.split():
+            objects[obj].add(os.path.join(build_dir, dep))
+        if not continued:
+            obj = None
@@ -0,0 +1,108 @@
+"""
+Historical test timings for scheduling CTest runs
+
+Durations and results of each test are stored after every CTest run in an
+agent-local SQLite database (in the cache directory, see cache.py), keyed by
+the test name, the branch, and the build configuration.  Before later runs,
+the history is written out as the ``CTestCostData.txt`` file that CTest uses
+for ordering tests in parallel runs: previously failed tests and the longest
+tests are started first, which shortens the tail of the test phase.
+"""
+
+import sqlite3
+
+# Number of most recent runs that the stored average duration approximately
+# covers.
+_AVERAGE_WINDOW = 10
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS test_times (
+    name TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    config TEXT NOT NULL,
+    runs INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    failed INTEGER NOT NULL,
+    PRIMARY KEY (name, branch, config)
+)
+"""
+
+class TestTimingStore(object):
+
+    """Stores per-test durations and results between builds.
+
+    Args:
+        connection (sqlite3.Connection): Database to store the timings in.
+    """
+
+    def __init__(self, connection):
+        self._conn = connection
+        with self._conn:
+            self._conn.execute(_SCHEMA)
+
+    def record(self, branch, config, results):
+        """Records the results of a CTest run.
+
+        Args:
+            branch (str): Branch that was tested.
+            config (str): Identifier for the build configuration.
+            results (List[CTestResult]): Results of the tests.
+        """
+        with self._conn:
+            for result in results:
+                row = self._conn.execute(
+                        'SELECT runs, duration FROM test_times'
+                        ' WHERE name=? AND branch=? AND config=?',
+                        (result.name, branch, config)).fetchone()
+                runs, duration = 0, 0.0
+                if row is not None:
+                    runs, duration = row
+                runs += 1
+                duration += (result.duration - duration) / min(runs, _AVERAGE_WINDOW)
+                self._conn.execute(
+                        'INSERT OR REPLACE INTO test_times'
+                        ' (name, branch, config, runs, duration, failed)'
+                        ' VALUES (?, ?, ?, ?, ?, ?)',
+                        (result.name, branch, config, runs, duration,
+                            0 if result.passed else 1))
+
+    def get_history(self, branch, config):
+        """Returns the stored timings for a configuration.
+
+        If the configuration has not been run before, the timings of the
+        tests are averaged over all the configurations of the branch (or all
+        branches, if needed), which still gives a useful ordering.
+
+        Returns:
+            List[Tuple[str, int, float, bool]]: Name, number of runs, average
+                duration, and whether the last run failed, for each test.
+        """
+        queries = [
+                ('SELECT name, runs, duration, failed FROM test_times'
+                    ' WHERE branch=? AND config=?', (branch, config)),
+                ('SELECT name, SUM(runs), AVG(duration), 0 FROM test_times'
+                    ' WHERE branch=? GROUP BY name', (branch,)),
+                ('SELECT name, SUM(runs), AVG(duration), 0 FROM test_times'
+                    ' GROUP BY name', ())
+            ]
+        for query, params in queries:
+            rows = self._conn.execute(query, params).fetchall()
+            if rows:
+                return [(name, runs, duration, bool(failed))
+                        for name, runs, duration, failed in sorted(rows)]
+        return []
+
+def write_cost_data(executor, path, history):
+    """Writes test history in the CTestCostData.txt format.
+
+    Args:
+        executor (Executor): Executor to use for writing the file.
+        path (str): Path to the file to write.
+        history (List): Test history as returned by
+            TestTimingStore.get_history().
+    """
+    lines = ['{0} {1} {2:.6f}\n'.format(name, runs, duration)
+            for name, runs, duration, failed in history]
+    lines.append('---\n')
+    lines.extend([name + '\n' for name, runs, duration, failed in history if failed])
+    executor.write_file(path, ''.join(lines))
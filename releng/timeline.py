@@ -0,0 +1,199 @@
+"""
+Timing and resource usage instrumentation for builds
+
+Records how long each command and each major build step takes, together with
+the CPU time and peak memory usage of the child processes, so that it is
+possible to see where the time of a build goes.  The results are written in
+the Chrome trace-event format (viewable in chrome://tracing or Perfetto) and
+summarized on the console at the end of the build.
+"""
+from __future__ import print_function
+
+import json
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; only wall times are recorded there.
+    resource = None
+
+def _get_child_rusage():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (usage.ru_utime, usage.ru_stime, usage.ru_maxrss)
+
+class TimelineSpan(object):
+
+    """Timing information for a single command or build step.
+
+    Instances are created by Timeline.span(), which returns a context manager
+    that measures the time spent within the with block.  The caller can set
+    ``returncode`` to record the exit code of a command.
+
+    Attributes:
+        name (str): Command line or name of the build step.
+        category (str): ``cmd`` for commands, ``step`` for build steps.
+        args (Dict): Additional information to show in the trace.
+        returncode (int or None): Exit code of the command, if any.
+        start (float): Start time, in seconds from the start of the timeline.
+        duration (float or None): Wall time spent, in seconds.
+        user_time (float or None): User CPU time used by child processes.
+        sys_time (float or None): System CPU time used by child processes.
+        max_rss (int or None): Peak resident set size (as reported by
+            getrusage(), i.e., in kilobytes on Linux) of the child
+            processes, if it exceeded that of all previous child processes.
+    """
+
+    def __init__(self, timeline, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.returncode = None
+        self.start = None
+        self.duration = None
+        self.user_time = None
+        self.sys_time = None
+        self.max_rss = None
+        self._timeline = timeline
+        self._start_usage = None
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.current_thread()
+        self._start_usage = self._timeline._rusage()
+        self.start = self._timeline._clock() - self._timeline._start_time
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = self._timeline._clock() - self._timeline._start_time
+        self.duration = end - self.start
+        end_usage = self._timeline._rusage()
+        if self._start_usage is not None and end_usage is not None:
+            self.user_time = end_usage[0] - self._start_usage[0]
+            self.sys_time = end_usage[1] - self._start_usage[1]
+            if end_usage[2] > self._start_usage[2]:
+                self.max_rss = end_usage[2]
+        self._timeline._add_span(self)
+        return False
+
+class Timeline(object):
+
+    """Collects timing information for the commands and steps of a build.
+
+    Usage of child processes is measured with getrusage(RUSAGE_CHILDREN),
+    which only covers child processes that have terminated.  For commands run
+    concurrently (with CommandRunner.submit()), the CPU times of overlapping
+    commands are thus attributed to all of them, and should be interpreted
+    with care.
+    """
+
+    def __init__(self, clock=time.time, rusage=_get_child_rusage):
+        self._clock = clock
+        self._rusage = rusage
+        self._start_time = clock()
+        self._lock = threading.Lock()
+        self._spans = []
+        self._thread_ids = dict()
+
+    @property
+    def spans(self):
+        """Returns all finished spans in the order they finished."""
+        return list(self._spans)
+
+    def span(self, name, category='cmd', **kwargs):
+        """Returns a context manager that records a span around a with block.
+
+        Args:
+            name (str): Command line or name of the build step.
+            category (Optional[str]): ``cmd`` for commands, ``step`` for
+                build steps.
+            **kwargs: Additional information to show in the trace.
+        """
+        return TimelineSpan(self, name, category, kwargs)
+
+    def _add_span(self, span):
+        with self._lock:
+            if span._thread not in self._thread_ids:
+                self._thread_ids[span._thread] = len(self._thread_ids)
+            self._spans.append(span)
+
+    def to_trace(self):
+        """Returns the timeline in Chrome trace-event format.
+
+        Returns:
+            Dict: JSON-serializable object with the trace events.
+        """
+        events = []
+        for thread, tid in sorted(self._thread_ids.items(), key=lambda x: x[1]):
+            events.append({
+                    'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                    'args': { 'name': thread.name }
+                })
+        for span in self._spans:
+            args = dict(span.args)
+            for key in ('returncode', 'user_time', 'sys_time', 'max_rss'):
+                value = getattr(span, key)
+                if value is not None:
+                    args[key] = value
+            events.append({
+                    'name': span.name,
+                    'cat': span.category,
+                    'ph': 'X',
+                    'ts': int(span.start * 1e6),
+                    'dur': int(span.duration * 1e6),
+                    'pid': 1,
+                    'tid': self._thread_ids[span._thread],
+                    'args': args
+                })
+        return { 'traceEvents': events, 'displayTimeUnit': 'ms' }
+
+    def write_trace(self, executor, path):
+        """Writes the timeline as a Chrome trace file."""
+        executor.write_file(path, json.dumps(self.to_trace()))
+
+    def print_summary(self, console, max_commands=10):
+        """Prints a summary table of the build steps and the slowest commands.
+
+        Args:
+            console (file): Stream to write the summary to.
+            max_commands (Optional[int]): Number of slowest commands to show.
+        """
+        steps = [x for x in self._spans if x.category == 'step']
+        steps.sort(key=lambda x: x.start)
+        cmds = [x for x in self._spans if x.category == 'cmd']
+        cmds.sort(key=lambda x: x.duration, reverse=True)
+        cmds = cmds[:max_commands]
+        if not steps and not cmds:
+            return
+        print('Build timeline summary:', file=console)
+        print('  {0:>9} {1:>9} {2:>9} {3:>9} {4:>5}  {5}'.format(
+            'wall(s)', 'user(s)', 'sys(s)', 'rss(MB)', 'exit', 'step/command'),
+            file=console)
+        for title, spans in (('Build steps:', steps), ('Slowest commands:', cmds)):
+            if not spans:
+                continue
+            print(title, file=console)
+            for span in spans:
+                print('  ' + self._format_row(span), file=console)
+
+    def _format_row(self, span):
+        def format_value(value, fmt):
+            if value is None:
+                return '-'
+            return fmt.format(value)
+        name = span.name
+        if len(name) > 80:
+            name = name[:77] + '...'
+        rss_mb = None
+        if span.max_rss is not None:
+            rss_mb = span.max_rss / 1024.0
+        return '{0:>9} {1:>9} {2:>9} {3:>9} {4:>5}  {5}'.format(
+                format_value(span.duration, '{0:.1f}'),
+                format_value(span.user_time, '{0:.1f}'),
+                format_value(span.sys_time, '{0:.1f}'),
+                format_value(rss_mb, '{0:.0f}'),
+                format_value(span.returncode, '{0}'),
+                name)
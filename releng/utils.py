@@ -3,6 +3,7 @@ Misc. utility functions.
 """
 
 import sys
+import xml.etree.ElementTree as ET
 
 def flush_output():
     """Ensures all output is flushed before an external process is started.
@@ -40,3 +41,46 @@ def write_property_file(executor, path, values):
     """
     contents = ''.join(['{0} = {1}\n'.format(key, value) for key, value in values.iteritems() if value is not None])
     executor.write_file(path, contents)
+
+def iterparse_elements(blocks, path):
+    """Yields elements at a given path from an XML document as they are parsed.
+
+    Each element is removed from the tree after the caller has processed it,
+    so that memory usage does not grow with the size of the document.
+
+    Args:
+        blocks (Iterable[str]): Contents of the XML document.
+        path (List[str]): Tags of the elements to find, starting from the
+            child of the root element.
+    """
+    stack = []
+    for event, elem in ET.iterparse(_IterableReader(blocks), events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            continue
+        stack.pop()
+        if [x.tag for x in stack[1:]] + [elem.tag] == path:
+            yield elem
+            stack[-1].remove(elem)
+
+class _IterableReader(object):
+    """Provides file-like read() for an iterable of strings (for iterparse)."""
+
+    def __init__(self, blocks):
+        self._blocks = iter(blocks)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            block = next(self._blocks, None)
+            if block is None:
+                break
+            chunks.append(block)
+            length += len(block)
+        data = ''.join(chunks)
+        if size < 0:
+            size = length
+        self._buffer = data[size:]
+        return data[:size]
@@ -10,7 +10,16 @@ import os.path
 import tarfile
 
 from common import BuildError, CommandError, ConfigurationError
-from common import Project
+from common import CheckoutMode, Project, System
+import cache
+
+# Thresholds for triggering git maintenance in a workspace repository.
+# These match the defaults of gc.auto and gc.autoPackLimit in git.
+_GIT_LOOSE_OBJECTS_LIMIT = 6700
+_GIT_PACKS_LIMIT = 50
+
+# Number of extracted tarballs to keep in the agent-local cache.
+_TARBALL_CACHE_MAX_ENTRIES = 10
 
 class CheckedOutProject(object):
     """Information about a checked-out project.
@@ -19,11 +28,17 @@ class CheckedOutProject(object):
         root (str): Root directory where the project has been checked out.
         tarball_path (str): Path to the tarball where the project has been
             extracted from (if it exists).
+        refspec (RefSpec): Refspec that has been checked out, if the checkout
+            was done by Workspace.
+        checkout_mode (CheckoutMode): How much history was fetched in the
+            checkout, if the checkout was done by Workspace from git.
     """
 
-    def __init__(self, root, tarball_path=None):
+    def __init__(self, root, tarball_path=None, refspec=None, checkout_mode=None):
         self.root = root
         self.tarball_path = tarball_path
+        self.refspec = refspec
+        self.checkout_mode = checkout_mode
 
     @property
     def is_tarball(self):
@@ -55,6 +70,13 @@ class Workspace(object):
         self._out_of_source = None
         self._logs_dir = os.path.join(self.root, 'logs')
         self.install_dir = os.path.join(self.root, 'test-install')
+        self._pending_git_maintenance = []
+        self._git_mirror_dir = None
+        self._tarball_cache_dir = None
+        if factory.system != System.WINDOWS:
+            if not factory.env.get('RELENG_DISABLE_GIT_MIRRORS', None):
+                self._git_mirror_dir = cache.get_cache_dir(factory.env, 'git')
+            self._tarball_cache_dir = cache.get_cache_dir(factory.env, 'tarballs')
 
     def _set_initial_checkouts(self, projects):
         """Sets projects checked out externally from Git.
@@ -111,7 +133,7 @@ class Workspace(object):
             project_info = self._get_checkout_info(self._default_project)
             if project_info.is_tarball:
                 self._executor.remove_path(project_info.root)
-                self._extract_tarball(project_info.tarball_path)
+                self._extract_tarball(project_info.refspec)
             elif not project_info.refspec.is_no_op:
                 self._run_git_clean(project_info.root)
 
@@ -196,36 +218,218 @@ class Workspace(object):
         path = self.get_log_dir(category=category)
         return os.path.join(path, name)
 
-    def _checkout_project(self, project, refspec):
-        """Checks out the given project."""
+    def _checkout_project(self, project, refspec, checkout_mode=CheckoutMode.FULL):
+        """Checks out the given project.
+
+        Args:
+            project (Project): Project to check out.
+            refspec (RefSpec): Refspec to check out.
+            checkout_mode (Optional[CheckoutMode]): How much history to fetch
+                (ignored for tarballs, and for fetches through git mirrors,
+                which do not copy any objects into the workspace).
+        """
         if refspec.is_tarball:
             props = refspec.tarball_props
             # TODO: Remove possible other directories from earlier extractions.
             project_dir = os.path.join(self.root, '{0}-{1}'.format(project, props['PACKAGE_VERSION']))
             self._executor.remove_path(project_dir)
-            self._extract_tarball(refspec.tarball_path)
-            project_info = CheckedOutProject(project_dir, refspec.tarball_path)
+            self._extract_tarball(refspec)
+            project_info = CheckedOutProject(project_dir, refspec.tarball_path, refspec=refspec)
         else:
             if not refspec.is_no_op:
-                self._do_git_checkout(project, refspec)
+                checkout_mode = self._do_git_checkout(project, refspec, checkout_mode)
+            else:
+                checkout_mode = None
             project_dir = os.path.join(self.root, project)
-            project_info = CheckedOutProject(project_dir)
+            project_info = CheckedOutProject(project_dir, refspec=refspec,
+                    checkout_mode=checkout_mode)
         self._checkouts[project] = project_info
 
-    def _extract_tarball(self, tarball_path):
-        with tarfile.open(tarball_path) as tar:
-            tar.extractall(self.root)
+    def _extract_tarball(self, refspec):
+        """Extracts the tarball for a tarball refspec into the workspace.
+
+        Extracted trees are cached on the agent, keyed by the checksum of the
+        tarball from its package info, and later extractions of the same
+        tarball copy the files from the cache (see Executor.copy_tree())
+        instead of decompressing the tarball again.
+        """
+        tarball_path = refspec.tarball_path
+        props = refspec.tarball_props
+        key = props.get('MD5SUM', None) or props.get('HEAD_HASH', None)
+        if not self._tarball_cache_dir or not key:
+            with tarfile.open(tarball_path) as tar:
+                tar.extractall(self.root)
+            return
+        cache_dir = self._tarball_cache_dir
+        entry_dir = os.path.join(cache_dir, cache.compute_key(key, os.path.basename(tarball_path)))
+        self._executor.ensure_dir_exists(cache_dir)
+        with self._executor.lock_file(os.path.join(cache_dir, 'cache.lock')):
+            if not os.path.isdir(entry_dir):
+                temp_dir = entry_dir + '.tmp'
+                self._executor.ensure_dir_exists(temp_dir, ensure_empty=True)
+                with tarfile.open(tarball_path) as tar:
+                    tar.extractall(temp_dir)
+                os.rename(temp_dir, entry_dir)
+            else:
+                print('Using cached extraction of ' + tarball_path, file=self._cmd_runner.console)
+            cache.touch(entry_dir)
+            for name in os.listdir(entry_dir):
+                dest = os.path.join(self.root, name)
+                self._executor.remove_path(dest)
+                self._executor.copy_tree(os.path.join(entry_dir, name), dest)
+            cache.prune_lru(cache_dir, _TARBALL_CACHE_MAX_ENTRIES, self._executor.remove_path)
+
+    def _do_git_checkout(self, project, refspec, checkout_mode):
+        """Fetches and checks out a refspec from git.
 
-    def _do_git_checkout(self, project, refspec):
+        Returns:
+            CheckoutMode: How much history was actually fetched.
+        """
         project_dir = os.path.join(self.root, project)
         self._executor.ensure_dir_exists(project_dir)
         runner = self._cmd_runner
-        if not os.path.isdir(os.path.join(project_dir, '.git')):
+        git_dir = os.path.join(project_dir, '.git')
+        if os.path.isdir(git_dir) and not self._has_valid_git_alternates(git_dir):
+            # The mirror that the repository borrows objects from has been
+            # removed, so the repository is no longer usable.
+            self._executor.remove_path(git_dir)
+        if not os.path.isdir(git_dir):
             runner.check_call(['git', 'init'], cwd=project_dir)
-        runner.check_call(['git', 'fetch', self._gerrit.get_git_url(project), refspec.fetch], cwd=project_dir)
-        runner.check_call(['git', 'checkout', '-qf', refspec.checkout], cwd=project_dir)
-        runner.check_call(['git', 'gc'], cwd=project_dir)
+        url = self._gerrit.get_git_url(project)
+        # A full fetch into a repository left shallow by an earlier checkout
+        # needs to explicitly fetch the missing history.
+        unshallow = os.path.isfile(os.path.join(git_dir, 'shallow')) \
+                and checkout_mode != CheckoutMode.SHALLOW
+        fetched = False
+        if self._git_mirror_dir:
+            try:
+                self._fetch_through_git_mirror(project, project_dir, url, refspec, unshallow)
+                fetched = True
+            except CommandError:
+                print('Fetching through git mirror failed, fetching directly', file=self._cmd_runner.console)
+        if fetched:
+            checkout_mode = CheckoutMode.FULL
+        else:
+            cmd = ['git', 'fetch']
+            if unshallow:
+                cmd.append('--unshallow')
+            if checkout_mode == CheckoutMode.SHALLOW:
+                cmd.append('--depth=1')
+            elif checkout_mode == CheckoutMode.PARTIAL:
+                cmd.append('--filter=blob:none')
+            cmd.extend([url, refspec.fetch])
+            runner.check_call(cmd, cwd=project_dir)
+        try:
+            runner.check_call(['git', 'checkout', '-qf', refspec.checkout], cwd=project_dir)
+        except CommandError:
+            # The commit to check out may not be the tip of the fetched ref,
+            # in which case a shallow fetch does not have it.
+            if checkout_mode != CheckoutMode.SHALLOW:
+                raise
+            self._fetch_full_history(project_dir, url, refspec)
+            checkout_mode = CheckoutMode.FULL
+            runner.check_call(['git', 'checkout', '-qf', refspec.checkout], cwd=project_dir)
+        self._check_git_maintenance(project_dir)
         self._run_git_clean(project_dir)
+        return checkout_mode
+
+    def _fetch_full_history(self, project_dir, url, refspec):
+        self._cmd_runner.check_call(['git', 'fetch', '--unshallow', url, refspec.fetch],
+                cwd=project_dir)
+
+    def ensure_full_history(self, project):
+        """Ensures that the full git history is available for a project.
+
+        Projects checked out in the shallow checkout mode only have the built
+        commit available.  Build scripts that need the history (e.g., to run
+        git describe or git log) should call this first; it does nothing if
+        the history is already available.
+
+        Args:
+            project (Project): Project whose history is needed.
+        """
+        project_info = self._get_checkout_info(project)
+        if project_info.checkout_mode != CheckoutMode.SHALLOW:
+            return
+        url = self._gerrit.get_git_url(project)
+        self._fetch_full_history(project_info.root, url, project_info.refspec)
+        project_info.checkout_mode = CheckoutMode.FULL
+
+    def _find_project_for_path(self, path):
+        """Returns the checked-out project that contains the given path, if any."""
+        path = os.path.abspath(path)
+        for project, project_info in self._checkouts.iteritems():
+            root = os.path.abspath(project_info.root)
+            if path == root or path.startswith(root + os.sep):
+                return project
+        return None
+
+    def _fetch_through_git_mirror(self, project, project_dir, url, refspec, unshallow):
+        """Fetches a refspec into a project through a shared git mirror.
+
+        The agent-wide bare mirror of the project is first updated from url,
+        and the project repository is set up to borrow objects from the mirror
+        through objects/info/alternates, such that fetching from the mirror
+        does not need to copy any objects.  The lock ensures that concurrent
+        builds on the same agent do not update the mirror simultaneously,
+        and that the fetched ref is not moved before we fetch it.
+        """
+        runner = self._cmd_runner
+        mirror_dir = os.path.join(self._git_mirror_dir, project + '.git')
+        mirror_ref = _get_git_mirror_ref(refspec.fetch)
+        self._executor.ensure_dir_exists(self._git_mirror_dir)
+        with self._executor.lock_file(mirror_dir + '.lock'):
+            if not os.path.isdir(mirror_dir):
+                runner.check_call(['git', 'init', '--bare', mirror_dir])
+            runner.check_call(['git', 'fetch', url, '+{0}:{1}'.format(refspec.fetch, mirror_ref)],
+                    cwd=mirror_dir)
+            alternates_path = os.path.join(project_dir, '.git', 'objects', 'info', 'alternates')
+            self._executor.write_file(alternates_path, os.path.join(mirror_dir, 'objects') + '\n')
+            cmd = ['git', 'fetch', mirror_dir, mirror_ref]
+            if unshallow:
+                cmd.insert(2, '--unshallow')
+            runner.check_call(cmd, cwd=project_dir)
+
+    def _check_git_maintenance(self, project_dir):
+        """Schedules maintenance for a repository if it has grown too fragmented.
+
+        Repacking is only needed occasionally, and can take a long time for
+        large repositories, so it is not done during the build, but deferred
+        until _run_deferred_maintenance().
+        """
+        try:
+            output = self._cmd_runner.check_output(['git', 'count-objects', '-v'], cwd=project_dir)
+        except CommandError:
+            return
+        counts = dict()
+        for line in output.splitlines():
+            key, value = line.split(':', 1)
+            if value.strip().isdigit():
+                counts[key.strip()] = int(value)
+        if counts.get('count', 0) >= _GIT_LOOSE_OBJECTS_LIMIT \
+                or counts.get('packs', 0) >= _GIT_PACKS_LIMIT:
+            self._pending_git_maintenance.append(project_dir)
+
+    def _run_deferred_maintenance(self):
+        """Starts maintenance scheduled during the build in the background.
+
+        Called after the build status has been reported, so that the
+        maintenance does not delay the build result.
+        """
+        for project_dir in self._pending_git_maintenance:
+            print('Starting git gc in background in ' + project_dir, file=self._executor.console)
+            self._executor.spawn_detached(['git', 'gc', '--quiet'], cwd=project_dir)
+        self._pending_git_maintenance = []
+
+    def _has_valid_git_alternates(self, git_dir):
+        alternates_path = os.path.join(git_dir, 'objects', 'info', 'alternates')
+        if not os.path.isfile(alternates_path):
+            return True
+        for line in self._executor.read_file(alternates_path):
+            path = line.strip()
+            if path and not os.path.isdir(path):
+                return False
+        return True
 
     def _run_git_clean(self, project_dir):
         self._cmd_runner.check_call(['git', 'clean', '-ffdxq'], cwd=project_dir)
@@ -277,3 +481,13 @@ class Workspace(object):
                 self._cmd_runner.check_call(cmd, cwd=cwd)
             except CommandError as e:
                 raise BuildError('Failed to upload the commit with updated files running ' + e.cmd + ' in cwd ' + cwd)
+
+def _get_git_mirror_ref(fetch_refspec):
+    """Returns the ref in a git mirror that stores a fetched refspec.
+
+    The refs are never deleted, which keeps all objects ever fetched reachable
+    in the mirror; workspace repositories may borrow any of them.
+    """
+    if fetch_refspec.startswith('refs/'):
+        fetch_refspec = fetch_refspec[len('refs/'):]
+    return 'refs/releng/' + fetch_refspec
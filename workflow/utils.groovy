@@ -27,7 +27,7 @@ def checkoutSilent(project)
         git fetch ssh://jenkins@gerrit.gromacs.org/${project}.git ${fetch_refspec}
         git checkout -qf ${checkout_refspec}
         git clean -ffdxq
-        git gc
+        git gc --auto
         """.stripIndent()
 }
 
@@ -73,7 +73,7 @@ def runRelengScript(contents, propagate = true)
             'ssh://jenkins@gerrit.gromacs.org/releng.git', os.environ['RELENG_REFSPEC']])
         subprocess.check_call(['git', 'checkout', '-qf', os.environ['RELENG_HASH']])
         subprocess.check_call(['git', 'clean', '-ffdxq'])
-        subprocess.check_call(['git', 'gc'])
+        subprocess.check_call(['git', 'gc', '--auto'])
         os.chdir('..')
         """
     runRelengScriptInternal(checkoutScript, contents, propagate)